@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import SocketServer
 import cPickle as pickle
 import logging
 import socket
@@ -19,28 +20,85 @@ class RobotCommandError(Exception):
     """Used when a robot command cannot be executed"""
     pass
 
+class ConnectionLostError(Exception):
+    """Used when the connection to the server drops or stops answering"""
+    pass
+
 class Robot(object):
     """Wraps the communication protocol with the robot server"""
+    # seconds to wait for a reply before giving up on the connection
+    REPLY_TIMEOUT = 1.
+
     def __init__(self, host, port):
         """connects to the driver server"""
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
+        self.host = host
+        self.port = port
+        self.connect()
 
+        self.disconnected = False
+
+        # the session token we got with control, to take it back after a reconnect
+        self.session = None
+        self.reconnects = 0
+        self.last_outage = None
+
+        # round trips, for the messages/s and round trip time in the status
+        self.messages = 0
+        self.round_trip = None
+        self.rate_start = time.time()
+        self.rate_messages = 0
+        self.message_rate = 0
+
+    def connect(self):
+        """Opens a connection to the server"""
+        self.sock = socket.create_connection((self.host, self.port), self.REPLY_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.server = self.sock.makefile('w')
 
-        self.disconnected = False
+    def reconnect(self):
+        """Connects again and takes back control if we had it
 
-    def _send_command(self, command):
-        """Sends a command to the server"""
+        Raises socket.error or ConnectionLostError if the server can't be
+        reached, and RobotCommandError if control can't be taken back yet;
+        the session is kept either way, so the next try starts over.
+        """
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.connect()
+        self.reconnects += 1
+
+        if self.session:
+            try:
+                self._send_command('resume %s' % self.session)
+            except RobotCommandError:
+                # held too long, or the server restarted; start over
+                self.become_controller()
+
+    def _request(self, command):
+        """Sends a command to the server and returns the pickled reply"""
+        start = time.time()
         command = "%s\n" % (command.strip())
-        self.server.write(command)
-        self.server.flush()
+        try:
+            self.server.write(command)
+            self.server.flush()
+
+            #read the length of the result
+            length = int(self.server.readline())
+            output = self.server.read(length)
+            if len(output) < length:
+                raise EOFError("connection closed mid-reply")
+        except (socket.error, ValueError, EOFError), e:
+            raise ConnectionLostError("lost connection to %s:%s (%s)" % (self.host, self.port, e))
 
-        #read the length of the result
-        length = int(self.server.readline())
-        output = self.server.read(length)
+        self.messages += 1
+        self.round_trip = time.time() - start
+        return output
 
-        result = pickle.loads(output)
+    def _send_command(self, command):
+        """Sends a command to the server"""
+        result = pickle.loads(self._request(command))
         if result[0] == 'ok':
             return result[1]
         else:
@@ -48,8 +106,12 @@ class Robot(object):
 
     def disconnect(self):
         """Stops the motors and disconnects from the server"""
-        self.stop()
-        self._send_command('exit')
+        try:
+            self.stop()
+            self._send_command('exit')
+        except ConnectionLostError:
+            # the server stops the robot once our session runs out
+            pass
         self.sock.close()
         self.disconnected = True
 
@@ -61,7 +123,14 @@ class Robot(object):
 
     def become_controller(self):
         """Becomes the exclusive client driving the robot"""
-        return self._send_command('control')
+        output = self._send_command('control')
+        if 'session' in output:
+            self.session = output.split()[-1]
+        return output
+
+    def reload(self):
+        """Has the server reread its parameters file; only the controller may"""
+        return self._send_command('reload')
 
     ###### the interface of the driver #####
     def brake(self, speed):
@@ -91,11 +160,60 @@ class Robot(object):
 
         return ", ".join(outputs)
 
+    def set_speeds(self, left, right):
+        """sets the speeds of both motors in one command"""
+        return self._send_command("speeds %d %d" % (left, right))
+
+    def tune(self, kp, ki = None, kd = None):
+        """Changes the gains of a closed-loop driver's speed controllers"""
+        gains = [gain for gain in (kp, ki, kd) if gain is not None]
+        return self._send_command("tune %s" % ' '.join(str(gain) for gain in gains))
+
+    def run_trajectory(self, segments):
+        """Has the server run a list of segments: ('w', seconds, left, right) or ('c', seconds, speed, curvature)"""
+        return self._send_command("trajectory %s" % ' '.join(
+            ':'.join(str(value) for value in segment) for segment in segments))
+
     def get_status(self):
         return self._send_command('status')
 
+    @property
+    def status(self):
+        now = time.time()
+        if now - self.rate_start >= 1:
+            self.message_rate = (self.messages - self.rate_messages) / (now - self.rate_start)
+            self.rate_start, self.rate_messages = now, self.messages
+
+        return {
+                'messages':self.messages,
+                'messages/s':round(self.message_rate, 1),
+                'round trip':round(self.round_trip, 4) if self.round_trip is not None else None,
+                'reconnects':self.reconnects,
+                'last outage':round(self.last_outage, 3) if self.last_outage is not None else None,
+                }
+
 class RobotClient(object):
-    """Controls the robot"""
+    """Controls the robot
+
+    Input and the network run separately. run() polls the UI in the
+    calling thread and applies every movement command to the steering
+    model's targets; a control thread wakes up at a fixed rate, sends the
+    one-shot commands (go, stop, ...) in the order they came in, then the
+    model's setpoint if the server doesn't have it yet, and fetches the
+    status. The setpoint also goes out again on a Hold, and once it is
+    KEEPALIVE_INTERVAL old, so the monitor doesn't brake a controller
+    that is holding a steady speed. A slow round trip only delays the next tick, never the input.
+    """
+    # seconds between control ticks
+    CONTROL_INTERVAL = .05
+    # seconds to wait for the UI when it has no input
+    INPUT_INTERVAL = .01
+    # seconds after which an unchanged setpoint is sent again; well under
+    # the monitor's control_timeout_brake
+    KEEPALIVE_INTERVAL = 1.
+    # seconds between reconnection attempts, doubling from the first to the last
+    RECONNECT_DELAYS = (.02, 2.)
+
     def __init__(
             self, robot, ui, steering_model, player, allow_control = True, become_controller = False):
         self.robot = robot
@@ -106,6 +224,12 @@ class RobotClient(object):
         self.allow_control = allow_control
         self.become_controller = become_controller
 
+        # input waiting for the next tick, guarded by the lock
+        self.lock = threading.Lock()
+        self.actions = []
+        self.input_time = None      # when the oldest movement input since the last tick came in
+
+        self.stats = ControlStats()
         self._stop = threading.Event()
 
     def run(self):
@@ -113,48 +237,395 @@ class RobotClient(object):
         if self.become_controller:
             self.robot.become_controller()
 
+        control = threading.Thread(target = self.control_loop, name = 'control-loop')
+        control.setDaemon(True)
+        control.start()
+
+        try:
+            while not self._stop.is_set():
+                user_commands = self.ui.get_commands()
+                for user_command in user_commands:
+                    self.handle_input(user_command)
+                if not user_commands:
+                    self._stop.wait(self.INPUT_INTERVAL)
+        finally:
+            self._stop.set()
+            control.join()
+
+    def handle_input(self, user_command):
+        """Applies a UI command to the steering model or queues it for the next tick"""
+        # if we don't allow control, then only allow quit command
+        if not self.allow_control and type(user_command) != commands.Quit:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.stats.events += 1
+            if type(user_command) in (commands.Brake, commands.Hold, commands.Drive, commands.Steer):
+                self.steering.parse_user_command(user_command)
+                if self.input_time is not None:
+                    self.stats.coalesced += 1
+                else:
+                    self.input_time = now
+            else:
+                # a stop overrides whatever movement was still waiting
+                if type(user_command) == commands.Stop:
+                    self.steering.stop()
+                    self.input_time = None
+                self.actions.append(user_command)
+
+    def control_loop(self):
+        """Runs a control tick every CONTROL_INTERVAL seconds"""
+        deadline = time.time()
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except ConnectionLostError, e:
+                logging.error(str(e))
+                self.ui.error_notify(e)
+                self.reconnect()
+            except Exception, e:
+                logging.exception("control tick failed")
+                self.ui.error_notify(e)
+                self._stop.set()
+                break
+
+            deadline += self.CONTROL_INTERVAL
+            delay = deadline - time.time()
+            if delay < 0:
+                # a round trip took longer than a tick; don't try to catch up
+                self.stats.late_ticks += 1
+                deadline = time.time()
+            else:
+                self._stop.wait(delay)
+
+    def reconnect(self):
+        """Keeps trying to get back to the server, backing off; input goes on meanwhile"""
+        start = time.time()
+        delay, max_delay = self.RECONNECT_DELAYS
         while not self._stop.is_set():
-            user_command = self.ui.get_command()
+            try:
+                self.robot.reconnect()
+                break
+            except (socket.error, ConnectionLostError, RobotCommandError), e:
+                # control may still be reserved, or held by whoever took over
+                logging.info("reconnecting: %s" % e)
+                self._stop.wait(delay)
+                delay = min(delay * 2, max_delay)
+        else:
+            return
+
+        self.robot.last_outage = time.time() - start
+        logging.warn("reconnected after %.3fs" % self.robot.last_outage)
+        self.ui.error_notify("reconnected after %.3fs" % self.robot.last_outage)
+
+        # send our setpoint again, whatever the server did while we were gone
+        with self.lock:
+            self.steering.resend()
+
+    def run_action(self, user_command):
+        """Carries out one button press from the UI"""
+        if type(user_command) == commands.Quit:
+            self.robot.disconnect()
+            self._stop.set()
+            return
+        elif type(user_command) == commands.Shutdown:
+            try:
+                self.robot.shutdown()
+            except ConnectionLostError:
+                pass
+            self._stop.set()
+            return
+
+        try:
+            if type(user_command) == commands.Horn and self.player:
+                self.player.play(self.player.SOUNDS['honk'])
+            elif type(user_command) == commands.Reset:
+                self.robot.reset()
+            elif type(user_command) == commands.Go:
+                self.robot.go()
+            elif type(user_command) == commands.Stop:
+                self.robot.stop()
+        except RobotCommandError, e:
+            logging.error(str(e))
+            self.ui.error_notify(e)
+
+    def tick(self):
+        """Sends what the UI asked for since the last tick and fetches the status"""
+        with self.lock:
+            actions, self.actions = self.actions, []
+        for number, user_command in enumerate(actions):
+            try:
+                self.run_action(user_command)
+            except ConnectionLostError:
+                # try these again once we're back
+                with self.lock:
+                    self.actions[:0] = actions[number:]
+                raise
+            if self._stop.is_set():
+                return
+
+        with self.lock:
+            setpoint = self.steering.advance()
+            changed = self.allow_control and (setpoint != self.steering.acked or
+                    self.steering.keepalive_due(self.KEEPALIVE_INTERVAL))
+            input_time, self.input_time = self.input_time, None
+
+        if changed:
+            try:
+                if 'brake' in setpoint:
+                    self.robot.brake(setpoint['brake'])
+                else:
+                    self.robot.set_speeds(setpoint['left'], setpoint['right'])
+                with self.lock:
+                    self.steering.sent(setpoint)
+            except RobotCommandError, e:
+                logging.error(str(e))
+                self.ui.error_notify(e)
+                with self.lock:
+                    self.steering.rejected()
+            if input_time is not None:
+                self.stats.setpoint_sent(time.time() - input_time)
+        elif input_time is not None:
+            self.stats.unchanged += 1
+
+        status = self.robot.get_status()
+        with self.lock:
+            # takes the server's targets if they aren't what we sent
+            self.steering.update_status(status)
 
-            # if we don't allow control, then only allow quit command
-            if not self.allow_control and type(user_command) != commands.Quit:
-                user_command = None
+        status['client'] = self.status
+
+        self.ui.update_status(status)
+
+        if self.player:
+            self.player.update_status(status)
+
+    @property
+    def status(self):
+        status = self.stats.status
+        status.update(self.robot.status)
+        status.update(self.steering.status)
+        if self.player:
+            status.update(self.player.status)
+        return status
+
+class ControlStats(object):
+    """Counts what the control loop did with the UI input"""
+    def __init__(self):
+        self.events = 0         # UI commands handled
+        self.coalesced = 0      # movement commands folded into a later one
+        self.unchanged = 0      # setpoints not sent since they matched the last
+        self.setpoints = 0      # setpoints sent
+        self.late_ticks = 0
+
+        self.last_latency = None
+        self.max_latency = 0
+        self.total_latency = 0
+
+    def setpoint_sent(self, latency):
+        """Records how long the oldest input in a setpoint waited to go out"""
+        self.setpoints += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    @property
+    def status(self):
+        return {
+                'events':self.events,
+                'coalesced':self.coalesced,
+                'unchanged':self.unchanged,
+                'setpoints':self.setpoints,
+                'late ticks':self.late_ticks,
+                'latency':round(self.last_latency, 4) if self.last_latency is not None else None,
+                'max latency':round(self.max_latency, 4),
+                'mean latency':round(self.total_latency / self.setpoints, 4) if self.setpoints else None,
+                }
+
+class StatusRelay(threading.Thread):
+    """Polls the robot's status over one connection for a relay's viewers
+
+    The status is pickled once per poll, with the relay's own numbers
+    under 'relay', and every viewer gets the same bytes. If the robot
+    can't be reached, viewers keep getting the last status, marked as
+    disconnected, while the relay reconnects.
+    """
+    def __init__(self, host, port, interval = RobotClient.CONTROL_INTERVAL):
+        threading.Thread.__init__(self, name = 'status-relay')
+        self.setDaemon(True)
+        self.host = host
+        self.port = port
+        self.interval = interval
+
+        self.robot = Robot(host, port)
+        self.lock = threading.Lock()
+        self.status = None
+        self.reply = None
+        self.updated = None
+        self.connected = True
+
+        self.viewers = 0
+        self.controllers = 0
+        self.served = 0
+        self.polls = 0
+        self.reconnects = 0
+        self._stop = threading.Event()
 
-            if user_command:
-                try:
-                    if type(user_command) == commands.Quit:
-                        self.robot.disconnect()
-                        break
-                    elif type(user_command) == commands.Shutdown:
-                        self.robot.shutdown()
+        self.poll()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        delay, max_delay = RobotClient.RECONNECT_DELAYS
+        deadline = time.time()
+        while not self._stop.is_set():
+            try:
+                if not self.connected:
+                    self.robot.reconnect()
+                    self.connected = True
+                    self.reconnects += 1
+                    delay = RobotClient.RECONNECT_DELAYS[0]
+                    logging.warn("relay reconnected to %s:%s" % (self.host, self.port))
+                self.poll()
+            except (socket.error, ConnectionLostError, RobotCommandError), e:
+                if self.connected:
+                    logging.error("relay lost the robot: %s" % e)
+                    self.connected = False
+                    self.publish(self.status)
+                self._stop.wait(delay)
+                delay = min(delay * 2, max_delay)
+                deadline = time.time()
+                continue
+
+            deadline += self.interval
+            wait = deadline - time.time()
+            if wait < 0:
+                deadline = time.time()
+            else:
+                self._stop.wait(wait)
+
+    def poll(self):
+        """Fetches the status once and publishes it to the viewers"""
+        status = self.robot.get_status()
+        self.polls += 1
+        self.updated = time.time()
+        self.publish(status)
+
+    def publish(self, status):
+        """Pickles the status once for all of the viewers"""
+        status = dict(status)
+        status['relay'] = self.relay_status
+        reply = pickle.dumps(('ok', status), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.status = status
+            self.reply = reply
+
+    def get_reply(self):
+        """The latest status, ready to send"""
+        with self.lock:
+            self.served += 1
+            return self.reply
+
+    @property
+    def relay_status(self):
+        return {
+                'connected':self.connected,
+                'viewers':self.viewers,
+                'controllers':self.controllers,
+                'served':self.served,
+                'polls':self.polls,
+                'reconnects':self.reconnects,
+                'updated':self.updated,
+                }
+
+class RelayHandler(SocketServer.StreamRequestHandler):
+    """Speaks the server's protocol to one downstream client
+
+    Status requests are answered from the relay. The first command that
+    isn't a status request opens the connection's own link to the robot,
+    and from then on everything it sends goes through it unchanged, so
+    control, sessions and the control lock stay with the server. A
+    dropped connection drops its link too, without an exit, so the server
+    holds a controller's session for it to resume.
+    """
+    def send_reply(self, reply):
+        self.wfile.write('%d\n' % len(reply))
+        self.wfile.write(reply)
+        self.wfile.flush()
+
+    def handle(self):
+        relay = self.server.relay
+        upstream = None
+        with relay.lock:
+            relay.viewers += 1
+        logging.info("viewer %s:%s connected" % self.client_address)
+
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.strip()
+
+                if upstream is None:
+                    if command == 'status':
+                        self.send_reply(relay.get_reply())
+                        continue
+                    if not command:
+                        self.send_reply(pickle.dumps(('ok', '')))
+                        continue
+                    if command == 'exit':
+                        self.send_reply(pickle.dumps(('ok', 'done')))
                         break
-                    elif type(user_command) == commands.Horn and self.player:
-                        self.player.play(self.player.SOUNDS['honk'])
-                    elif type(user_command) == commands.Reset:
-                        self.robot.reset()
-                    elif type(user_command) == commands.Go:
-                        self.robot.go()
-                    elif type(user_command) == commands.Stop:
-                        self.robot.stop()
-                    elif type(user_command) in (
-                            commands.Brake, commands.Hold, commands.Drive, commands.Steer):
-                        new_speeds = self.steering.parse_user_command(user_command)
-                        if 'brake' in new_speeds:
-                            self.robot.brake(int(new_speeds['brake']))
-                        else:
-                            self.robot.set_speed(int(new_speeds['left']), 'left')
-                            self.robot.set_speed(int(new_speeds['right']), 'right')
-
-                except RobotCommandError, e:
-                    logging.error(str(e))
-                    self.ui.error_notify(e)
 
-            status = self.robot.get_status()
-            self.ui.update_status(status)
-            self.steering.update_status(status)
+                    upstream = Robot(relay.host, relay.port)
+                    with relay.lock:
+                        relay.controllers += 1
+                    logging.info("passing %s:%s through to the robot" % self.client_address)
 
-            if self.player:
-                self.player.update_status(status)
+                try:
+                    self.send_reply(upstream._request(command))
+                except ConnectionLostError, e:
+                    # let the client see the drop and reconnect through us
+                    logging.error(str(e))
+                    break
+                if command == 'exit':
+                    break
+        finally:
+            with relay.lock:
+                relay.viewers -= 1
+                if upstream is not None:
+                    relay.controllers -= 1
+            if upstream is not None:
+                upstream.sock.close()
+            logging.info("viewer %s:%s disconnected" % self.client_address)
+
+class RelayServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serves one robot's status to any number of viewers"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, sockaddr, relay):
+        SocketServer.TCPServer.__init__(self, sockaddr, RelayHandler)
+        self.relay = relay
+
+def run_relay(host, port, relay_port):
+    """Relays the robot at host:port to viewers on relay_port until interrupted"""
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s relay %(levelname)-8s %(message)s')
+    relay = StatusRelay(host, port)
+    relay.start()
+    server = RelayServer(('', relay_port), relay)
+    logging.warn("relaying %s:%s on port %d" % (host, port, relay_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        server.server_close()
+    return 0
 
 def main():
     """If run directly, we will connect to a server and run the specified UI"""
@@ -171,6 +642,8 @@ def main():
             help="Interact with this type of UI [Default: joyride]")
     uigroup.add_option('-j', '--joystick', action="store", type="string", dest="joystick_device", default=None,
             help="Path to the device file of the joystick (for joyride UI) [Default: None]")
+    uigroup.add_option('-f', '--framebuffer', action="store", type="string", dest="framebuffer_device", default='/dev/fb0',
+            help="Framebuffer device to draw on (for framebuffer UI) [Default: /dev/fb0]")
     uigroup.add_option('-s', '--disable-sound', action="store_false", dest="sound", default=True,
             help="Disable sound [Default: False]")
     uigroup.add_option('-i', '--disable-input', action="store_false", dest="allow_input", default=True,
@@ -179,6 +652,9 @@ def main():
             help="Become exclusive controlling connection [Default: False]")
     uigroup.add_option('-n', '--no-control', action="store_false", dest="allow_control", default=True,
             help="Ignore all UI commands from this client [Default: False]")
+    uigroup.add_option("--steering", action="store", type="choice", dest="steering", default="increment",
+            choices=steering.SteeringModel.MODES,
+            help="increment: each input nudges the speeds; rate: the stick sets how fast they change [Default: increment]")
     uigroup.add_option("--list", action="store_true", dest="list", default=False,
             help="List the available UIs and exit")
     parser.add_option_group(uigroup)
@@ -188,6 +664,8 @@ def main():
             help="Host/address to connect to [Default: localhost]")
     netgroup.add_option('-p', '--port', action="store", type="int", dest="port", default=9999,
             help="Port the server is listening on [Default: 9999]")
+    netgroup.add_option('-r', '--relay', action="store", type="int", dest="relay_port", default=None,
+            help="Instead of running a UI, relay the robot's status to viewers on this port [Default: None]")
     parser.add_option_group(netgroup)
 
     options, args = parser.parse_args()
@@ -205,6 +683,9 @@ def main():
             print "%s %s" % (name.ljust(30), info[0])
         return 0
 
+    if options.relay_port:
+        return run_relay(options.host, options.port, options.relay_port)
+
     # create the robot
     robot = Robot(options.host, options.port)
     status = robot.get_status()
@@ -216,7 +697,7 @@ def main():
         ui = uimod.get_ui(**vars(options))
 
         # create the steerer
-        steerer = steering.SteeringModel(status)
+        steerer = steering.SteeringModel(status, options.steering)
 
         if options.sound:
             player = sound.SoundPlayer(status)
@@ -6,7 +6,21 @@ import time
 import threading
 
 class CursesUI(threading.Thread):
-    """A curses UI or talking to a driver via client"""
+    """A curses UI or talking to a driver via client
+
+    Only the UI thread touches the screen. update_status and error_notify
+    just leave their data for it, and it redraws at most
+    MAX_REFRESH_RATE times a second, whatever the rate of statuses or
+    keystrokes. Each line's text is remembered, so a redraw only writes
+    the span of a line that changed; windows with changes are marked
+    with noutrefresh and the terminal is updated once with doupdate.
+    When the robot is idle, next to nothing goes out to the terminal.
+    """
+    # most screen updates per second
+    MAX_REFRESH_RATE = 5
+    # milliseconds to wait for a key before checking whether to redraw
+    INPUT_TIMEOUT = 20
+
     def __init__(self, allow_input):
         """Initializes ncurses"""
         threading.Thread.__init__(self, name='curses-ui')
@@ -21,6 +35,26 @@ class CursesUI(threading.Thread):
         # it is cleared and returned by get_command
         self._last_key = None
 
+        # the latest status and result, waiting to be drawn
+        self.lock = threading.Lock()
+        self._status = None
+        self._result = None
+
+        # what is on screen: (window, line, margin) -> text, and lines
+        # used by each status window
+        self.lines = {}
+        self.used_lines = {}
+        # windows written to since the last refresh
+        self.touched = {}
+
+        # drawing statistics, and their rates over the last second
+        self.last_render = 0
+        self.frames = 0
+        self.cells = 0
+        self.render_time = 0
+        self.rates = {'frames/s':0, 'cells/s':0, 'cpu':0}
+        self._rate_start = (time.time(), 0, 0, 0)
+
     def init(self):
         """Sets up ncurses and creates all the windows"""
         #initialize ncurses
@@ -33,7 +67,7 @@ class CursesUI(threading.Thread):
         self.stdscr.keypad(1)
 
         curses.curs_set(0)
-        curses.halfdelay(1)
+        self.stdscr.timeout(self.INPUT_TIMEOUT)
 
         #initialize the status and result windows
         self.windows['time'] = self.create_window(' Time ', 3, 82, 0, 0)
@@ -55,15 +89,61 @@ class CursesUI(threading.Thread):
     def run(self):
         """The main loop"""
         while not self._stop.is_set():
-            self.write_line(self.windows['time'], 1, "%.2f" % time.time(), align = 'center')
-            for window in self.windows.values():
-                window.refresh()
+            if time.time() - self.last_render >= 1. / self.MAX_REFRESH_RATE:
+                self.render()
 
             if self.allow_input:
                 try:
                     self._last_key = self.stdscr.getkey()
                 except:
                     pass
+            else:
+                self._stop.wait(self.INPUT_TIMEOUT / 1000.)
+
+    def render(self):
+        """Draws whatever changed since the last call and updates the terminal once"""
+        start = time.time()
+        with self.lock:
+            status, self._status = self._status, None
+            result, self._result = self._result, None
+
+        self.write_line(self.windows['time'], 1, "%s    ui: %d cells/s, %.1f%% cpu" % (
+            time.strftime('%H:%M:%S'), self.rates['cells/s'], self.rates['cpu']), align = 'center')
+        if status:
+            self.draw_status(status)
+        if result:
+            self.write_line(self.windows['result'], 1, result)
+
+        if self.touched:
+            for window in self.touched.values():
+                window.noutrefresh()
+            curses.doupdate()
+            self.touched = {}
+            self.frames += 1
+
+        self.last_render = time.time()
+        self.render_time += self.last_render - start
+        self.update_rates(self.last_render)
+
+    def update_rates(self, now):
+        """Works out the drawing rates once a second"""
+        then, frames, cells, render_time = self._rate_start
+        elapsed = now - then
+        if elapsed < 1:
+            return
+
+        self.rates = {
+                'frames/s':(self.frames - frames) / elapsed,
+                'cells/s':(self.cells - cells) / elapsed,
+                'cpu':100 * (self.render_time - render_time) / elapsed,
+                }
+        self._rate_start = (now, self.frames, self.cells, self.render_time)
+
+    @property
+    def status(self):
+        status = dict(self.rates)
+        status.update({'frames':self.frames, 'cells':self.cells})
+        return status
 
     def stop(self):
         """Stops the UI loop"""
@@ -114,15 +194,38 @@ class CursesUI(threading.Thread):
                     }
             line = align_fun[align](length)
 
-        window.addstr(linenum, left_margin, line)
+        # only write the part of the line that changed
+        key = (id(window), linenum, left_margin)
+        old = self.lines.get(key)
+        if old == line:
+            return
+        self.lines[key] = line
+
+        first, last = 0, len(line)
+        if old is not None and len(old) == len(line):
+            while line[first] == old[first]:
+                first += 1
+            while line[last - 1] == old[last - 1]:
+                last -= 1
+
+        window.addstr(linenum, left_margin + first, line[first:last])
+        self.cells += last - first
+        self.touched[id(window)] = window
 
     def write_result(self, result):
-        self.write_line(self.windows['result'], 1, str(result))
+        """Shows a result in the results window at the next redraw"""
+        with self.lock:
+            self._result = str(result)
 
     def update_status(self, status):
+        """Keeps the latest status for the next redraw"""
+        with self.lock:
+            self._status = status
+
+    def draw_status(self, status):
         """puts the current status into the status windows"""
         for cat, s in status.items():
-            if cat == 'sensors':
+            if cat == 'sensors' or cat not in self.windows:
                 continue
 
             window = self.windows[cat]
@@ -135,15 +238,26 @@ class CursesUI(threading.Thread):
                     for k, v in val.items():
                         self.write_key_value(window, linenum, '  '+k, v)
                         linenum += 1
+                elif isinstance(val, (dict, list)):
+                    # only alerts are shown broken out; skip other nested data
+                    continue
                 else:
                     self.write_key_value(window, linenum, key, val)
                     linenum += 1
+            self.clear_lines(cat, linenum)
 
         sen_line = 1
         for sen in status['sensors']:
             val = "%s%s" % (sen['value'], sen['units'])
             self.write_key_value(self.windows['sensors'], sen_line, sen['name'], val)
             sen_line += 1
+        self.clear_lines('sensors', sen_line)
+
+    def clear_lines(self, name, linenum):
+        """Blanks the lines of a window left over from a longer status"""
+        for old_line in range(linenum, self.used_lines.get(name, linenum)):
+            self.write_line(self.windows[name], old_line, '')
+        self.used_lines[name] = linenum
 
     def get_command(self):
         """Returns the user's last command"""
@@ -178,6 +292,11 @@ class CursesUI(threading.Thread):
             self._last_key = None
         self.cleanup()
 
+    def get_commands(self):
+        """Returns the user's commands since the last call"""
+        command = self.get_command()
+        return [command] if command else []
+
     def error_notify(self, error):
         """Displays the error in the results window"""
         self.write_result("Error at %.2f: %s" % (time.time(), str(error)))
@@ -186,7 +305,7 @@ def get_ui(allow_input, **rest):
     return CursesUI(allow_input)
 
 if __name__ == "__main__":
-    ui = get_ui()
+    ui = get_ui(True)
     ui.init()
 
     ui.start()
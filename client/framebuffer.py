@@ -1,49 +1,396 @@
 #!/usr/bin/python
+"""Shows the robot's status on a framebuffer, such as the on-board display
 
-import curses
+The framebuffer device (or a plain file standing in for one) is mapped
+into memory and drawn on directly. Text comes from a glyph atlas: every
+character is rendered once, at startup, into the rows of pixel bytes it
+takes up in the framebuffer's own format, so drawing a line of text is
+joining those rows and copying them in.
+
+Like the curses UI, each panel remembers the text on every line and only
+the span of a line that changed is redrawn, at most MAX_FRAME_RATE times
+a second, from the UI's own thread.
+"""
+
+import mmap
+import os
+import struct
 import time
 import threading
 
-class CursesUI(threading.Thread):
-    """A curses UI or talking to a driver via client"""
-    def __init__(self):
-        pass
+# 5x7 glyphs for ' ' to '~', one row per byte with the leftmost pixel in bit 4
+FONT = """
+    00 00 00 00 00 00 00   04 04 04 04 04 00 04   0a 0a 0a 00 00 00 00   0a 0a 1f 0a 1f 0a 0a
+    04 0f 14 0e 05 1e 04   18 19 02 04 08 13 03   0c 12 14 08 15 12 0d   0c 04 08 00 00 00 00
+    02 04 08 08 08 04 02   08 04 02 02 02 04 08   00 04 15 0e 15 04 00   00 04 04 1f 04 04 00
+    00 00 00 00 0c 04 08   00 00 00 1f 00 00 00   00 00 00 00 00 0c 0c   00 01 02 04 08 10 00
+    0e 11 13 15 19 11 0e   04 0c 04 04 04 04 0e   0e 11 01 02 04 08 1f   1f 02 04 02 01 11 0e
+    02 06 0a 12 1f 02 02   1f 10 1e 01 01 11 0e   06 08 10 1e 11 11 0e   1f 01 02 04 08 08 08
+    0e 11 11 0e 11 11 0e   0e 11 11 0f 01 02 0c   00 0c 0c 00 0c 0c 00   00 0c 0c 00 0c 04 08
+    02 04 08 10 08 04 02   00 00 1f 00 1f 00 00   08 04 02 01 02 04 08   0e 11 01 02 04 00 04
+    0e 11 01 0d 15 15 0e   0e 11 11 11 1f 11 11   1e 11 11 1e 11 11 1e   0e 11 10 10 10 11 0e
+    1c 12 11 11 11 12 1c   1f 10 10 1e 10 10 1f   1f 10 10 1e 10 10 10   0e 11 10 17 11 11 0f
+    11 11 11 1f 11 11 11   0e 04 04 04 04 04 0e   07 02 02 02 02 12 0c   11 12 14 18 14 12 11
+    10 10 10 10 10 10 1f   11 1b 15 15 11 11 11   11 11 19 15 13 11 11   0e 11 11 11 11 11 0e
+    1e 11 11 1e 10 10 10   0e 11 11 11 15 12 0d   1e 11 11 1e 14 12 11   0f 10 10 0e 01 01 1e
+    1f 04 04 04 04 04 04   11 11 11 11 11 11 0e   11 11 11 11 11 0a 04   11 11 11 15 15 15 0a
+    11 11 0a 04 0a 11 11   11 11 11 0a 04 04 04   1f 01 02 04 08 10 1f   0e 08 08 08 08 08 0e
+    00 10 08 04 02 01 00   0e 02 02 02 02 02 0e   04 0a 11 00 00 00 00   00 00 00 00 00 00 1f
+    08 04 02 00 00 00 00   00 00 0e 01 0f 11 0f   10 10 16 19 11 11 1e   00 00 0e 10 10 11 0e
+    01 01 0d 13 11 11 0f   00 00 0e 11 1f 10 0e   06 09 08 1c 08 08 08   00 0f 11 11 0f 01 0e
+    10 10 16 19 11 11 11   04 00 0c 04 04 04 0e   02 00 06 02 02 12 0c   10 10 12 14 18 14 12
+    0c 04 04 04 04 04 0e   00 00 1a 15 15 11 11   00 00 16 19 11 11 11   00 00 0e 11 11 11 0e
+    00 00 1e 11 1e 10 10   00 00 0d 13 0f 01 01   00 00 16 19 10 10 10   00 00 0e 10 0e 01 1e
+    08 08 1c 08 08 09 06   00 00 11 11 11 13 0d   00 00 11 11 11 0a 04   00 00 11 11 15 15 0a
+    00 00 11 0a 04 0a 11   00 00 11 11 0f 01 0e   00 00 1f 02 04 08 1f   02 04 04 08 04 04 02
+    04 04 04 04 04 04 04   08 04 04 02 04 04 08   00 00 08 15 02 00 00"""
 
-    def start(self):
-        pass
+GLYPH_WIDTH, GLYPH_HEIGHT = 5, 7
+# a blank column and row between characters
+CELL_WIDTH, CELL_HEIGHT = GLYPH_WIDTH + 1, GLYPH_HEIGHT + 1
+
+# colors
+BACKGROUND = (0, 0, 0)
+TEXT = (220, 220, 220)
+TITLE = (0, 0, 0)
+TITLE_BACKGROUND = (230, 180, 40)
+
+def glyph_bitmaps():
+    """Returns the font as {character: rows of bits}"""
+    values = [int(value, 16) for value in FONT.split()]
+    return dict((chr(32 + i), values[i * GLYPH_HEIGHT:(i + 1) * GLYPH_HEIGHT])
+                for i in range(len(values) // GLYPH_HEIGHT))
+
+class Framebuffer(object):
+    """A memory-mapped framebuffer, or a file of the same layout
+
+    geometry is (width, height, bits per pixel); for a real device it is
+    read from sysfs.
+    """
+    def __init__(self, path = '/dev/fb0', geometry = None):
+        stride = None
+        if geometry is None:
+            geometry, stride = self.read_geometry(path)
+        self.width, self.height, self.bpp = geometry
+        if self.bpp not in (16, 24, 32):
+            raise ValueError("can't draw on a %d-bit framebuffer" % self.bpp)
+
+        self.bytes_per_pixel = self.bpp // 8
+        self.stride = stride or self.width * self.bytes_per_pixel
+        self.size = self.stride * self.height
+
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if not path.startswith('/dev/'):
+            # a stand-in file has to be as large as the screen
+            self.file.seek(0, os.SEEK_END)
+            if self.file.tell() < self.size:
+                self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+    @staticmethod
+    def read_geometry(path):
+        """Returns ((width, height, bpp), stride) of a framebuffer device"""
+        sysfs = os.path.join('/sys/class/graphics', os.path.basename(path))
+        def read(name):
+            with open(os.path.join(sysfs, name)) as f:
+                return f.read().strip()
+
+        width, height = [int(value) for value in read('virtual_size').split(',')]
+        return (width, height, int(read('bits_per_pixel'))), int(read('stride'))
+
+    def pixel(self, color):
+        """Returns the bytes of one pixel of an (r, g, b) color"""
+        r, g, b = color
+        if self.bpp == 16:
+            return struct.pack('<H', ((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3))
+        elif self.bpp == 24:
+            return struct.pack('BBB', b, g, r)
+        else:
+            return struct.pack('BBBB', b, g, r, 0)
+
+    def blit(self, x, y, rows):
+        """Copies rows of pixel bytes to the screen with their top left at (x, y)"""
+        offset = y * self.stride + x * self.bytes_per_pixel
+        for row in rows:
+            self.mm[offset:offset + len(row)] = row
+            offset += self.stride
+
+    def fill(self, x, y, width, height, color):
+        """Fills a rectangle with a color"""
+        self.blit(x, y, [self.pixel(color) * width] * height)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+class GlyphAtlas(object):
+    """Every character pre-rendered in one color pair at one scale"""
+    def __init__(self, framebuffer, foreground, background, scale = 1):
+        self.cell_width = CELL_WIDTH * scale
+        self.cell_height = CELL_HEIGHT * scale
+
+        on = framebuffer.pixel(foreground) * scale
+        off = framebuffer.pixel(background) * scale
+
+        self.glyphs = {}
+        for char, bitmap in glyph_bitmaps().items():
+            rows = []
+            for bits in bitmap + [0]:
+                row = ''.join(on if bits & (1 << (GLYPH_WIDTH - 1 - i)) else off
+                        for i in range(GLYPH_WIDTH)) + off
+                rows.extend([row] * scale)
+            self.glyphs[char] = rows
+        self.missing = self.glyphs['?']
+
+    def render(self, text):
+        """Returns the rows of pixel bytes that draw a line of text"""
+        glyphs = [self.glyphs.get(char, self.missing) for char in text]
+        return [''.join(glyph[row] for glyph in glyphs) for row in range(self.cell_height)]
+
+class Panel(object):
+    """A titled box of text lines, measured in character cells"""
+    def __init__(self, ui, title, column, row, columns, lines):
+        self.ui = ui
+        self.title = title
+        self.column = column
+        self.row = row
+        self.columns = columns
+
+        # what each line shows now
+        self.lines = [''] * lines
+        self.used_lines = 0
+
+    def draw_frame(self):
+        """Draws the title bar and blanks the lines"""
+        self.write_text(self.row, self.title.center(self.columns), self.ui.title_atlas)
+        for linenum in range(len(self.lines)):
+            self.lines[linenum] = ' ' * self.columns
+            self.write_text(self.row + 1 + linenum, self.lines[linenum], self.ui.atlas)
+
+    def write_text(self, row, text, atlas, column = 0):
+        """Draws text starting at a character cell; this is one dirty rectangle"""
+        x = (self.column + column) * atlas.cell_width
+        self.ui.framebuffer.blit(x, row * atlas.cell_height, atlas.render(text))
+        self.ui.dirty_rects += 1
+        self.ui.pixels += len(text) * atlas.cell_width * atlas.cell_height
+
+    def write_line(self, linenum, line, align = 'left'):
+        """Shows a line, redrawing only the characters that changed"""
+        if linenum >= len(self.lines):
+            return
+
+        line = line[:self.columns]
+        line = {'left':line.ljust, 'right':line.rjust, 'center':line.center}[align](self.columns)
+
+        old = self.lines[linenum]
+        if old == line:
+            return
+        self.lines[linenum] = line
+
+        first, last = 0, len(line)
+        while line[first] == old[first]:
+            first += 1
+        while line[last - 1] == old[last - 1]:
+            last -= 1
+        self.write_text(self.row + 1 + linenum, line[first:last], self.ui.atlas, first)
+
+    def write_key_value(self, linenum, key, value):
+        """Properly formats and writes a key-value pair"""
+        key, value = str(key), str(value)
+        key_len = max(0, self.columns - len(value) - 1)
+        self.write_line(linenum, "%s %s" % (key[:key_len].ljust(key_len), value))
+
+    def clear_from(self, linenum):
+        """Blanks the lines left over from a longer status"""
+        for old_line in range(linenum, self.used_lines):
+            self.write_line(old_line, '')
+        self.used_lines = linenum
+
+class FramebufferUI(threading.Thread):
+    """An output-only UI for the on-board display"""
+    # most screen updates per second
+    MAX_FRAME_RATE = 4
+    # the layout is drawn for this many character cells, and fits into no
+    # fewer than the minimum
+    COLUMNS, ROWS = 53, 24
+    MIN_COLUMNS, MIN_ROWS = 25, 10
+
+    def __init__(self, device = '/dev/fb0', geometry = None):
+        threading.Thread.__init__(self, name='framebuffer-ui')
+        self.setDaemon(True)
+
+        self.device = device
+        self.geometry = geometry
+
+        # used to stop the UI loop
+        self._stop = threading.Event()
+
+        # the latest status and result, waiting to be drawn
+        self.lock = threading.Lock()
+        self._status = None
+        self._result = None
+
+        # drawing statistics, and their rates over the last second
+        self.frames = 0
+        self.dirty_rects = 0
+        self.pixels = 0
+        self.render_time = 0
+        self.rates = {'pixels/s':0, 'cpu':0}
+        self._rate_start = (time.time(), 0, 0)
+
+    def init(self):
+        """Maps the framebuffer, renders the glyphs and draws the empty panels"""
+        self.framebuffer = fb = Framebuffer(self.device, self.geometry)
+
+        # as large as the screen takes
+        scale = max(1, min(fb.width // (CELL_WIDTH * self.COLUMNS),
+                fb.height // (CELL_HEIGHT * self.ROWS)))
+        self.atlas = GlyphAtlas(fb, TEXT, BACKGROUND, scale)
+        self.title_atlas = GlyphAtlas(fb, TITLE, TITLE_BACKGROUND, scale)
+
+        columns = fb.width // self.atlas.cell_width
+        rows = fb.height // self.atlas.cell_height
+        if columns < self.MIN_COLUMNS or rows < self.MIN_ROWS:
+            raise ValueError("a %dx%d screen is too small; the status needs at least %dx%d pixels" % (
+                fb.width, fb.height, CELL_WIDTH * self.MIN_COLUMNS, CELL_HEIGHT * self.MIN_ROWS))
+
+        # the status panels share what the time, result and titles leave, 10:8
+        lines = rows - 6
+        top = lines * 10 // 18
+        bottom = lines - top
+        half = (columns - 1) // 2
+        self.panels = {
+                'time':Panel(self, ' Time ', 0, 0, columns, 1),
+                'driver':Panel(self, ' Driver Status ', 0, 2, half, top),
+                'monitor':Panel(self, ' Monitor Status ', half + 1, 2, columns - half - 1, top),
+                'arduino':Panel(self, ' Arduino Status ', 0, 3 + top, half, bottom),
+                'sensors':Panel(self, ' Sensor Status ', half + 1, 3 + top, columns - half - 1, bottom),
+                'result':Panel(self, ' Last Result ', 0, 4 + top + bottom, columns, 1),
+                }
+
+        fb.fill(0, 0, fb.width, fb.height, BACKGROUND)
+        for panel in self.panels.values():
+            panel.draw_frame()
+
+    def run(self):
+        """Redraws whatever changed, MAX_FRAME_RATE times a second"""
+        while not self._stop.is_set():
+            self.render()
+            self._stop.wait(1. / self.MAX_FRAME_RATE)
 
     def stop(self):
-        pass
+        """Stops the UI loop"""
+        self._stop.set()
+        if self.is_alive():
+            self.join()
+        self.framebuffer.close()
+
+    def render(self):
+        """Draws the latest status and result"""
+        start = time.time()
+        with self.lock:
+            status, self._status = self._status, None
+            result, self._result = self._result, None
+
+        self.panels['time'].write_line(0, "%s    ui: %d pixels/s, %.1f%% cpu" % (
+            time.strftime('%H:%M:%S'), self.rates['pixels/s'], self.rates['cpu']), align = 'center')
+        if status:
+            self.draw_status(status)
+        if result:
+            self.panels['result'].write_line(0, result)
+
+        self.frames += 1
+        now = time.time()
+        self.render_time += now - start
+        self.update_rates(now)
+
+    def draw_status(self, status):
+        """puts the current status into the status panels"""
+        for cat, s in status.items():
+            if cat == 'sensors' or cat not in self.panels:
+                continue
+
+            panel = self.panels[cat]
+            linenum = 0
+            for key, val in s.items():
+                if key == 'alerts':
+                    panel.write_line(linenum, 'Alerts:')
+                    linenum += 1
+                    for k, v in val.items():
+                        panel.write_key_value(linenum, '  '+k, v)
+                        linenum += 1
+                elif isinstance(val, (dict, list)):
+                    continue
+                else:
+                    panel.write_key_value(linenum, key, val)
+                    linenum += 1
+            panel.clear_from(linenum)
+
+        panel = self.panels['sensors']
+        for linenum, sen in enumerate(status['sensors']):
+            panel.write_key_value(linenum, sen['name'], "%s%s" % (sen['value'], sen['units']))
+        panel.clear_from(len(status['sensors']))
+
+    def update_rates(self, now):
+        """Works out the drawing rates once a second"""
+        then, pixels, render_time = self._rate_start
+        elapsed = now - then
+        if elapsed < 1:
+            return
+
+        self.rates = {
+                'pixels/s':(self.pixels - pixels) / elapsed,
+                'cpu':100 * (self.render_time - render_time) / elapsed,
+                }
+        self._rate_start = (now, self.pixels, self.render_time)
+
+    @property
+    def status(self):
+        status = dict(self.rates)
+        status.update({'frames':self.frames, 'dirty rects':self.dirty_rects, 'pixels':self.pixels})
+        return status
 
     def update_status(self, status):
-        pass
+        """Keeps the latest status for the next frame"""
+        with self.lock:
+            self._status = status
 
     def get_command(self):
         pass
 
+    def get_commands(self):
+        return []
+
     def error_notify(self, error):
-        pass
+        """Shows the error in the result panel at the next frame"""
+        with self.lock:
+            self._result = "Error at %.2f: %s" % (time.time(), str(error))
 
-def get_ui(**options):
-    return FramebufferUI()
+def get_ui(framebuffer_device = '/dev/fb0', **options):
+    return FramebufferUI(framebuffer_device)
 
 if __name__ == "__main__":
-    ui = get_ui()
+    # python framebuffer.py [path [WIDTHxHEIGHTxBPP]] draws a changing
+    # status; give a geometry to draw into a plain file instead of a device
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else '/dev/fb0'
+    geometry = tuple(int(v) for v in sys.argv[2].split('x')) if len(sys.argv) > 2 else None
+
+    ui = FramebufferUI(path, geometry)
     ui.init()
 
     ui.start()
     try:
-        while True:
+        for i in range(40):
+            ui.update_status({
+                'driver':{'target left':i % 10, 'target right':0, 'braking speed':0},
+                'monitor':{'client_age':0.01, 'alerts':{'Battery warn':False}},
+                'arduino':{'estop':False, 'healthy':True},
+                'sensors':[{'name':'Left sonar', 'value':40 + i % 3, 'units':'in'}],
+                })
             time.sleep(0.05)
-
-            command = ui.get_command()
-            if not command:
-                continue
-            if command[0] == 'quit':
-                break
-            else:
-                ui.error_notify("command was %s" % str(command))
+        ui.error_notify("demo finished")
+        time.sleep(0.5)
+        print ui.status
     finally:
         ui.stop()
-
-
@@ -28,6 +28,9 @@ class JoyrideUI(threading.Thread):
     def get_command(self):
         return self.js.get_event()
 
+    def get_commands(self):
+        return self.js.get_commands()
+
     def update_status(self, status):
         pass
 
@@ -7,10 +7,14 @@ stores them in a more usable format.
 [1] http://www.kernel.org/doc/Documentation/input/joystick-api.txt
 """
 
+import array
+import collections
 import commands
+import os
 import select
 import struct
 import threading
+import time
 
 __author__ = 'Jered Wierzbicki'
 
@@ -57,7 +61,6 @@ class RawEvent(object):
 def Normalize(v, calibration):
     """Normalizes v to a value between -1 and 1."""
     v_min, v_zero, v_max = calibration
-    # Maybe use a quadratic bezier curve here or something instead.
     if v < v_zero:
         # -1.0 at v_min approaching 0 at v_zero.
         return max(-1.0, -float(abs(v - v_zero)) / float(abs(v_min - v_zero)))
@@ -66,13 +69,74 @@ def Normalize(v, calibration):
         return min(1.0, float(abs(v - v_zero)) / float(abs(v_max - v_zero)))
 
 
+class ResponseCurve(object):
+    """Maps raw axis values to -1..1 through a precomputed table.
+
+    The normalized value goes through, in order:
+        a deadzone: magnitudes up to deadzone read as exactly 0;
+        saturation: magnitudes from saturation up read as exactly 1;
+        expo: the range in between is blended between linear (0) and
+            cubic (1), for finer control near center.
+    Every possible 16-bit value is worked out once per calibration and
+    curve, and the table is shared by every ResponseCurve that asks for
+    the same one, so mapping an event is a table lookup.
+    """
+
+    # tables already built, by (calibration, deadzone, expo, saturation)
+    tables = {}
+
+    def __init__(self, calibration, deadzone=0, expo=0, saturation=1):
+        if not 0 <= deadzone < saturation <= 1:
+            raise ValueError("need 0 <= deadzone < saturation <= 1")
+        if not 0 <= expo <= 1:
+            raise ValueError("expo must be between 0 and 1")
+        v_min, v_zero, v_max = calibration
+        if v_min == v_zero or v_max == v_zero:
+            raise ValueError("calibration %r has no range on one side" % (calibration,))
+
+        self.deadzone = deadzone
+        self.expo = expo
+        self.saturation = saturation
+
+        key = (tuple(calibration), deadzone, expo, saturation)
+        self.table = self.tables.get(key)
+        if self.table is None:
+            self.table = self.tables[key] = self.build_table(*key)
+
+    @staticmethod
+    def build_table(calibration, deadzone, expo, saturation):
+        """Works out the output for every 16-bit value"""
+        v_min, v_zero, v_max = calibration
+        span = float(saturation - deadzone)
+        linear = 1 - expo
+
+        def curve(n):
+            m = min(1.0, max(0.0, n - deadzone) / span)
+            return linear * m + expo * m * m * m
+
+        # the same steps as Normalize, one side at a time; 0.0 - 0.0 is
+        # 0.0, so the negative side never gives -0.0
+        below = float(abs(v_min - v_zero))
+        above = float(abs(v_max - v_zero))
+        zero = max(-32768, min(32768, v_zero))
+        table = array.array('f', [0.0 - curve(min(1.0, (v_zero - v) / below))
+                                  for v in xrange(-32768, zero)])
+        table.extend([curve(min(1.0, (v - v_zero) / above))
+                      for v in xrange(zero, 32768)])
+        return table
+
+    def __getitem__(self, v):
+        return self.table[v + 32768]
+
+
 class Profile(object):
     """Describes how to interpret joystick events for a particular joystick."""
 
     def __init__(self,
                  steering_axis=-1, left=0, center=0, right=0,
                  drive_axis=-1, forward=0, still=0, reverse=0,
-                 stop_button=-1, horn_button=-1, go_button=-1):
+                 stop_button=-1, horn_button=-1, go_button=-1,
+                 steering_response=None, drive_response=None, threshold=0):
         """Creates a joystick profile.
 
         Args:
@@ -87,6 +151,11 @@ class Profile(object):
             stop_button: The button that means stop.
             horn_button: The button that means honk.
             go_button: The button that starts the penguin.
+            steering_response: ResponseCurve arguments (deadzone, expo,
+                saturation) for the steering axis.
+            drive_response: The same for the drive axis.
+            threshold: Axis events that move the output by less than
+                this are dropped, unless they reach 0 or full scale.
         """
         self.steering_axis = steering_axis
         self.steering = (left, center, right)
@@ -96,6 +165,28 @@ class Profile(object):
         self.horn_button = horn_button
         self.go_button = go_button
 
+        # Only configured axes get a curve; the defaults have no calibration.
+        self.curves = {}
+        if steering_axis >= 0:
+            self.curves[steering_axis] = ResponseCurve(self.steering, **(steering_response or {}))
+        if drive_axis >= 0:
+            self.curves[drive_axis] = ResponseCurve(self.drive, **(drive_response or {}))
+        self.threshold = threshold
+        # The last output passed on for each axis.
+        self.outputs = dict((axis, 0.0) for axis in self.curves)
+        self.suppressed = 0
+
+    def axis_output(self, event):
+        """Returns the new output of an axis, or None if it hasn't moved enough."""
+        output = self.curves[event.number][event.value]
+        last = self.outputs[event.number]
+        if output == last or (abs(output - last) < self.threshold
+                              and output not in (0, -1, 1)):
+            self.suppressed += 1
+            return None
+        self.outputs[event.number] = output
+        return output
+
     def interpret(self, event):
         """Interprets a raw event as a comand."""
         # Ignore init events.
@@ -106,11 +197,14 @@ class Profile(object):
                 return commands.Horn()
             elif event.number == self.go_button and not event.value:
                 return commands.Go()
-        elif event.event_type == RawEvent.AXIS:
+        elif event.event_type == RawEvent.AXIS and event.number in self.curves:
+            output = self.axis_output(event)
+            if output is None:
+                return None
             if event.number == self.steering_axis:
-                return commands.Steer(Normalize(event.value, self.steering))
-            elif event.number == self.drive_axis:
-                return commands.Drive(Normalize(event.value, self.drive))
+                return commands.Steer(output)
+            else:
+                return commands.Drive(output)
 
 
 class NESController(Profile):
@@ -120,49 +214,112 @@ class NESController(Profile):
         Profile.__init__(self,
             steering_axis=3, left=-32767, center=0, right=32767,
             drive_axis=4, forward=32767, still=0, reverse=-32767,
-            stop_button=2, horn_button=1, go_button=9)
+            stop_button=2, horn_button=1, go_button=9,
+            steering_response=dict(deadzone=0.1, expo=0.3),
+            drive_response=dict(deadzone=0.1),
+            threshold=0.02)
 
 
 class Listener(threading.Thread):
-    """Listens for and queues joystick events."""
+    """Listens for and queues joystick events.
+
+    Every read drains all the events the driver has ready. Button events
+    are all kept, in order; an axis event replaces one for the same axis
+    that hasn't been picked up yet, and takes its place at the end of the
+    queue. So however busy the sticks are, the queue stays short, no
+    button press (stop, go) is lost, and a button still comes after the
+    stick motion that preceded it.
+    """
+
+    # Most events to read at once.
+    READ_EVENTS = 64
 
     def __init__(self, device_path):
         threading.Thread.__init__(self, name='joystick-listener')
         self.setDaemon(True)
         self.device = open(device_path, 'rb', 0)
         self.events_lock = threading.Lock()
-        self.last_event = None
+        self.events = []
+        # axis number -> index in self.events of its pending event
+        self.axis_slots = {}
         self._stop = threading.Event()
 
+        # statistics
+        self.reads = 0
+        self.received = 0
+        self.coalesced = 0
+        self.max_batch = 0
+
     def stop(self):
         """Signals that the listener thread should stop."""
         self._stop.set()
 
     def run(self):
         """Listens for and queues joystick events."""
+        fd = self.device.fileno()
+        partial = ''
         while not self._stop.isSet():
             rlist, _, _ = select.select([self.device], [], [], 0.05)
             if not rlist:
                 # Spin to check for stop signal.
                 continue
 
-            data = self.device.read(RawEvent.BYTES)
-            event = RawEvent.Unpack(data)
-            self.events_lock.acquire()
-            self.last_event = event
-            self.events_lock.release()
+            data = partial + os.read(fd, RawEvent.BYTES * self.READ_EVENTS)
+            if len(data) == len(partial):
+                # The device went away.
+                break
+
+            whole = len(data) - len(data) % RawEvent.BYTES
+            data, partial = data[:whole], data[whole:]
+            self.queue([RawEvent.Unpack(data[i:i + RawEvent.BYTES])
+                        for i in xrange(0, whole, RawEvent.BYTES)])
         self.device.close()
 
-    def get_event(self):
-        """Pops and returns the oldest queued event."""
+    def queue(self, events):
+        """Adds a batch of events, coalescing axis motion."""
+        self.events_lock.acquire()
+        try:
+            self.reads += 1
+            self.received += len(events)
+            self.max_batch = max(self.max_batch, len(events))
+            for event in events:
+                if event.event_type & ~RawEvent.INIT == RawEvent.AXIS:
+                    slot = self.axis_slots.get(event.number)
+                    if slot is not None:
+                        self.events[slot] = None
+                        self.coalesced += 1
+                    self.axis_slots[event.number] = len(self.events)
+                self.events.append(event)
+
+            # Nobody is picking events up; drop the replaced axis slots.
+            if len(self.events) > 4 * self.READ_EVENTS:
+                self.events = [event for event in self.events if event]
+                self.axis_slots = dict((event.number, i) for i, event in enumerate(self.events)
+                                       if event.event_type & ~RawEvent.INIT == RawEvent.AXIS)
+        finally:
+            self.events_lock.release()
+
+    def get_events(self):
+        """Returns all the queued events, oldest first, and empties the queue."""
         self.events_lock.acquire()
         try:
-            event = self.last_event
-            self.last_event = None
-            return event
+            events = [event for event in self.events if event]
+            self.events = []
+            self.axis_slots = {}
+            return events
         finally:
             self.events_lock.release()
 
+    @property
+    def status(self):
+        return {
+                'reads':self.reads,
+                'received':self.received,
+                'coalesced':self.coalesced,
+                'max batch':self.max_batch,
+                'queued':sum(1 for event in self.events if event),
+                }
+
 
 class Joystick(object):
     """Wraps a joystick device."""
@@ -180,15 +337,31 @@ class Joystick(object):
         self.listener = Listener(device_path)
         self.listener.start()
         self.profile = profile
+        # Commands fetched by get_commands but not yet handed out by get_event.
+        self.pending = collections.deque()
 
-    def get_event(self):
-        """Returns True iff the joystick has pending events."""
+    def get_commands(self):
+        """Returns the commands for all the queued events, oldest first."""
         if not self.listener.is_alive():
             raise JoystickError("listener has terminated")
 
-        event = self.listener.get_event()
-        if event:
-            return self.profile.interpret(event)
+        interpreted = [self.profile.interpret(event) for event in self.listener.get_events()]
+        interpreted = list(self.pending) + [command for command in interpreted if command]
+        self.pending.clear()
+        return interpreted
+
+    def get_event(self):
+        """Returns the oldest pending command, or None."""
+        if not self.pending:
+            self.pending.extend(self.get_commands())
+        if self.pending:
+            return self.pending.popleft()
+
+    @property
+    def status(self):
+        status = self.listener.status
+        status['suppressed'] = self.profile.suppressed
+        return status
 
     def close(self):
         """Close the joystick device."""
@@ -200,8 +373,8 @@ if __name__ == '__main__':
     js = Joystick('/dev/input/js0', NESController())
     try:
         while True:
-            ev = js.get_event()
-            if ev:
+            for ev in js.get_commands():
                 print ev
+            time.sleep(0.01)
     finally:
         js.close()
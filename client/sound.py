@@ -1,78 +1,319 @@
 #!/usr/bin/env python
-"""Functionality to play sounds in response to events"""
+"""Functionality to play sounds in response to events
 
+Every sound is decoded once, when it is loaded, into the mixer's format
+(mono, 16-bit, RATE), and the mixer keeps a single output stream open.
+Overlapping sounds are mixed sample by sample. Each sound has a
+priority: starting one cuts off everything of lower priority that is
+playing, and a lower-priority sound that starts while it plays is mixed
+in quietly. The mixer thread sleeps while nothing is playing.
+
+The audio backend is PyAudio, or NullBackend where there is no sound
+card (or in tests); the null backend takes the audio at the pace a real
+one would and keeps count of it. The backend is opened by the mixer
+thread, so starting the client doesn't wait on the sound card.
+
+Sounds come from a SoundBank, found next to this package and shared by
+every player. A sound is decoded the first time it is asked for, or by
+a background preload, and only its PCM is kept.
+"""
+
+import audioop
 import glob
 import os
-import pyaudio
-import Queue
 import threading
 import time
 import wave
 
+# where the bundled sounds are, wherever we're run from
+SOUND_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sounds'))
+
+# the format everything is mixed in
+RATE = 22050
+WIDTH = 2
+CHANNELS = 1
+
+# priorities; an alarm cuts off warnings and feedback
+FEEDBACK, WARNING, ALARM = 0, 1, 2
+PRIORITIES = {
+        'estop':ALARM,
+        'battery_estop_set':ALARM,
+        'driver_estop_set':ALARM,
+        'crash':ALARM,
+        'arduino_unhealthy':WARNING,
+        'battery_warn':WARNING,
+        'driver_warn':WARNING,
+        'encoder_warn':WARNING,
+        'sonar_warn':WARNING,
+        }
+
 class Sound(object):
-    def __init__(self, path):
-        self.wf = wave.open(path, 'rb')
+    """A sound decoded into the mixer's format"""
+    def __init__(self, path, priority = None):
+        self.name = os.path.basename(path)[:-4]
+        self.priority = PRIORITIES.get(self.name, FEEDBACK) if priority is None else priority
 
-class Mixer(threading.Thread):
-    CHUNKSIZE = 1024
+        wf = wave.open(path, 'rb')
+        try:
+            width, channels, rate = wf.getsampwidth(), wf.getnchannels(), wf.getframerate()
+            data = wf.readframes(wf.getnframes())
+        finally:
+            wf.close()
+
+        # 8-bit wav samples are unsigned
+        if width == 1:
+            data = audioop.bias(data, 1, -128)
+        if width != WIDTH:
+            data = audioop.lin2lin(data, width, WIDTH)
+        if channels == 2:
+            data = audioop.tomono(data, WIDTH, .5, .5)
+        if rate != RATE:
+            data, _ = audioop.ratecv(data, WIDTH, CHANNELS, rate, RATE, None)
+
+        self.data = data
+
+    @property
+    def duration(self):
+        return len(self.data) / float(WIDTH * CHANNELS * RATE)
+
+class SoundBank(object):
+    """The sounds in a directory by name, each decoded on first use"""
+    def __init__(self, directory = SOUND_DIR):
+        self.directory = directory
+        self._paths = None
+        self.sounds = {}
+        self.lock = threading.Lock()
+        self.load_time = 0
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            self._paths = dict((os.path.basename(path)[:-4], path)
+                    for path in glob.glob(os.path.join(self.directory, '*.wav')))
+        return self._paths
+
+    def __contains__(self, name):
+        return name in self.paths
 
+    def __getitem__(self, name):
+        with self.lock:
+            sound = self.sounds.get(name)
+            if sound is None:
+                start = time.time()
+                sound = self.sounds[name] = Sound(self.paths[name])
+                self.load_time += time.time() - start
+        return sound
+
+    def preload(self):
+        """Decodes every sound in a background thread"""
+        def load_all():
+            for name in self.paths.keys():
+                self[name]
+        loader = threading.Thread(target = load_all, name = 'sound_preload')
+        loader.setDaemon(True)
+        loader.start()
+        return loader
+
+    @property
+    def status(self):
+        with self.lock:
+            loaded = self.sounds.values()
+        return {
+                'sounds loaded':'%d/%d' % (len(loaded), len(self.paths)),
+                'sound memory':sum(len(sound.data) for sound in loaded),
+                'sound load time':round(self.load_time, 3),
+                }
+
+# shared by all players
+BANK = SoundBank()
+
+class PyAudioBackend(object):
+    """Plays through the default output device"""
     def __init__(self):
+        import pyaudio
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = None
+
+    def open(self, rate, width, channels):
+        self.stream = self.pyaudio.open(
+            format=self.pyaudio.get_format_from_width(width),
+            channels=channels,
+            rate=rate,
+            output=True)
+        self.stream.start_stream()
+
+    def write(self, data):
+        """Blocks until the device has room for the data"""
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+        self.pyaudio.terminate()
+
+class NullBackend(object):
+    """Takes audio at the rate a device would, and counts it"""
+    def __init__(self, realtime = True):
+        self.realtime = realtime
+        self.bytes_per_second = None
+        self.written = 0
+        self.chunks = []
+
+    def open(self, rate, width, channels):
+        self.bytes_per_second = float(rate * width * channels)
+
+    def write(self, data):
+        self.written += len(data)
+        self.chunks.append(data)
+        if self.realtime:
+            time.sleep(len(data) / self.bytes_per_second)
+
+    def close(self):
+        pass
+
+class Voice(object):
+    """A sound being played"""
+    def __init__(self, sound, priority):
+        self.sound = sound
+        self.priority = priority
+        self.position = 0
+
+class Mixer(threading.Thread):
+    # frames mixed and written at a time; about 23ms at RATE
+    CHUNKSIZE = 512
+    # most sounds playing at once
+    MAX_VOICES = 4
+    # volume of sounds playing under a higher-priority one
+    DUCKING = .3
+
+    def __init__(self, backend = None):
         threading.Thread.__init__(self, name = 'player_mixer')
         self.setDaemon(True)
-        self._queue = Queue.Queue(0)
-        self.pyaudio = pyaudio.PyAudio()
+        # opened by the mixer thread if not given
+        self.backend = backend
+        self.voices = []
+        self.condition = threading.Condition()
         self._stop = threading.Event()
 
+        self.played = 0
+        self.preempted = 0
+        self.dropped = 0
+
     def stop(self, final_sound = None):
-        self._stop.set()
-        self.join()
-        if final_sound:
-            self._play(final_sound)
+        """Stops the mixer, after playing final_sound over everything else"""
+        if final_sound and self.is_alive():
+            self.play(final_sound, ALARM + 1)
+            self.wait_until_quiet(final_sound.duration + 1)
 
-        self.pyaudio.terminate()
+        self._stop.set()
+        with self.condition:
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        if self.backend:
+            self.backend.close()
 
     def run(self):
+        if self.backend is None:
+            self.backend = PyAudioBackend()
+        self.backend.open(RATE, WIDTH, CHANNELS)
+        chunk_bytes = self.CHUNKSIZE * WIDTH * CHANNELS
         while not self._stop.isSet():
-            try:
-                sound = self._queue.get(block=False, timeout=0.1)
-                self._play(sound)
-            except Queue.Empty:
-                pass
-
-    def queue(self, sound):
-        self._queue.put(sound)
-
-    def _play(self, sound):
-        stream = self.pyaudio.open(
-            format=self.pyaudio.get_format_from_width(sound.wf.getsampwidth()),
-            channels=sound.wf.getnchannels(),
-            rate=sound.wf.getframerate(),
-            output=True)
-        stream.start_stream()
-        sound.wf.rewind()
-        data = sound.wf.readframes(Mixer.CHUNKSIZE)
-        while data != '':
-            stream.write(data)
-            data = sound.wf.readframes(Mixer.CHUNKSIZE)
-        stream.close()
+            with self.condition:
+                while not self.voices and not self._stop.isSet():
+                    self.condition.wait()
+                data = self._mix(chunk_bytes)
+
+            if data:
+                # blocks for about a chunk's worth of time
+                self.backend.write(data)
+
+    def _mix(self, chunk_bytes):
+        """Mixes the next chunk of every voice; call with the condition held"""
+        if not self.voices:
+            return None
+
+        top = max(voice.priority for voice in self.voices)
+        mixed = None
+        for voice in self.voices:
+            piece = voice.sound.data[voice.position:voice.position + chunk_bytes]
+            voice.position += chunk_bytes
+            if len(piece) < chunk_bytes:
+                piece += '\0' * (chunk_bytes - len(piece))
+            if voice.priority < top:
+                piece = audioop.mul(piece, WIDTH, self.DUCKING)
+            # add saturates rather than wrapping around
+            mixed = piece if mixed is None else audioop.add(mixed, piece, WIDTH)
+
+        self.voices = [voice for voice in self.voices if voice.position < len(voice.sound.data)]
+        if not self.voices:
+            self.condition.notifyAll()
+        return mixed
+
+    def play(self, sound, priority = None):
+        """Starts a sound right away, mixed with whatever else is playing"""
+        priority = sound.priority if priority is None else priority
+        with self.condition:
+            # lower priorities give way
+            playing = len(self.voices)
+            self.voices = [voice for voice in self.voices if voice.priority >= priority]
+            self.preempted += playing - len(self.voices)
+
+            if len(self.voices) >= self.MAX_VOICES:
+                # make room by dropping the lowest priority, oldest sound
+                lowest = min(self.voices, key = lambda voice: voice.priority)
+                if lowest.priority > priority:
+                    self.dropped += 1
+                    return
+                self.voices.remove(lowest)
+                self.dropped += 1
+
+            self.voices.append(Voice(sound, priority))
+            self.played += 1
+            self.condition.notify()
+
+    def wait_until_quiet(self, timeout = None):
+        """Waits until nothing is playing; returns False on timeout"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.voices:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    @property
+    def status(self):
+        with self.condition:
+            playing = [voice.sound.name for voice in self.voices]
+        return {
+                'playing':playing,
+                'played':self.played,
+                'preempted':self.preempted,
+                'dropped':self.dropped,
+                }
 
 class SoundPlayer(object):
-    SOUNDS = dict((os.path.basename(name)[:-4], Sound(name))
-                  for name in glob.glob('../sounds/*.wav'))
+    SOUNDS = BANK
 
-    def __init__(self, status):
+    def __init__(self, status, backend = None):
         self.last_status = status
-        self.mixer = Mixer()
+        self.mixer = Mixer(backend)
+
+        # don't replay alerts that happened before we connected
+        events = status['monitor'].get('events', [])
+        self.last_event = events[-1]['seq'] if events else 0
 
     def start(self):
+        """Starts the mixer and decodes the sounds in the background"""
+        self.SOUNDS.preload()
         self.mixer.start()
 
     def play(self, sound):
-        self.mixer.queue(sound)
+        self.mixer.play(sound)
 
     def stop(self, final_sound = None):
         self.mixer.stop(final_sound)
-        self.mixer.join()
 
     def update_status(self, new_status):
         """Go through the new status and play sounds for any new alerts"""
@@ -81,38 +322,43 @@ class SoundPlayer(object):
 
         old, new = self.last_status['arduino'], new_status['arduino']
         if became_set('estop', old, new):
-            self.mixer.queue(self.SOUNDS['estop'])
+            self.play(self.SOUNDS['estop'])
         elif became_cleared('estop', old, new):
-            self.mixer.queue(self.SOUNDS['clear_estop'])
+            self.play(self.SOUNDS['clear_estop'])
         if became_set('healthy', old, new):
-            self.mixer.queue(self.SOUNDS['arduino_healthy'])
+            self.play(self.SOUNDS['arduino_healthy'])
         elif became_cleared('healthy', old, new):
-            self.mixer.queue(self.SOUNDS['arduino_unhealthy'])
-
-        old, new = self.last_status['monitor']['alerts'], new_status['monitor']['alerts']
-        if became_set('Driver overtemp estop', old, new):
-            self.mixer.queue(self.SOUNDS['driver_estop_set'])
-        elif became_cleared('Driver overtemp estop', old, new):
-            self.mixer.queue(self.SOUNDS['driver_estop_clear'])
-        if became_set('Driver overtemp warn', old, new):
-            self.mixer.queue(self.SOUNDS['driver_warn'])
-        if became_set('Battery estop', old, new):
-            self.mixer.queue(self.SOUNDS['battery_estop_set'])
-        elif became_cleared('Battery estop', old, new):
-            self.mixer.queue(self.SOUNDS['battery_estop_clear'])
-        if became_set('Battery warn', old, new):
-            self.mixer.queue(self.SOUNDS['battery_warn'])
-        if became_set('Sonar warn', old, new):
-            self.mixer.queue(self.SOUNDS['sonar_warn'])
-        if became_set('Encoder warn', old, new):
-            pass
-            #self.mixer.queue(self.SOUNDS['encoder_warn'])
+            self.play(self.SOUNDS['arduino_unhealthy'])
+
+        # the server tells us which sound goes with each alert it sets or clears
+        events = new_status['monitor'].get('events', [])
+        if events and events[-1]['seq'] < self.last_event:
+            # the server restarted and is numbering events from scratch
+            self.last_event = 0
+
+        for event in events:
+            if event['seq'] <= self.last_event:
+                continue
+            self.last_event = event['seq']
+            if event['sound'] in self.SOUNDS:
+                self.play(self.SOUNDS[event['sound']])
 
         self.last_status = new_status
 
+    @property
+    def status(self):
+        status = self.SOUNDS.status
+        mixer = self.mixer.status
+        status.update({
+                'sounds playing':', '.join(mixer['playing']),
+                'sounds played':mixer['played'],
+                'sounds preempted':mixer['preempted'],
+                })
+        return status
+
 if __name__ == "__main__":
     mixer = Mixer()
     mixer.start()
-    mixer.queue(SoundPlayer.SOUNDS['startup'])
+    mixer.play(SoundPlayer.SOUNDS['startup'])
     time.sleep(2)
     mixer.stop()
@@ -1,52 +1,192 @@
 #!/usr/bin/env python
 
+import time
+
 import commands
 
 class SteeringModel(object):
-    def __init__(self, status):
-        self.last_status = status
+    """Keeps the targets the client wants and turns user commands into setpoints
+
+    The targets live here rather than being read back from the last
+    status, so input builds on what was asked for, not on what the server
+    had said a round trip ago. The client calls advance() on every control
+    tick for the setpoint to send, sent() once the server took it, and
+    update_status() with every status. If the server's targets aren't
+    what it was last sent (the monitor braked, a command was rejected, a
+    trajectory ran), the model starts over from the server's.
+
+    There are two ways of steering:
+        increment: every Drive or Steer nudges the targets, as the
+            arrow keys do;
+        rate: the stick position is the rate the speed changes at for
+            Drive, and how hard to turn for Steer; the targets follow in
+            advance(), whether or not new input comes in.
+    """
+    MODES = ('increment', 'rate')
 
+    def __init__(self, status, mode = 'increment'):
+        if mode not in self.MODES:
+            raise ValueError("unknown steering mode '%s'" % mode)
+        self.mode = mode
+
+        # increment mode: change per event at full scale
         self.acceleration = 5
         self.braking = 1
         self.turn_acceleration = 2
 
+        # rate mode: speed change per second and half the wheel speed
+        # difference at full stick
+        self.speed_rate = 20
+        self.turn_speed = 15
+
+        # stick positions, for rate mode, and whether they moved since advance()
+        self.drive = 0
+        self.steer = 0
+        self.moved = False
+
+        self.last_advance = time.time()
+        self.resyncs = 0
+
+        # the setpoint the server last accepted; None to take the server's
+        self.acked = None
+        # when we last had it accepted, and whether a Hold asks to send it again
+        self.sent_at = None
+        self.hold = False
+        self.update_status(status)
+
     def parse_user_command(self, command):
-        """Turns the latest user command into speed instructions for the robot"""
+        """Applies the latest user command to the targets and returns them"""
         if type(command) == commands.Hold:
-            if self.last_status['driver']['braking speed']:
-                return {
-                        'brake':self.last_status['driver']['braking speed'],
-                        }
-            else:
-                return {
-                        'left':self.last_status['driver']['target left'],
-                        'right':self.last_status['driver']['target right']}
+            self.drive = 0
+            self.hold = True
 
         elif type(command) == commands.Steer:
-            speed = abs(command.direction)
-            if command.direction < 0:  # steer left
-                return {
-                        'left':self.last_status['driver']['target left'] - self.turn_acceleration * speed,
-                        'right':self.last_status['driver']['target right'] + self.turn_acceleration * speed}
-            else:  # steer right
-                return {
-                        'left':self.last_status['driver']['target left'] + self.turn_acceleration * speed,
-                        'right':self.last_status['driver']['target right'] - self.turn_acceleration * speed}
+            self.braking_speed = 0
+            if self.mode == 'rate':
+                self.steer = command.direction
+            else:
+                self.left += self.turn_acceleration * command.direction
+                self.right -= self.turn_acceleration * command.direction
 
         elif type(command) == commands.Drive:
-            left = command.speed * self.acceleration
-            right = command.speed * self.acceleration
-            return {
-                    'left':self.last_status['driver']['target left'] + left,
-                    'right':self.last_status['driver']['target right'] + right}
+            self.braking_speed = 0
+            if self.mode == 'rate':
+                self.drive = command.speed
+            else:
+                self.left += command.speed * self.acceleration
+                self.right += command.speed * self.acceleration
 
         elif type(command) == commands.Brake:
-            return {
-                    'brake':self.last_status['driver']['braking speed'] + self.braking * command.speed
-                    }
+            # the driver drops its targets while braking
+            self.left = self.right = 0
+            self.drive = 0
+            self.braking_speed = min(self.max_braking,
+                    self.braking_speed + self.braking * command.speed)
 
         else:
             raise Exception("invalid steering command")
 
+        self.moved = True
+        self.limit()
+        return self.setpoint()
+
+    def stop(self):
+        """The robot was stopped; it starts from standstill"""
+        self.left = self.right = 0
+        self.braking_speed = 0
+        self.drive = self.steer = 0
+        self.acked = None
+        self.sent_at = None
+
+    def advance(self, now = None):
+        """Moves the targets along in rate mode; returns the setpoint to send"""
+        now = now or time.time()
+        elapsed = min(now - self.last_advance, .5)
+        self.last_advance = now
+
+        # with the stick centered, leave the targets to the server
+        if self.mode == 'rate' and not self.braking_speed and (
+                self.drive or self.steer or self.moved):
+            speed = (self.left + self.right) / 2. + self.drive * self.speed_rate * elapsed
+            turn = self.steer * self.turn_speed
+            self.left, self.right = speed + turn, speed - turn
+            self.limit()
+        self.moved = False
+
+        return self.setpoint()
+
+    def limit(self):
+        """Keeps the targets within what the driver accepts"""
+        speed = (self.left + self.right) / 2.
+        speed = max(-self.max_speed, min(self.max_speed, speed))
+        turn = (self.left - self.right) / 2.
+        turn = max(-self.max_turn_speed / 2., min(self.max_turn_speed / 2., turn))
+
+        # give up speed rather than the turn
+        speed = max(abs(turn) - self.max_speed, min(self.max_speed - abs(turn), speed))
+        self.left, self.right = speed + turn, speed - turn
+
+    def setpoint(self):
+        """The targets as the client sends them"""
+        if self.braking_speed:
+            return {'brake':int(self.braking_speed)}
+        return {'left':int(self.left), 'right':int(self.right)}
+
+    def keepalive_due(self, interval, now = None):
+        """Whether the setpoint should go out even though the server has it
+
+        A Hold always sends it; otherwise a setpoint we sent is repeated
+        every interval, so the monitor knows the controller is still there.
+        """
+        if self.hold:
+            return True
+        return self.sent_at is not None and (now or time.time()) - self.sent_at >= interval
+
+    def sent(self, setpoint):
+        """The server accepted this setpoint"""
+        self.acked = setpoint
+        self.sent_at = time.time()
+        self.hold = False
+
+    def resend(self):
+        """The server may have lost the setpoint; send it again"""
+        self.acked = None
+
+    def rejected(self):
+        """The server refused the last setpoint; take its targets on the next status"""
+        self.acked = None
+        self.sent_at = None
+        self.hold = False
+
+    def resync(self, driver):
+        """Starts over from the server's targets"""
+        self.left, self.right = driver['target left'], driver['target right']
+        self.braking_speed = driver['braking speed']
+        self.acked = self.setpoint()
+        # these are the server's targets, not ours to keep alive
+        self.sent_at = None
+
     def update_status(self, status):
         self.last_status = status
+
+        driver = status['driver']
+        self.max_speed = driver.get('max speed', 100)
+        self.max_turn_speed = driver.get('max turn speed', 200)
+        self.max_braking = driver.get('max braking', 100)
+
+        if self.acked is None:
+            self.resync(driver)
+            return
+
+        server = ({'brake':driver['braking speed']} if driver['braking speed'] else
+                {'left':driver['target left'], 'right':driver['target right']})
+        if server != self.acked:
+            self.resyncs += 1
+            self.resync(driver)
+
+    @property
+    def status(self):
+        return {
+                'steering mode':self.mode,
+                'steering resyncs':self.resyncs,
+                }
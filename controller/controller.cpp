@@ -105,13 +105,19 @@ static struct State {
     lastCommandTimestamp(0),
     lastStateSentTimestamp(0),
     emergencyStop(false),
-    runLED(false) { }
+    runLED(false),
+    leftVelocity(0),
+    rightVelocity(0) { }
   unsigned long badCommandsReceived;
   unsigned long commandsReceived;
   unsigned long lastCommandTimestamp;
   unsigned long lastStateSentTimestamp;
   bool emergencyStop;
   bool runLED;
+  // what the motors were last given, echoed so the server can tell
+  // which velocity command arrived
+  int leftVelocity;
+  int rightVelocity;
 } state;
 
 /*************** Prototypes  *********************/
@@ -254,6 +260,8 @@ void send_velocity_to_sabertooth(int left, int right)
     left = 0;
     right = 0;
   }
+  state.leftVelocity = left;
+  state.rightVelocity = right;
   if (left == 0 && right == 0) {
     sabertoothSerial.write(uint8_t(0));
   } else {
@@ -285,6 +293,12 @@ void send_state(unsigned long now)
   Serial.print(state.emergencyStop, DEC);
   Serial.print(";");
 
+  Serial.print("V:");
+  Serial.print(state.leftVelocity, DEC);
+  Serial.print(",");
+  Serial.print(state.rightVelocity, DEC);
+  Serial.print(";");
+
   Serial.print("!");
   for(unsigned int i = 0; i < NumSensors; i++) {
     if (!sensors[i])
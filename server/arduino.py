@@ -5,9 +5,12 @@ import logging
 import os
 import select
 import serial
+import termios
 import threading
 import time
 
+from collections import deque
+
 from sensors import SensorReading
 
 class State(object):
@@ -20,6 +23,7 @@ class State(object):
             bad_commands_received = 0,
             ms_since_command_received = 0,
             emergency_stop = False,
+            velocity = None,
             ):
         self.timestamp = timestamp
         self.commands_sent = commands_sent
@@ -27,17 +31,122 @@ class State(object):
         self.bad_commands_received = bad_commands_received
         self.ms_since_command_received = ms_since_command_received
         self.emergency_stop = emergency_stop
+        # the speeds the arduino last gave the motors, in V command
+        # order; None from firmware that doesn't echo them
+        self.velocity = velocity
 
     def __repr__(self):
         return "State(timestamp=%f, commands_sent=%d, commands_received=%d, "\
                 "bad_commands_received=%d, ms_since_command_received=%d, "\
-                "emergency_stop=%d)" % (
+                "emergency_stop=%d, velocity=%r)" % (
                        self.timestamp,
                        self.commands_sent,
                        self.commands_received,
                        self.bad_commands_received,
                        self.ms_since_command_received,
-                       self.emergency_stop)
+                       self.emergency_stop,
+                       self.velocity)
+
+class LinkBudget(object):
+    """Accounts for the traffic on the serial link and holds back what isn't needed
+
+    Both directions share a 9600 baud link with the 50ms state frames, so
+    nothing redundant is sent:
+        - a heartbeat is skipped if any other command went out recently,
+          since any command resets the arduino's estop timer
+        - a V command is dropped if it repeats the last one and the
+          arduino has acknowledged that one
+
+    A V counts as acknowledged once a state frame from after it was sent
+    echoes the same speeds back. Heartbeats and other commands don't move
+    the echo, so they can't acknowledge a V that was lost, and firmware
+    that doesn't echo never acknowledges one, so every V goes out. An
+    estop (or a G or X) zeroes the motors on the arduino, so the next V
+    always goes out after one.
+    """
+    # start bit + 8 data bits + stop bit
+    BITS_PER_BYTE = 10
+
+    def __init__(self, baud_rate = 9600, heartbeat_secs = .1, window = 1.):
+        self.capacity = float(baud_rate) / self.BITS_PER_BYTE   # bytes/sec each way
+        self.heartbeat_secs = heartbeat_secs
+        self.window = window
+
+        self.lock = threading.Lock()
+        self.sent_bytes = deque()       # (time, bytes) within the window
+        self.received_bytes = deque()
+
+        self.last_sent = 0
+        self.velocity = None            # last V command sent
+        self.velocity_sent = 0
+        self.velocity_acked = False
+
+        self.suppressed_heartbeats = 0
+        self.dropped_setpoints = 0
+
+    def should_send(self, command):
+        """Returns False if command can be left unsent"""
+        with self.lock:
+            now = time.time()
+            if command == 'H' and now - self.last_sent < self.heartbeat_secs:
+                self.suppressed_heartbeats += 1
+                return False
+
+            if command == self.velocity and self.velocity_acked:
+                self.dropped_setpoints += 1
+                return False
+
+            return True
+
+    def sent(self, command, length):
+        """Notes that command went out, taking length bytes"""
+        with self.lock:
+            now = time.time()
+            self.last_sent = now
+            self._add(self.sent_bytes, now, length)
+
+            if command.startswith('V'):
+                self.velocity = command
+                self.velocity_sent = now
+                self.velocity_acked = False
+            elif command in ('G', 'X'):
+                self.velocity = None
+
+    def received(self, length):
+        """Notes a line of length bytes from the arduino"""
+        with self.lock:
+            self._add(self.received_bytes, time.time(), length)
+
+    def state_received(self, state):
+        """Checks a new state from the arduino for acknowledgements and estops"""
+        with self.lock:
+            if state.emergency_stop:
+                self.velocity = None
+            elif self.velocity and not self.velocity_acked and state.timestamp > self.velocity_sent:
+                self.velocity_acked = (state.velocity is not None
+                        and 'V%d,%d' % state.velocity == self.velocity)
+
+    def _add(self, samples, now, length):
+        samples.append((now, length))
+        while samples and now - samples[0][0] > self.window:
+            samples.popleft()
+
+    def _rate(self, samples):
+        now = time.time()
+        return sum(length for t, length in samples if now - t <= self.window) / self.window
+
+    @property
+    def status(self):
+        with self.lock:
+            sent, received = self._rate(self.sent_bytes), self._rate(self.received_bytes)
+            return {
+                    'tx bytes/s':sent,
+                    'rx bytes/s':received,
+                    'tx utilization':round(sent / self.capacity, 3),
+                    'rx utilization':round(received / self.capacity, 3),
+                    'suppressed heartbeats':self.suppressed_heartbeats,
+                    'dropped setpoints':self.dropped_setpoints,
+                    }
 
 class ArduinoMonitor(threading.Thread):
     """Monitors an Arduino state and sends regular heartbeat commands"""
@@ -84,32 +193,61 @@ class ArduinoMonitor(threading.Thread):
         self.last_heartbeat_time = time.time()
 
 class Arduino(object):
-    """Represents an on-board arduino and provides a means of talking to it."""
+    """Represents an on-board arduino and provides a means of talking to it.
+
+    The board resets when DTR is raised. Linux raises DTR whenever the
+    port is opened, and drops it on close if HUPCL is set, which it is by
+    default; so normally every open resets the board. We clear HUPCL as
+    soon as the port is open, so DTR stays up after we close it, or die,
+    and the next open doesn't reset the board. A reset is then a DTR
+    pulse of our own.
+
+    This needs termios, so POSIX only. A port last closed with HUPCL set
+    (by an older server, or after the board was plugged in) still resets
+    the board on the next open.
+    """
 
     # Timeout for buffered serial I/O in seconds.
     IO_TIMEOUT_SEC = 5
 
+    # how long DTR is dropped to reset the board
+    RESET_PULSE_SECS = .05
+
     # how stale does the state get until we are considered no longer healthy?
     HEALTH_TIMEOUT = 2
 
-    def __init__(self, port, baud_rate=9600):
+    def __init__(self, port, baud_rate=9600, reset_board=True):
         """Connects to the Arduino on a serial port.
 
         Args:
             port: The serial port or path to a serial device.
             baud_rate: The bit rate for serial communication.
+            reset_board: Whether to reset the board once the port is open.
 
         Raises:
             ValueError: There is an error opening the port.
             SerialError: There is a configuration error.
         """
         # Build the serial wrapper.
-        self._serial = serial.Serial(port=port,
+        self._serial = serial.Serial(port=None,
                 baudrate=baud_rate, bytesize=8, parity='N', stopbits=1,
                 timeout=self.IO_TIMEOUT_SEC, writeTimeout=self.IO_TIMEOUT_SEC)
+        self._serial.port = port
+        self._serial.open()
         if not self._serial.isOpen():
             raise ValueError("Couldn't open %s" % port)
 
+        # keep DTR up when the port closes, so the next open can leave the board running
+        fd = self._serial.fileno()
+        attributes = termios.tcgetattr(fd)
+        attributes[2] &= ~termios.HUPCL
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+        if reset_board:
+            self._serial.dtr = False
+            time.sleep(self.RESET_PULSE_SECS)
+            self._serial.dtr = True
+
         # container for the internal state
         self.state = None
         self.sensor_readings = {}
@@ -120,6 +258,9 @@ class Arduino(object):
         # used to make sure only a single thread tries to write to the arduino
         self.write_lock = threading.Lock()
 
+        # keeps redundant commands off the link
+        self.link = LinkBudget(baud_rate, ArduinoMonitor.HEARTBEAT_SECS)
+
         # the monitor ensures communication is still flowing
         self.monitor = ArduinoMonitor(self)
 
@@ -143,7 +284,7 @@ class Arduino(object):
     def stop(self):
         """Shuts down communication to the Arduino."""
         # shut down the monitor
-        self.monitor.stop()
+        self.stop_monitor()
         self.monitor.join(timeout=5)
 
         # Maybe that worked, maybe it didn't. We're probably trying to reset
@@ -151,7 +292,18 @@ class Arduino(object):
         if self.monitor.is_alive():
             logging.error('Monitor did not stop.')
 
-        # close the serial port
+        self.close()
+
+    def stop_monitor(self):
+        """Asks the monitor thread to stop, without waiting for it"""
+        self.monitor.stop()
+
+    def monitor_stopped(self):
+        """Returns True once the monitor thread has finished"""
+        return not self.monitor.is_alive()
+
+    def close(self):
+        """Closes the serial port"""
         self._serial.close()
 
     @property
@@ -164,6 +316,7 @@ class Arduino(object):
                 'recieved':self.state.commands_received if self.state else 0,
                 'bad':self.state.bad_commands_received if self.state else 0,
                 }
+        status.update(self.link.status)
         return status
 
     def send_command(self, command):
@@ -173,18 +326,22 @@ class Arduino(object):
             command: An ASCII string which the controller will interpret.
 
         Returns:
-            True if command was sent, False if something went wrong. Note
-            this doesn't guarantee the command was actually received.
+            True if command was sent (or didn't need to be), False if
+            something went wrong. Note this doesn't guarantee the command
+            was actually received.
         """
         if not acquire(self.write_lock, 2):
             return False
 
         try:
-            self._serial.write(command)
-            if not command.endswith('\n'):
-                self._serial.write('\n')
+            command = command.rstrip('\n')
+            if not self.link.should_send(command):
+                return True
+
+            self._serial.write(command + '\n')
             self._serial.flush()
             self.commands_sent += 1
+            self.link.sent(command, len(command) + 1)
         finally:
             self.write_lock.release()
 
@@ -232,7 +389,12 @@ class Arduino(object):
     def update_state(self, timeout = 0):
         """Updates the internal state with fresh data from the arduino"""
         try:
-            state, sensors = self._parse_data(self._read_data(timeout))
+            line = self._read_data(timeout)
+            if line is not None:
+                # the arduino ends lines with \r\n
+                self.link.received(len(line) + 2)
+
+            state, sensors = self._parse_data(line)
             timestamp = time.time()
 
             # update the state
@@ -242,8 +404,10 @@ class Arduino(object):
                     commands_received = int(state['C']),
                     bad_commands_received = int(state['B']),
                     ms_since_command_received = int(state['L']),
-                    emergency_stop = bool(int(state['E'])),)
+                    emergency_stop = bool(int(state['E'])),
+                    velocity = tuple(int(v) for v in state['V'].split(',')) if 'V' in state else None,)
             self.state = new_state
+            self.link.state_received(new_state)
 
             # update the new sensor readings
             for sensor_name, sensor_data in sensors.items():
@@ -289,6 +453,18 @@ class FakeArduino(object):
         """Does nothing on this fake object"""
         pass
 
+    def stop_monitor(self):
+        """Does nothing on this fake object"""
+        pass
+
+    def monitor_stopped(self):
+        """There is no monitor to wait for"""
+        return True
+
+    def close(self):
+        """Does nothing on this fake object"""
+        pass
+
     @property
     def status(self):
         """Returns a dictionary of the arduino's status for the client"""
@@ -329,6 +505,131 @@ class FakeArduino(object):
         else:
             return copy.deepcopy(reading)
 
+class Resetter(object):
+    """Resets the link to the arduino a small step at a time
+
+    Nothing here blocks for long, so whoever calls step() (the server
+    monitor) keeps running while the old monitor thread winds down and the
+    new port is opened. While the reset is in progress a FakeArduino stands
+    in, so anything sending commands sees an estopped, unhealthy arduino
+    rather than a half-closed one.
+
+    install(arduino, placeholder) is called with the stand-in when the
+    reset starts and with the new arduino when it is done. find(serial,
+    reset_board) opens the new arduino. A takeover reset opens it without
+    resetting the board, so a robot driven by a server that died keeps
+    running (see Arduino for when the open itself still resets it).
+    """
+    IDLE = 'idle'
+    STOPPING = 'stopping'
+    SETTLING = 'settling'
+    OPENING = 'opening'
+
+    # how long to wait for the old monitor thread before closing anyway
+    STOP_TIMEOUT = 5
+
+    # pause between closing the old port and scanning for the new one
+    SETTLE_SECS = .5
+
+    def __init__(self, serial, install, find = None):
+        self.serial = serial
+        self.install = install
+        self.find = find or find_arduino
+
+        self.state = self.IDLE
+        self.old = None
+        self.state_deadline = 0
+        self.settle_secs = self.SETTLE_SECS
+        self.takeover = False
+        self.lock = threading.Lock()
+
+        self.started = 0
+        self.resets = 0
+        self.failures = 0
+        self.last_duration = None
+        self.last_outcome = None
+        self.last_error = None
+
+    @property
+    def busy(self):
+        return self.state != self.IDLE
+
+    def start(self, old, settle_secs = None, takeover = False):
+        """Begins resetting, shutting down the old arduino; returns False if already resetting"""
+        with self.lock:
+            if self.busy:
+                return False
+
+            self.takeover = takeover
+            self.settle_secs = self.SETTLE_SECS if settle_secs is None else settle_secs
+            self.started = time.time()
+            self.old = old
+            self.install(FakeArduino(), True)
+
+            if old:
+                old.stop_monitor()
+            self._enter(self.STOPPING, self.STOP_TIMEOUT)
+            return True
+
+    def _enter(self, state, timeout = 0):
+        self.state = state
+        self.state_deadline = time.time() + timeout
+
+    def _finish(self, outcome, error = None):
+        self.state = self.IDLE
+        self.old = None
+        self.takeover = False
+        self.resets += 1
+        self.last_duration = time.time() - self.started
+        self.last_outcome = outcome
+        self.last_error = error
+        if outcome == 'failed':
+            self.failures += 1
+        return outcome
+
+    def step(self):
+        """Advances the reset; returns its outcome when it finishes, or None"""
+        with self.lock:
+            if self.state == self.STOPPING:
+                if self.old and not self.old.monitor_stopped():
+                    if time.time() < self.state_deadline:
+                        return None
+                    logging.error('Monitor did not stop.')
+
+                try:
+                    if self.old:
+                        self.old.close()
+                except:
+                    logging.exception("failed to close old arduino")
+                self.old = None
+                self._enter(self.SETTLING, self.settle_secs)
+
+            if self.state == self.SETTLING:
+                if time.time() < self.state_deadline:
+                    return None
+                self._enter(self.OPENING)
+
+            if self.state == self.OPENING:
+                try:
+                    new = self.find(self.serial, not self.takeover)
+                except Exception, e:
+                    return self._finish('failed', e)
+
+                self.install(new, False)
+                return self._finish('fake' if isinstance(new, FakeArduino) else 'ok')
+
+            return None
+
+    @property
+    def status(self):
+        return {
+                'state':self.state,
+                'resets':self.resets,
+                'failures':self.failures,
+                'last duration':round(self.last_duration, 3) if self.last_duration is not None else None,
+                'last outcome':self.last_outcome,
+                }
+
 def acquire(lock, timeout):
     """Acquire lock with a timeout"""
     if lock.acquire(False):
@@ -342,7 +643,7 @@ def acquire(lock, timeout):
 
     return False
 
-def find_arduino(serial):
+def find_arduino(serial, reset_board = True):
     """returns the first arduino found; if none found, returns a fake arduino"""
     arduinos = []
 
@@ -366,7 +667,7 @@ def find_arduino(serial):
         elif len(matching) > 1:
             raise Exception("Multiple arduinos with serial number %s found!" % serial)
         else:
-            return Arduino(matching[0]['device'])
+            return Arduino(matching[0]['device'], reset_board = reset_board)
 
     # if no serial number passed, pick any old random arduino, including a fake one
     else:
@@ -377,7 +678,7 @@ def find_arduino(serial):
             if len(arduinos) > 1:
                 print "Warning: multiple arduinos found! Using %s" % arduinos[0]['name']
 
-            return Arduino(arduinos[0]['device'])
+            return Arduino(arduinos[0]['device'], reset_board = reset_board)
 
 if __name__ == '__main__':
     a = find_arduino()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""Predictive collision avoidance from the sonars and wheel encoders
+
+Can also be run directly to replay sonar/encoder streams through the
+avoider: with no arguments it drives a simulated robot at a wall from a
+range of speeds, and with a CSV file (as written by save_frames) it
+replays the recorded frames and prints what the avoider decided.
+"""
+
+import collections
+import logging
+import math
+import sys
+import threading
+
+class Frame(object):
+    """One sensor frame as seen by the avoider"""
+    def __init__(self, timestamp, left_sonar, right_sonar, left_rpm, right_rpm, direction = 1):
+        self.timestamp = timestamp
+        self.left_sonar = left_sonar
+        self.right_sonar = right_sonar
+        self.left_rpm = left_rpm
+        self.right_rpm = right_rpm
+        self.direction = direction
+
+    def to_csv(self):
+        return "%f,%s,%s,%f,%f,%d" % (self.timestamp, self.left_sonar, self.right_sonar,
+                self.left_rpm, self.right_rpm, self.direction)
+
+    @staticmethod
+    def from_csv(line):
+        def sonar(value):
+            return None if value == 'None' else int(value)
+
+        fields = line.strip().split(',')
+        return Frame(float(fields[0]), sonar(fields[1]), sonar(fields[2]),
+                float(fields[3]), float(fields[4]), int(fields[5]))
+
+    def __repr__(self):
+        return "Frame(%s)" % self.to_csv()
+
+class CollisionAvoider(object):
+    """Slows or brakes the robot before it runs into whatever the sonars see
+
+    On every frame the closing speed is estimated two ways: from how fast
+    the nearest sonar distance is shrinking, and from the wheel speed the
+    encoders report. The larger of the two is used, so a sonar that
+    hasn't caught up yet doesn't hide a fast approach.
+
+    If the distance left (less a safety margin) is no more than what it
+    takes to stop from the current speed, the robot brakes; otherwise, as
+    the time to collision drops below slow_time, the forward speed limit is
+    scaled down in proportion. Every update is constant time.
+    """
+    def __init__(self, wheel_radius = 8, deceleration = 40, reaction_time = .3,
+            margin = 12, slow_time = 3, min_scale = .2, brake_speed = 20,
+            smoothing = .5, max_frame_gap = .5, history = 2000, **rest):
+        # inches travelled per wheel rpm each second
+        self.rpm_to_speed = 2 * math.pi * wheel_radius / 60.
+
+        # how fast we can count on stopping (inches/s^2), and how long it
+        # takes us to start doing it
+        self.deceleration = float(deceleration)
+        self.reaction_time = reaction_time
+
+        # try to stop at least this many inches from the obstacle
+        self.margin = margin
+
+        self.slow_time = float(slow_time)
+        self.min_scale = min_scale
+        self.brake_speed = brake_speed
+
+        self.smoothing = smoothing
+
+        # frames further apart than this don't give a usable sonar rate
+        self.max_frame_gap = max_frame_gap
+
+        self.last_frame = None
+        self.sonar_closing = 0.
+        self.closing_speed = 0.
+        self.time_to_collision = None
+        self.scale = 1.
+        self.braking = False
+
+        # recent frames, so an incident can be saved and replayed later
+        self.frames = collections.deque(maxlen = history)
+
+    def stopping_distance(self, speed):
+        """Inches needed to stop from speed (inches/s)"""
+        return speed * self.reaction_time + speed * speed / (2 * self.deceleration)
+
+    def update(self, frame):
+        """Processes a new frame; returns (speed scale, whether to brake)"""
+        # nothing to go on until the sonars have read something
+        if frame.timestamp is None:
+            return (self.scale, self.braking)
+
+        last = self.last_frame
+        if last is not None and frame.timestamp == last.timestamp:
+            return (self.scale, self.braking)
+
+        self.frames.append(frame)
+        self.last_frame = frame
+
+        sonars = [d for d in (frame.left_sonar, frame.right_sonar) if d is not None]
+        distance = min(sonars) if sonars else None
+
+        # how fast are the sonars saying we're closing in?
+        last_sonars = [d for d in (last.left_sonar, last.right_sonar) if d is not None] if last else []
+        dt = frame.timestamp - last.timestamp if last else 0
+        if distance is not None and last_sonars and 0 < dt <= self.max_frame_gap:
+            rate = (min(last_sonars) - distance) / dt
+            a = self.smoothing
+            self.sonar_closing = a * self.sonar_closing + (1 - a) * rate
+        else:
+            self.sonar_closing = 0.
+
+        # the sonars face forward, so backing up never closes in
+        wheel_speed = self.rpm_to_speed * (frame.left_rpm + frame.right_rpm) / 2
+        if frame.direction <= 0:
+            wheel_speed = 0.
+            self.sonar_closing = min(self.sonar_closing, 0.)
+
+        self.closing_speed = max(self.sonar_closing, wheel_speed, 0.)
+
+        if distance is None or self.closing_speed <= 0:
+            self.time_to_collision = None
+            self.scale = 1.
+            self.braking = False
+            return (self.scale, self.braking)
+
+        room = distance - self.margin
+        self.time_to_collision = max(room, 0) / self.closing_speed
+        self.braking = room <= self.stopping_distance(self.closing_speed)
+
+        if self.braking:
+            self.scale = 0.
+        elif self.time_to_collision < self.slow_time:
+            self.scale = max(self.min_scale, self.time_to_collision / self.slow_time)
+        else:
+            self.scale = 1.
+
+        return (self.scale, self.braking)
+
+    def save_frames(self, fname):
+        """Writes the recent frames out as CSV in the background"""
+        frames = list(self.frames)
+        def write():
+            try:
+                fhandle = file(fname, 'w')
+                try:
+                    for frame in frames:
+                        fhandle.write(frame.to_csv() + '\n')
+                finally:
+                    fhandle.close()
+            except:
+                logging.exception("failed to save collision frames to %s" % fname)
+
+        writer = threading.Thread(target = write, name = 'collision-recorder')
+        writer.setDaemon(True)
+        writer.start()
+
+    @property
+    def status(self):
+        return {
+                'closing speed':round(self.closing_speed, 1),
+                'time to collision':round(self.time_to_collision, 2) if self.time_to_collision is not None else None,
+                'speed scale':round(self.scale, 2),
+                'braking':self.braking,
+                }
+
+def load_frames(fname):
+    """Reads frames saved by save_frames"""
+    return [Frame.from_csv(line) for line in open(fname) if line.strip()]
+
+def replay(avoider, frames):
+    """Runs recorded frames through the avoider; returns (frame, scale, brake) for each"""
+    return [(frame,) + avoider.update(frame) for frame in frames]
+
+def simulate_approach(avoider, rpm, distance = 240, frame_interval = .05,
+        deceleration = 40, braking_deceleration = 60, min_range = 6, max_time = 30):
+    """Drives a simulated robot at a wall and lets the avoider stop it
+
+    The robot wants to hold rpm; it follows the avoider's speed scale at up
+    to deceleration inches/s^2 and, once told to brake, slows at
+    braking_deceleration. The sonars report whole inches and can't see
+    closer than min_range.
+
+    Returns the closest the robot got to the wall, in inches.
+    """
+    speed_per_rpm = avoider.rpm_to_speed
+    speed = rpm * speed_per_rpm
+    now = 0.
+
+    while now < max_time and distance > 0:
+        sonar = max(int(distance), min_range)
+        current_rpm = speed / speed_per_rpm
+        scale, brake = avoider.update(Frame(now, sonar, sonar, current_rpm, current_rpm))
+
+        if brake:
+            speed = max(0., speed - braking_deceleration * frame_interval)
+        else:
+            target = rpm * speed_per_rpm * scale
+            if target < speed:
+                speed = max(target, speed - deceleration * frame_interval)
+            else:
+                speed = target
+
+        if speed == 0:
+            break
+
+        distance -= speed * frame_interval
+        now += frame_interval
+
+    return distance
+
+def main():
+    from parameters import collision as cp
+
+    if len(sys.argv) > 1:
+        avoider = CollisionAvoider(**cp)
+        for frame, scale, brake in replay(avoider, load_frames(sys.argv[1])):
+            print "%s scale=%.2f brake=%s ttc=%s" % (
+                    frame, scale, brake, avoider.status['time to collision'])
+        return 0
+
+    failed = False
+    for rpm in (20, 40, 60, 80, 100, 120):
+        closest = simulate_approach(CollisionAvoider(**cp), rpm)
+        ok = closest > 0
+        failed = failed or not ok
+        print "%3d rpm: stopped %5.1f\" from the wall %s" % (rpm, closest, '' if ok else '(COLLISION)')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
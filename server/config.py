@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""Versioned snapshots of parameters.py that can be reloaded while running
+
+The server reads parameters.py into a Snapshot at startup and again on
+SIGHUP or the 'reload' meta-command. Each section of the file (every
+dict, plus the safety rules) becomes an attribute of the snapshot, with
+its keys as attributes in turn, so code on hot paths does
+    self.mp.client_timeout
+rather than a dict lookup.
+
+A new snapshot is only swapped in after the check passed to reload()
+accepts it; a bad edit leaves the running configuration alone. The swap
+is a single reference assignment, and the monitor compares versions on
+every tick to apply new values to the driver and safety rules.
+"""
+
+import logging
+import os
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parameters.py')
+
+class ConfigError(Exception):
+    """A configuration that can't be loaded or doesn't pass its check"""
+    pass
+
+class Section(object):
+    """One section of parameters, as attributes"""
+    def __init__(self, values):
+        self.__dict__.update(values)
+        self._values = dict(values)
+
+    def as_dict(self):
+        """Returns the parameters as a dict, e.g. to pass as keyword arguments"""
+        return dict(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, Section) and self._values == other._values
+
+    def __ne__(self, other):
+        return not self == other
+
+class Snapshot(object):
+    """All of the parameters at one version"""
+    def __init__(self, version, namespace, path):
+        self.version = version
+        self.path = path
+        self.loaded = time.time()
+
+        self.sections = []
+        for name, value in namespace.items():
+            if name.startswith('_'):
+                continue
+            if isinstance(value, dict):
+                setattr(self, name, Section(value))
+            elif isinstance(value, (list, tuple)):
+                setattr(self, name, tuple(value))
+            else:
+                continue
+            self.sections.append(name)
+
+    def changed(self, other):
+        """Names of the sections that differ from another snapshot"""
+        return sorted(name for name in set(self.sections) | set(other.sections)
+                if getattr(self, name, None) != getattr(other, name, None))
+
+def read(path, version):
+    """Executes a parameters file and returns it as a snapshot"""
+    namespace = {}
+    try:
+        execfile(path, namespace)
+    except Exception, e:
+        raise ConfigError("cannot load %s: %s" % (path, e))
+
+    return Snapshot(version, namespace, path)
+
+class Config(object):
+    """Holds the current snapshot and replaces it on reload"""
+    def __init__(self, path = DEFAULT_PATH):
+        self.path = path
+        self.current = read(path, 1)
+
+        # only one reload at a time
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+
+    def reload(self, check = None):
+        """Reads the file again; check(snapshot) may raise to reject it
+
+        Returns the new snapshot. Raises ConfigError (leaving the current
+        snapshot in place) if it couldn't be loaded or was rejected.
+        """
+        with self.lock:
+            try:
+                snapshot = read(self.path, self.current.version + 1)
+                if check:
+                    try:
+                        check(snapshot)
+                    except Exception, e:
+                        raise ConfigError("rejected %s: %s" % (self.path, e))
+            except ConfigError, e:
+                self.failures += 1
+                self.last_error = str(e)
+                logging.error(str(e))
+                raise
+
+            changed = snapshot.changed(self.current)
+            self.current = snapshot
+            self.reloads += 1
+            self.last_error = None
+            logging.warn("loaded configuration version %d; changed: %s" % (
+                snapshot.version, ', '.join(changed) or 'nothing'))
+            return snapshot
+
+    @property
+    def status(self):
+        return {
+                'version':self.current.version,
+                'loaded':self.current.loaded,
+                'reloads':self.reloads,
+                'failures':self.failures,
+                'last error':self.last_error,
+                }
@@ -1,7 +1,13 @@
 #!/usr/bin/python
 
 import sabertooth
+import closedloop
+import sim
+import smc
 
 driverlist = {
         'sabertooth':('Talks to the Sabertooth 2x60 via the on-board arduino', sabertooth),
+        'closedloop':('Sabertooth driver holding wheel rpm steady with the encoders', closedloop),
+        'sim':('Drives a simulated robot; no hardware needed', sim),
+        'smc':('Talks to a pair of Pololu Simple Motor Controllers over USB serial', smc),
         }
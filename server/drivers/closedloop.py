@@ -0,0 +1,384 @@
+#!/usr/bin/python
+"""Closed-loop speed control for the sabertooth using the wheel encoders
+
+The open-loop sabertooth driver works out where each wheel's speed should
+be along its motion profile. This driver turns that into a target rpm
+per wheel and runs a PID controller against the encoder rpm on every new
+encoder frame, with the open-loop speed as feed-forward. The controller
+only has to make up for motor mismatch, load and battery sag, so the
+left/right speed adjustments can be left at 1.
+
+Run from the server directory to compare open and closed loop against a
+simulated plant:
+    python -m drivers.closedloop
+"""
+
+import math
+
+import common
+from sabertooth import SabertoothDriver
+
+from parameters import driver as dp
+from parameters import closedloop as cp
+
+class PIDController(object):
+    """A PID controller with feed-forward and anti-windup
+
+    The integral is kept in output units, so gains can be changed on the
+    fly without a bump in the output. It stops integrating whenever the
+    output is saturated in the direction the error is pushing, or when
+    the caller asks it to hold, and never grows past integral_limit.
+    """
+    def __init__(self, kp, ki = 0, kd = 0, output_limit = 100, integral_limit = 100,
+            derivative_smoothing = .5):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+
+        self.output_limit = output_limit
+        self.integral_limit = integral_limit
+        self.derivative_smoothing = derivative_smoothing
+
+        self.reset()
+
+    def reset(self):
+        """Forgets all history, e.g. when the wheel is stopped"""
+        self.integral = 0.
+        self.derivative = 0.
+        self.last_measurement = None
+        self.error = 0.
+        self.output = 0.
+        self.saturated = False
+
+    def set_gains(self, kp = None, ki = None, kd = None):
+        if kp is not None: self.kp = kp
+        if ki is not None: self.ki = ki
+        if kd is not None: self.kd = kd
+
+    def update(self, setpoint, measurement, dt, feed_forward = 0, hold = False):
+        """Returns the new output given a measurement taken dt seconds after the last one"""
+        self.error = setpoint - measurement
+
+        # the derivative is on the measurement so setpoint changes don't kick
+        if self.last_measurement is not None and dt > 0:
+            a = self.derivative_smoothing
+            rate = -(measurement - self.last_measurement) / dt
+            self.derivative = a * self.derivative + (1 - a) * rate
+        self.last_measurement = measurement
+
+        integral = self.integral if hold else self.integral + self.ki * self.error * dt
+        integral = max(-self.integral_limit, min(self.integral_limit, integral))
+
+        output = feed_forward + self.kp * self.error + integral + self.kd * self.derivative
+        self.saturated = abs(output) > self.output_limit
+
+        # anti-windup: only integrate if it doesn't push further into saturation
+        if not self.saturated or (output > 0) != (self.error > 0):
+            self.integral = integral
+
+        self.output = max(-self.output_limit, min(self.output_limit, output))
+        return self.output
+
+    @property
+    def status(self):
+        return {
+                'error':self.error,
+                'integral':self.integral,
+                'output':self.output,
+                'saturated':self.saturated,
+                }
+
+class WheelSpeed(object):
+    """Estimates a wheel's rpm from its pulse counter, one encoder frame at a time
+
+    With only a couple of magnets a frame rarely sees more than one
+    pulse, so speed is measured from the time between pulses. While no
+    pulse arrives, the estimate can't be more than one pulse over the time
+    since the last one, so it decays towards zero.
+    """
+    # the arduino keeps its pulse counters in a 16-bit int
+    COUNTER_MODULUS = 65536
+
+    def __init__(self, magnets = 2, max_pulse_delta = 50, smoothing = .3, timeout = 2):
+        self.magnets = float(magnets)
+        self.max_pulse_delta = max_pulse_delta
+        self.smoothing = smoothing
+
+        # this long without a pulse and the wheel is stopped
+        self.timeout = timeout
+
+        self.rpm = 0.
+        self.timestamp = None   # of the last frame
+        self.dt = 0             # time between the last two frames
+        self._count = None
+        self._last_pulse = None
+
+    def resync(self):
+        """Forgets the last count; the next frame becomes the new baseline"""
+        self._count = None
+        self.rpm = 0.
+
+    def update(self, reading):
+        """Takes in a new frame; returns True if there was one"""
+        if reading is None or reading.timestamp == self.timestamp:
+            return False
+
+        count = int(reading.data)
+        self.dt = reading.timestamp - self.timestamp if self.timestamp is not None else 0
+        self.timestamp = reading.timestamp
+
+        if self._count is None:
+            self._count, self._last_pulse = count, reading.timestamp
+            return True
+
+        pulses = (count - self._count) % self.COUNTER_MODULUS
+        self._count = count
+        if pulses > self.max_pulse_delta:
+            # the arduino was reset, or the count glitched
+            self.resync()
+            self._count, self._last_pulse = count, reading.timestamp
+            return True
+
+        since_pulse = reading.timestamp - self._last_pulse
+        if since_pulse <= 0:
+            return True
+
+        if pulses:
+            measured = (pulses / self.magnets) * (60.0 / since_pulse)
+            self.rpm = self.smoothing * self.rpm + (1 - self.smoothing) * measured
+            self._last_pulse = reading.timestamp
+        elif since_pulse > self.timeout:
+            self.rpm = 0.
+        else:
+            self.rpm = min(self.rpm, (1 / self.magnets) * (60.0 / since_pulse))
+
+        return True
+
+class ClosedLoopSabertoothDriver(SabertoothDriver):
+    """A sabertooth driver which holds each wheel at a target rpm using its encoder"""
+    encoders = ('Left encoder', 'Right encoder')
+    config_sections = ('driver', 'closedloop')
+
+    def __init__(self, robot, **parameters):
+        # set up by configure
+        self.controllers = [PIDController(0, output_limit = 100) for i in (0, 1)]
+        self.wheels = [WheelSpeed() for i in (0, 1)]
+
+        self.target_rpm = [0., 0.]
+        self.measured_rpm = [0., 0.]
+        self.outputs = [0., 0.]
+        self.corrections = [0., 0.]
+        self._directions = [0, 0]
+
+        SabertoothDriver.__init__(self, robot, **parameters)
+
+    def check_parameters(self, max_rpm = 120, kp = .2, ki = .5, kd = 0, max_correction = 30,
+            magnets = 2, max_pulse_delta = 50, speed_smoothing = .3, **rest):
+        values = SabertoothDriver.check_parameters(self, **rest)
+        self.check_gains(kp, ki, kd)
+        values.update({
+                # rpm at a speed of 100 on a fresh battery; used to get the target rpm
+                'max_rpm':self.validate_parameter('Maximum rpm', max_rpm, 1, 10000),
+                'max_correction':self.validate_parameter('Maximum correction', max_correction, 0, 100),
+                'magnets':self.validate_parameter('Magnets', magnets, 1, 100),
+                'max_pulse_delta':self.validate_parameter('Maximum pulse delta', max_pulse_delta, 1, 10000),
+                'speed_smoothing':self.validate_parameter('Speed smoothing', speed_smoothing, 0, .99),
+                'gains':(kp, ki, kd),
+                })
+        return values
+
+    def configure(self, **parameters):
+        SabertoothDriver.configure(self, **parameters)
+        for controller in self.controllers:
+            controller.set_gains(*self.gains)
+            controller.integral_limit = self.max_correction
+
+        for wheel in self.wheels:
+            wheel.magnets = float(self.magnets)
+            wheel.max_pulse_delta = self.max_pulse_delta
+            wheel.smoothing = self.speed_smoothing
+
+    def check_gains(self, kp = None, ki = None, kd = None):
+        for name, gain in (('kp', kp), ('ki', ki), ('kd', kd)):
+            if gain is not None and (gain < 0 or math.isinf(gain) or math.isnan(gain)):
+                raise common.ParameterError("Gain %s must be a non-negative number" % name)
+
+    def set_gains(self, kp = None, ki = None, kd = None):
+        """Changes the gains of both wheels' controllers"""
+        self.check_gains(kp, ki, kd)
+        for controller in self.controllers:
+            controller.set_gains(kp, ki, kd)
+
+        controller = self.controllers[0]
+        self.gains = (controller.kp, controller.ki, controller.kd)
+
+    def stop(self):
+        SabertoothDriver.stop(self)
+        for controller in self.controllers:
+            controller.reset()
+        self.outputs = [0., 0.]
+        self.corrections = [0., 0.]
+
+    def _send_speeds(self, speeds):
+        """Corrects the open-loop speeds with encoder feedback before sending them"""
+        for i in (0, 1):
+            wheel, controller = self.wheels[i], self.controllers[i]
+            reading = self.robot.sensors[self.encoders[i]].last_reading
+            new_frame = wheel.update(reading)
+
+            # the encoders can't tell direction, so trust the profile's
+            direction = cmp(self.last_speeds[i], 0)
+            self.target_rpm[i] = self.last_speeds[i] / 100. * self.max_rpm
+            self.measured_rpm[i] = direction * wheel.rpm
+
+            # open loop while braking, stopped, or changing direction
+            if self.braking_speed or speeds[i] == 0 or direction != self._directions[i]:
+                controller.reset()
+                self.outputs[i] = speeds[i]
+
+            # only correct when there's something new to correct with; the
+            # rpm estimate lags while the profile ramps, so leave the
+            # integral alone until it settles
+            elif new_frame:
+                ramping = self.profiles[i].acceleration != 0
+                self.outputs[i] = controller.update(self.target_rpm[i], self.measured_rpm[i],
+                        wheel.dt, speeds[i], hold = ramping)
+                self.corrections[i] = self.outputs[i] - speeds[i]
+
+            # between frames, follow the feed-forward with the last correction
+            else:
+                self.outputs[i] = max(-100, min(100, speeds[i] + self.corrections[i]))
+
+            if controller.last_measurement is None:
+                self.corrections[i] = 0.
+
+            self._directions[i] = direction
+
+        return SabertoothDriver._send_speeds(self, self.outputs)
+
+    @property
+    def status(self):
+        status = SabertoothDriver.status.fget(self)
+        controller = self.controllers[0]
+        status.update({
+                'target rpm left':round(self.target_rpm[0], 1),
+                'target rpm right':round(self.target_rpm[1], 1),
+                'measured rpm left':round(self.measured_rpm[0], 1),
+                'measured rpm right':round(self.measured_rpm[1], 1),
+                'output left':round(self.outputs[0], 1),
+                'output right':round(self.outputs[1], 1),
+                'kp':controller.kp,
+                'ki':controller.ki,
+                'kd':controller.kd,
+                })
+        return status
+
+def get_driver(robot, snapshot, **rest):
+    args = ClosedLoopSabertoothDriver.section_parameters(snapshot)
+    args['robot'] = robot
+    return ClosedLoopSabertoothDriver(**args)
+
+class MotorPlant(object):
+    """A simulated motor and wheel, for trying controllers without the robot
+
+    The wheel settles exponentially towards an rpm proportional to the
+    command and the battery level, minus whatever the load takes away.
+    Pulses are counted like the arduino does, in a 16-bit counter.
+    """
+    def __init__(self, max_rpm = 120, time_constant = .3, magnets = 2, battery = 1., load = 0):
+        self.max_rpm = max_rpm
+        self.time_constant = time_constant
+        self.magnets = magnets
+
+        self.battery = battery  # fraction of full battery voltage
+        self.load = load        # rpm lost to friction, hills, etc.
+
+        self.command = 0
+        self.rpm = 0.
+        self.revolutions = 0.
+
+    def step(self, dt):
+        """Advances the simulation by dt seconds; returns the new rpm"""
+        free_rpm = self.max_rpm * self.battery * self.command / 100.
+        steady = math.copysign(max(0, abs(free_rpm) - self.load), free_rpm)
+
+        self.rpm += (steady - self.rpm) * (1 - math.exp(-dt / self.time_constant))
+        self.revolutions += abs(self.rpm) * dt / 60.
+        return self.rpm
+
+    @property
+    def count(self):
+        """The pulse counter, as the arduino would report it"""
+        return int(self.revolutions * self.magnets) % WheelSpeed.COUNTER_MODULUS
+
+def simulate(driver_class, speed = 50, duration = 12, frame_interval = .05, **options):
+    """Drives a pair of simulated wheels with a driver; returns (time, left rpm, right rpm) samples
+
+    The right motor is 5% weaker. At a third of the way through a load is
+    added, and at two thirds the battery sags by 15%.
+    """
+    from sensors import SensorReading
+
+    class Clock(object):
+        now = 0.
+
+    class Arduino(object):
+        status = {'estop':False}
+        def send_command(self, command):
+            if command.startswith('V'):
+                right, left = [int(v) for v in command[1:].split(',')]
+                plants[0].command, plants[1].command = left * 100 / 63., right * 100 / 63.
+
+    class Encoder(object):
+        last_reading = None
+
+    class Robot(object):
+        arduino = Arduino()
+        sensors = {'Left encoder':Encoder(), 'Right encoder':Encoder()}
+
+    plants = [MotorPlant(), MotorPlant(max_rpm = 114)]
+
+    args = dict(dp)
+    args.update(cp)
+    args.update(options)
+    driver = driver_class(Robot(), **args)
+    driver.clock = lambda: Clock.now
+    driver.go()
+    driver.set_speed(speed)
+
+    samples = []
+    steps = int(duration / frame_interval)
+    for step in range(steps):
+        Clock.now += frame_interval
+        if step == steps / 3:
+            for plant in plants: plant.load = 15
+        if step == 2 * steps / 3:
+            for plant in plants: plant.battery = .85
+
+        for plant, name in zip(plants, ('Left encoder', 'Right encoder')):
+            plant.step(frame_interval)
+            Robot.sensors[name].last_reading = SensorReading(Clock.now, name, str(plant.count))
+
+        driver.update_speed()
+        samples.append((Clock.now, plants[0].rpm, plants[1].rpm))
+
+    return samples
+
+def main():
+    speed = 50
+    target = speed / 100. * cp['max_rpm']
+    runs = [
+            ('open loop', simulate(SabertoothDriver, speed, left_speed_adjust = 1, right_speed_adjust = 1)),
+            ('closed loop', simulate(ClosedLoopSabertoothDriver, speed)),
+            ]
+
+    print "target %.1f rpm; load added at 4s, battery sags at 8s" % target
+    print "%6s  %23s  %23s" % ('', runs[0][0], runs[1][0])
+    print "%6s  %11s %11s  %11s %11s" % ('time', 'left', 'right', 'left', 'right')
+    for i in range(19, len(runs[0][1]), 20):
+        t = runs[0][1][i][0]
+        print "%5.1fs  %11.1f %11.1f  %11.1f %11.1f" % (
+                (t,) + runs[0][1][i][1:] + runs[1][1][i][1:])
+
+if __name__ == '__main__':
+    main()
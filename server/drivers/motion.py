@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+from math import copysign, sqrt
+
+class MotionProfile(object):
+    """Works out one wheel's speed as a function of elapsed wall-clock time
+
+    Speeds are in the drivers' -100 to 100 units, and the limits are in
+    those units per second (and per second squared for jerk). Speeding up
+    is limited by acceleration; slowing down (including on the way through
+    zero to reverse) by deceleration, or by a braking rate if one is given.
+    Braking is never smoothed by the jerk limit.
+
+    With jerk set to 0 the profile is trapezoidal: the speed ramps at the
+    limit until it reaches the target. Otherwise it is an S-curve: the
+    acceleration itself ramps at the jerk limit, and starts easing off
+    early enough to arrive at the target with no acceleration left.
+    """
+    # a late update doesn't get to jump further than this many seconds
+    MAX_STEP = .5
+
+    def __init__(self, acceleration, deceleration, jerk = 0):
+        self.set_limits(acceleration, deceleration, jerk)
+
+        self.velocity = 0.
+        self.acceleration = 0.
+        self.last_time = None
+
+    def set_limits(self, acceleration, deceleration, jerk = 0):
+        """Changes the limits; takes effect on the next update"""
+        self.max_acceleration = float(acceleration)
+        self.max_deceleration = float(deceleration)
+        self.jerk = float(jerk)
+
+    def ramp_time(self, start, target, step = .05, limit = 60):
+        """Seconds these limits take to get from a steady start speed to target
+
+        Runs a scratch profile updated every step seconds, as a driver
+        would, so S-curves and passing through zero come out as they
+        really happen. Gives up at limit seconds.
+        """
+        profile = MotionProfile(self.max_acceleration, self.max_deceleration, self.jerk)
+        profile.reset(start)
+        profile.update(target, 0)
+
+        elapsed = 0
+        while profile.velocity != target and elapsed < limit:
+            elapsed += step
+            profile.update(target, elapsed)
+        return elapsed
+
+    def reset(self, velocity = 0.):
+        """Jumps straight to velocity, e.g. after the motors were stopped"""
+        self.velocity = float(velocity)
+        self.acceleration = 0.
+
+    def update(self, target, now, braking = None):
+        """Advances the profile to time now; returns the new velocity"""
+        dt = 0 if self.last_time is None else min(now - self.last_time, self.MAX_STEP)
+        self.last_time = now
+        if dt <= 0:
+            return self.velocity
+
+        error = target - self.velocity
+        if error == 0:
+            self.acceleration = 0.
+            return self.velocity
+
+        slowing = self.velocity != 0 and (target * self.velocity < 0 or abs(target) < abs(self.velocity))
+        if slowing:
+            limit = braking if braking else self.max_deceleration
+        else:
+            limit = self.max_acceleration
+
+        if not self.jerk or (slowing and braking):
+            step = min(abs(error), limit * dt)
+            self.velocity += copysign(step, error)
+            self.acceleration = copysign(step / dt, error)
+            return self.velocity
+
+        # the most acceleration we can have and still ease off in time
+        wanted = copysign(min(limit, sqrt(2 * self.jerk * abs(error))), error)
+        change = wanted - self.acceleration
+        self.acceleration += copysign(min(abs(change), self.jerk * dt), change)
+
+        self.velocity += self.acceleration * dt
+        if (target - self.velocity) * error <= 0:
+            # got there (or went past it)
+            self.velocity = float(target)
+            self.acceleration = 0.
+
+        return self.velocity
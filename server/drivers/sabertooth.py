@@ -4,40 +4,89 @@ import common
 from math import copysign
 import time
 
-from parameters import driver as dp
+from motion import MotionProfile
 
 class SabertoothDriver(object):
     """A driver which controls motors via the Sabertooth 2x60 Motor Controller"""
-    def __init__(self, robot,
-            min_speed = 0, max_speed = 100, max_turn_speed = 200, max_acceleration = 100, max_braking = 100,
-            speed_adjust = 1, left_speed_adjust = 1, right_speed_adjust = 1,
-            min_update_interval = 0.1, **rest):
-        self.robot = robot
-
-        # validate and save parameters
-        # these parameters cause new values to be rejected (checked in set_speed)
-        self.max_speed = self.validate_parameter('Maximum speed', max_speed, 1, 100)
-        self.max_turn_speed = self.validate_parameter('Maximum turn speed', max_turn_speed, 1, 200)
+    # the sections of parameters.py (see config.py) this driver is configured from
+    config_sections = ('driver',)
+    # how early, as a fraction of setpoint_interval, an update may come
+    # and still run
+    SETPOINT_TOLERANCE = .2
 
-        # these parameters control the functioning of the driver (checked in update_speed)
-        self.min_speed = self.validate_parameter('Minimum speed', min_speed, 0, 99)
-        self.max_acceleration = self.validate_parameter('Maximum acceleration', max_acceleration, 1, 200)
-        self.max_braking = self.validate_parameter('Maximum braking speed', max_braking, 1, 200)
-        self.speed_adjust = self.validate_parameter('Overall speed adjustment', speed_adjust, 0, 1)
-
-        self.side_adjust = (
-                self.validate_parameter('Left speed adjustment', left_speed_adjust, 0, 1),
-                self.validate_parameter('Right speed adjustment', right_speed_adjust, 0, 1))
+    def __init__(self, robot, **parameters):
+        self.robot = robot
 
-        # controls maximum frequency with which update_speed runs
+        # controls how often update_speed works out new setpoints
         self.last_speed_update = 0  # last time speed was updated
-        self.min_update_interval = min_update_interval
+
+        # where update_speed gets the time from; simulations replace it
+        self.clock = time.time
 
         # controls braking mode
         self.braking_speed = 0
 
+        # fraction of the target speed we may actually go forward at;
+        # lowered by the monitor when something is in the way
+        self.speed_limit = 1.
+
         self.target_speeds = [0, 0] # target speed (set by calls to set_speed)
-        self.last_speeds = [0, 0]   # last speed sent to motor controller (before adjust)
+        self.last_speeds = [0, 0]   # current speed along the profile (before adjust)
+
+        # one profile per wheel works out the speed as time passes
+        self.profiles = [MotionProfile(1, 1) for i in (0, 1)]
+
+        # last (right, left) values sent to the sabertooth; None forces a send
+        self.last_sent = None
+        self.commands_sent = 0
+
+        self.configure(**parameters)
+
+    def check_parameters(self,
+            min_speed = 0, max_speed = 100, max_turn_speed = 200,
+            acceleration = 500, deceleration = 500, jerk = 0, max_braking = 100, brake_rate = 5,
+            speed_adjust = 1, left_speed_adjust = 1, right_speed_adjust = 1,
+            setpoint_interval = 0.05, **rest):
+        """Validates parameters; returns the attributes they set"""
+        return {
+                # these parameters cause new values to be rejected (checked in set_speed)
+                'max_speed':self.validate_parameter('Maximum speed', max_speed, 1, 100),
+                'max_turn_speed':self.validate_parameter('Maximum turn speed', max_turn_speed, 1, 200),
+
+                # these parameters control the functioning of the driver (checked in update_speed)
+                'min_speed':self.validate_parameter('Minimum speed', min_speed, 0, 99),
+                'max_braking':self.validate_parameter('Maximum braking speed', max_braking, 1, 200),
+                'speed_adjust':self.validate_parameter('Overall speed adjustment', speed_adjust, 0, 1),
+
+                # acceleration limits are in speed units per second (per second
+                # squared for jerk); a braking speed of N slows at N * brake_rate
+                'acceleration':self.validate_parameter('Acceleration', acceleration, 1, 1000),
+                'deceleration':self.validate_parameter('Deceleration', deceleration, 1, 1000),
+                'jerk':self.validate_parameter('Jerk', jerk, 0, 10000),
+                'brake_rate':self.validate_parameter('Brake rate', brake_rate, 0.1, 100),
+
+                'side_adjust':(
+                    self.validate_parameter('Left speed adjustment', left_speed_adjust, 0, 1),
+                    self.validate_parameter('Right speed adjustment', right_speed_adjust, 0, 1)),
+
+                'setpoint_interval':self.validate_parameter('Setpoint interval', setpoint_interval, 0, 1),
+                }
+
+    def configure(self, **parameters):
+        """Applies new parameters; if any are invalid, nothing changes"""
+        values = self.check_parameters(**parameters)
+        self.__dict__.update(values)
+
+        for profile in self.profiles:
+            profile.set_limits(self.acceleration, self.deceleration, self.jerk)
+
+    @classmethod
+    def section_parameters(cls, snapshot):
+        """Gathers this driver's parameters from a config snapshot"""
+        parameters = {}
+        for section in cls.config_sections:
+            parameters.update(getattr(snapshot, section).as_dict())
+        return parameters
 
     def validate_parameter(self, name, value, minimum, maximum):
         if value >= minimum and value <= maximum: return value
@@ -55,12 +104,19 @@ class SabertoothDriver(object):
         """Puts the controller into a basic run state"""
         self.brake(self.max_braking)
         self.robot.arduino.send_command('G')
+        self.last_sent = None
 
     def stop(self):
         """Stops the robot"""
         self.robot.arduino.send_command('X')
         self.target_speeds = [0, 0]
 
+        # the arduino cuts the motors on estop, so start from standstill
+        for profile in self.profiles:
+            profile.reset()
+        self.last_speeds = [0, 0]
+        self.last_sent = None
+
     def brake(self, speed):
         """Applies braking to the motors"""
         if speed < 0:
@@ -73,9 +129,6 @@ class SabertoothDriver(object):
 
     def set_speed(self, speed, motor = 'both'):
         """sets the target speed of one or both motors"""
-        if self.robot.arduino.status['estop']:
-            raise common.StoppedError("Cannot change speed while emergency stopped")
-
         old_left, old_right = self.target_speeds
 
         # figure out what new targets will be
@@ -86,66 +139,74 @@ class SabertoothDriver(object):
         elif motor == 'right':
             new_left, new_right = (old_left, speed)
 
+        self.set_speeds(new_left, new_right)
+
+    def set_speeds(self, left, right):
+        """sets the target speeds of both motors at once"""
+        if self.robot.arduino.status['estop']:
+            raise common.StoppedError("Cannot change speed while emergency stopped")
+
         # validate new targets
-        if abs(speed) > self.max_speed:
-            raise common.ParameterError("Speed %d exceeds maximum value of %d" % (speed, copysign(self.max_speed, speed)))
+        for speed in (left, right):
+            if abs(speed) > self.max_speed:
+                raise common.ParameterError("Speed %d exceeds maximum value of %d" % (speed, copysign(self.max_speed, speed)))
 
-        if abs(new_left - new_right) > self.max_turn_speed:
-            raise common.ParameterError("New targets (%d,%d) exceed maximum turn velocity of %d" % (new_left, new_right, self.max_turn_speed))
+        if abs(left - right) > self.max_turn_speed:
+            raise common.ParameterError("New targets (%d,%d) exceed maximum turn velocity of %d" % (left, right, self.max_turn_speed))
 
         # we're good -- update the speed
         self.braking_speed = 0
-        self.target_speeds = [new_left, new_right]
+        self.target_speeds = [left, right]
 
     def update_speed(self):
-        """Updates the current speed to match target speed (in accordance with parameters)"""
-        # if it's too soon since we last ran, exit
-        if (time.time() - self.last_speed_update) < self.min_update_interval:
-            return False
+        """Moves the current speed along the motion profile towards the target speed"""
+        now = self.clock()
 
-        # if we have nothing to do, we're done
-        if self.target_speeds == self.last_speeds:
-            return True
+        # if it's too soon since we last ran, exit; the monitor calls at the
+        # same interval, so a call that's only a little early still counts
+        if (now - self.last_speed_update) < self.setpoint_interval * (1 - self.SETPOINT_TOLERANCE):
+            return False
 
-        # make a copy of the target spees to avoid race conditions
+        # make a copy of the target speeds to avoid race conditions
         target_speeds = list(self.target_speeds)
 
-        # figure out what we're going to send this time around
-        to_send = list(target_speeds)
+        # scale both wheels alike so we keep turning the same way
+        if self.speed_limit < 1 and sum(target_speeds) > 0:
+            target_speeds = [s * self.speed_limit for s in target_speeds]
+
+        # if we're actively braking, slow down at the braking rate
+        braking = self.braking_speed * self.brake_rate if self.braking_speed else None
+
+        to_send = [0, 0]
         for i in (0, 1):
-            # what is our maximum acceleration speed?
-            # if we're actively braking, we can change at up to brake speed
-            # never use braking to accelerate though; in that case, use
-            # normal acceleration model
-            if self.braking_speed and abs(target_speeds[i]) < abs(self.last_speeds[i]):
-                max_diff = self.braking_speed
-            # otherwise we're accelerating/decellerating normally
-            else:
-                max_diff = self.max_acceleration
-
-            # avoid accelerating more than the max acceleration
-            diff = target_speeds[i] - self.last_speeds[i]
-            if abs(diff) > max_diff:
-                diff = copysign(max_diff, diff)
-
-            # figure out new speed to send
-            self.last_speeds[i] = self.last_speeds[i] + diff
-
-            # send adjusted parameters
-            to_send[i] = self.last_speeds[i] * self.side_adjust[i] * self.speed_adjust
+            profile = self.profiles[i]
+
+            # too slow to bother with; snap to target
+            if abs(target_speeds[i]) < self.min_speed and abs(profile.velocity) < self.min_speed:
+                profile.reset(target_speeds[i])
 
-        # if our speed is too slow, send 0 but claim target has been reached
-        for i in (0,1):
+            self.last_speeds[i] = profile.update(target_speeds[i], now, braking)
+
+            # send adjusted speeds, but nothing the motors are too slow to turn at
+            to_send[i] = self.last_speeds[i] * self.side_adjust[i] * self.speed_adjust
             if abs(to_send[i]) < self.min_speed:
-                self.last_speeds[i] = target_speeds[i]
                 to_send[i] = 0
 
+        self.last_speed_update = now
+        self._send_speeds(to_send)
+        return True
+
+    def _send_speeds(self, speeds):
+        """Sends (left, right) speeds, but only if the sabertooth would see a change"""
         # sabertooth takes right,left instead of left-right like everything else here
-        self.robot.arduino.send_command('V%d,%d' % (
-            self._convert_speed(to_send[1]),
-            self._convert_speed(to_send[0])))
+        values = (self._convert_speed(speeds[1]), self._convert_speed(speeds[0]))
+        if values == self.last_sent:
+            return False
 
-        self.last_speed_update = time.time()
+        self.robot.arduino.send_command('V%d,%d' % values)
+        self.last_sent = values
+        self.commands_sent += 1
+        return True
 
     @property
     def status(self):
@@ -156,9 +217,14 @@ class SabertoothDriver(object):
                 'last right':self.last_speeds[1],
                 'last speed update':self.last_speed_update,
                 'braking speed':self.braking_speed,
+                'speed limit':self.speed_limit,
+                'speed commands':self.commands_sent,
+                'max speed':self.max_speed,
+                'max turn speed':self.max_turn_speed,
+                'max braking':self.max_braking,
                 }
 
-def get_driver(robot, **rest):
-    args = dict(dp)
+def get_driver(robot, snapshot, **rest):
+    args = SabertoothDriver.section_parameters(snapshot)
     args['robot'] = robot
     return SabertoothDriver(**args)
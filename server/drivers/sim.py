@@ -0,0 +1,393 @@
+#!/usr/bin/python
+"""A driver for running the whole server without a robot
+
+The sim driver talks the sabertooth driver's protocol to a SimArduino,
+which behaves like the on-board controller (see controller/controller.cpp):
+it starts estopped, interprets G, X, H and V commands, estops after a
+second without a command, and sends a state frame every 50ms with
+encoder, sonar, battery voltage and driver temperature readings.
+
+The readings come from a World: two motors (see closedloop.MotorPlant)
+turning the wheels of a steering.Cart in a walled arena, with a battery
+that drains and sags under load and a driver that heats up.
+
+With a time scale above 1 the world runs that many times faster than
+the wall clock, so hours of battery drain and heating go by in minutes.
+The server's clock doesn't speed up with it, so rates it measures (the
+encoder rpm, say) are scaled up too; use it for soak and throughput
+testing, not for tuning.
+"""
+
+import copy
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+from sabertooth import SabertoothDriver
+from closedloop import MotorPlant
+
+from arduino import ArduinoMonitor, State
+from sensors import SensorReading
+
+from parameters import sim as simp
+
+# the cart kinematics live with the pygame simulator
+SIM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'sim')
+if SIM_DIR not in sys.path:
+    sys.path.append(SIM_DIR)
+import steering
+
+class SimCart(steering.Cart):
+    """A steering.Cart that moves by actual wheel rpm over any timestep"""
+    def __init__(self, x, y, width, length, wheel_radius):
+        steering.Cart.__init__(self, x, y, width, length)
+        self.wheel_radius = wheel_radius
+        self.yaw_rate = 0.
+
+    def step(self, left_rpm, right_rpm, dt):
+        self.left_rpm = left_rpm
+        self.right_rpm = right_rpm
+
+        inches_per_rpm = 2 * math.pi * self.wheel_radius / 60.
+        left, right = left_rpm * inches_per_rpm, right_rpm * inches_per_rpm
+
+        self.yaw_rate = (right - left) / self.width
+        self.theta += self.yaw_rate * dt
+
+        v = (left + right) / 2
+        self.left_x += v * math.sin(self.theta) * dt
+        self.left_y += -v * math.cos(self.theta) * dt
+
+    @property
+    def heading(self):
+        """The direction the cart is facing, as a unit vector"""
+        return (math.sin(self.theta), -math.cos(self.theta))
+
+class World(object):
+    """The simulated robot and its surroundings"""
+    # range of the LV-MaxSonar EZ1, in inches
+    SONAR_MIN = 6
+    SONAR_MAX = 254
+
+    def __init__(self,
+            wheel_radius = 8, track_width = 30, length = 60, magnets = 2,
+            max_rpm = 120, motor_time_constant = .3, right_motor_strength = .95, load = 0,
+            arena_width = 480, arena_length = 720,
+            battery_volts = 25.6, empty_volts = 23, capacity_ah = 35, resistance = .05,
+            idle_current = 1, max_current = 60,
+            ambient_temperature = 25, heating = .5, thermal_time_constant = 300, **rest):
+        self.magnets = magnets
+        self.plants = [
+                MotorPlant(max_rpm, motor_time_constant, magnets, load = load),
+                MotorPlant(max_rpm * right_motor_strength, motor_time_constant, magnets, load = load)]
+
+        self.arena = (float(arena_width), float(arena_length))
+        self.cart = SimCart(arena_width / 2., arena_length / 2., track_width, length, wheel_radius)
+        self.bumps = 0
+
+        self.battery_volts = self.full_volts = float(battery_volts)
+        self.empty_volts = empty_volts
+        self.capacity_ah = capacity_ah
+        self.charge_ah = float(capacity_ah)
+        self.resistance = resistance
+        self.idle_current = idle_current
+        self.max_current = max_current
+
+        self.temperature = self.ambient_temperature = float(ambient_temperature)
+        self.heating = heating
+        self.thermal_time_constant = thermal_time_constant
+
+        self.time = 0.
+
+    def step(self, left, right, dt):
+        """Runs the motors at (left, right) driver speeds for dt seconds"""
+        self.time += dt
+
+        current = self.idle_current
+        for plant, command in zip(self.plants, (left, right)):
+            plant.command = command
+            plant.battery = self.battery_volts / self.full_volts
+            plant.step(dt)
+            current += self.max_current * abs(command) / 200.
+
+        old_position = (self.cart.left_x, self.cart.left_y, self.cart.theta)
+        self.cart.step(self.plants[0].rpm, self.plants[1].rpm, dt)
+        if not self._inside(self.cart.left_x, self.cart.left_y):
+            # ran into a wall; the wheels spin but the cart stays put
+            self.cart.left_x, self.cart.left_y, self.cart.theta = old_position
+            self.bumps += 1
+
+        self.charge_ah = max(0, self.charge_ah - current * dt / 3600.)
+        open_volts = self.empty_volts + (self.full_volts - self.empty_volts) * self.charge_ah / self.capacity_ah
+        self.battery_volts = open_volts - self.resistance * current
+
+        settled = self.ambient_temperature + self.heating * current
+        self.temperature += (settled - self.temperature) * (1 - math.exp(-dt / self.thermal_time_constant))
+
+    def _inside(self, x, y):
+        return 0 <= x <= self.arena[0] and 0 <= y <= self.arena[1]
+
+    def _range(self, x, y, dx, dy):
+        """Distance from (x, y) along (dx, dy) to the nearest wall"""
+        distances = []
+        for position, direction, size in ((x, dx, self.arena[0]), (y, dy, self.arena[1])):
+            if direction > 0:
+                distances.append((size - position) / direction)
+            elif direction < 0:
+                distances.append(-position / direction)
+        return min(distances)
+
+    def sonar(self, side):
+        """What the left (-1) or right (1) sonar sees, from the front corners"""
+        dx, dy = self.cart.heading
+        offset = side * self.cart.width / 2.
+        x, y = self.cart.left_x - dy * offset, self.cart.left_y + dx * offset
+        if not self._inside(x, y):
+            return self.SONAR_MIN
+
+        distance = self._range(x, y, dx, dy)
+        return int(max(self.SONAR_MIN, min(self.SONAR_MAX, distance)))
+
+    def pulses(self, wheel):
+        return int(self.plants[wheel].revolutions * self.magnets)
+
+    @property
+    def status(self):
+        return {
+                'time':round(self.time, 1),
+                'x':round(self.cart.left_x, 1),
+                'y':round(self.cart.left_y, 1),
+                'heading':round(math.degrees(self.cart.theta), 1),
+                'battery':round(self.battery_volts, 2),
+                'temperature':round(self.temperature, 1),
+                'bumps':self.bumps,
+                }
+
+class SimArduino(object):
+    """Stands in for the on-board arduino, running the firmware against a World"""
+    # the controller's StateSendMS and EmergencyBrakeMS
+    FRAME_SECS = .05
+    ESTOP_SECS = 1.
+
+    # how stale does the state get until we are considered no longer healthy?
+    HEALTH_TIMEOUT = 2
+
+    # voltage divider on the battery sensor, and the ADC's range
+    BATTERY_RATIO = 11.
+    ADC_VOLTS = 5.
+    ADC_MAX = 1023
+
+    def __init__(self, world, time_scale = 1):
+        self.world = world
+        self.time_scale = float(time_scale)
+
+        self.state = None
+        self.sensor_readings = {}
+        self.commands_sent = 0
+
+        # what the firmware keeps track of
+        self.emergency_stop = True
+        self.velocities = (0, 0)    # as sent: right, left
+        self.commands_received = 0
+        self.bad_commands_received = 0
+        self.last_command = time.time()
+
+        # pulse counters start at 0 when the arduino does
+        self.pulse_base = (world.pulses(0), world.pulses(1))
+
+        self.frames = 0
+        self.late_frames = 0
+
+        self.lock = threading.Lock()
+        self._frame = threading.Event()
+        self._stop = threading.Event()
+        self.runner = threading.Thread(target = self._run, name = 'sim world')
+        self.runner.daemon = True
+
+        # the same monitor as the real arduino sends the heartbeats
+        self.monitor = ArduinoMonitor(self)
+
+    def is_healthy(self):
+        """Returns True if our link with the Arduino is healthy."""
+        if not self.state:
+            return False
+        return (time.time() - self.state.timestamp < self.HEALTH_TIMEOUT)
+
+    def start_monitor(self):
+        if not self.runner.is_alive():
+            self.runner.start()
+        if not self.monitor.is_alive():
+            self.monitor.start()
+
+    def stop(self):
+        self.stop_monitor()
+        for thread in (self.monitor, self.runner):
+            if thread.is_alive():
+                thread.join(timeout = 5)
+        self.close()
+
+    def stop_monitor(self):
+        self.monitor.stop()
+        self._stop.set()
+
+    def monitor_stopped(self):
+        return not (self.monitor.is_alive() or self.runner.is_alive())
+
+    def close(self):
+        """There is no port to close"""
+        pass
+
+    @property
+    def status(self):
+        """Returns a dictionary of the arduino's status for the client"""
+        return {
+                'healthy':self.is_healthy(),
+                'estop':(not self.state or self.state.emergency_stop),
+                'sent':self.commands_sent,
+                'recieved':self.state.commands_received if self.state else 0,
+                'bad':self.state.bad_commands_received if self.state else 0,
+                'simulated':True,
+                'time scale':self.time_scale,
+                'late frames':self.late_frames,
+                }
+
+    def send_command(self, command):
+        """Interprets a command the way the controller firmware does"""
+        command = command.strip()
+        with self.lock:
+            self.commands_sent += 1
+
+            kind = command[:1]
+            if kind == 'V':
+                try:
+                    velocities = tuple(int(v) for v in command[1:].split(','))
+                    if len(velocities) != 2:
+                        raise ValueError(command)
+                except ValueError:
+                    kind = None
+                else:
+                    self.velocities = tuple(max(-63, min(63, v)) for v in velocities)
+
+            if kind not in ('H', 'G', 'S', 'X', 'V'):
+                self.bad_commands_received += 1
+                return True
+
+            self.last_command = time.time()
+            self.commands_received += 1
+            if kind == 'G':
+                self.emergency_stop = False
+            elif kind == 'X':
+                self._estop()
+
+        return True
+
+    def _estop(self):
+        self.emergency_stop = True
+        self.velocities = (0, 0)
+
+    def _run(self):
+        """Steps the world a frame at a time, time_scale times faster than real time"""
+        interval = self.FRAME_SECS / self.time_scale
+        next_frame = time.time()
+        while not self._stop.isSet():
+            self.step()
+
+            next_frame += interval
+            delay = next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.FRAME_SECS:
+                # can't keep up; don't try to catch up all at once
+                self.late_frames += 1
+                next_frame = time.time()
+
+    def step(self):
+        """Runs the world for one frame and sends the state frame"""
+        with self.lock:
+            now = time.time()
+            if now - self.last_command > self.ESTOP_SECS and not self.emergency_stop:
+                self._estop()
+
+            # the sabertooth driver sends right,left
+            right, left = self.velocities
+            self.world.step(left * 100 / 63., right * 100 / 63., self.FRAME_SECS)
+
+            self.state = State(
+                    timestamp = now,
+                    commands_sent = self.commands_sent,
+                    commands_received = self.commands_received,
+                    bad_commands_received = self.bad_commands_received,
+                    ms_since_command_received = int((now - self.last_command) * 1000),
+                    emergency_stop = self.emergency_stop,
+                    velocity = self.velocities)
+
+            world = self.world
+            volts_to_adc = self.ADC_MAX / self.ADC_VOLTS
+            data = {
+                    'LE':self._counter(world.pulses(0) - self.pulse_base[0]),
+                    'RE':self._counter(world.pulses(1) - self.pulse_base[1]),
+                    'LS':world.sonar(-1),
+                    'RS':world.sonar(1),
+                    'BV':int(world.battery_volts / self.BATTERY_RATIO * volts_to_adc),
+                    'DT':int((world.temperature * 10 + 500) / 1000. * volts_to_adc),
+                    }
+            for name, value in data.items():
+                self.sensor_readings[name] = SensorReading(now, name, str(value))
+
+            self.frames += 1
+
+        self._frame.set()
+
+    def _counter(self, pulses):
+        """The firmware counts pulses in a 16-bit signed int"""
+        return (pulses + 32768) % 65536 - 32768
+
+    def update_state(self, timeout = 0):
+        """Waits for the next state frame; returns True if one arrived"""
+        if not self._frame.wait(timeout):
+            return False
+        self._frame.clear()
+        return True
+
+    def get_state(self):
+        """Returns a copy of the current state."""
+        return copy.deepcopy(self.state)
+
+    def get_sensor_reading(self, sensor_name):
+        """Gets the raw data for a particular sensor"""
+        try:
+            reading = self.sensor_readings[sensor_name]
+        except KeyError:
+            return None
+        else:
+            return copy.deepcopy(reading)
+
+class SimDriver(SabertoothDriver):
+    """The sabertooth driver, driving a simulated robot"""
+    def __init__(self, robot, time_scale = 1, world = simp, **rest):
+        SabertoothDriver.__init__(self, robot, **rest)
+
+        # the world outlives any one arduino, like the real robot does
+        self.world = World(**world)
+        self.time_scale = time_scale
+
+    def find_arduino(self, serial, reset_board = True):
+        """Used by the robot's resetter instead of looking for a real arduino"""
+        return SimArduino(self.world, self.time_scale)
+
+    @property
+    def status(self):
+        status = SabertoothDriver.status.fget(self)
+        for key, value in self.world.status.items():
+            status['sim %s' % key] = value
+        return status
+
+def get_driver(robot, snapshot, sim_time_scale = None, **rest):
+    args = SimDriver.section_parameters(snapshot)
+    args['robot'] = robot
+    args['world'] = snapshot.sim.as_dict()
+    args['time_scale'] = sim_time_scale or snapshot.sim.time_scale
+    return SimDriver(**args)
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+"""Drives a pair of Pololu Simple Motor Controllers over their USB serial ports
+
+Each SMC shows up as a virtual serial port, and accepts the compact
+binary serial protocol described in the SMC user's guide
+(http://www.pololu.com/docs/0J44): a command byte followed by data
+bytes with the high bit clear. One port is kept open per controller for
+as long as it works, and everything sent in one update goes out in a
+single write.
+
+Status variables are requested along with the speed commands and their
+replies picked up on a later update, so nothing here waits on the
+controllers. The requests also keep the controllers' command timeout
+from expiring while the speed isn't changing.
+"""
+
+import glob
+import logging
+import os
+import select
+import threading
+import time
+
+import serial
+
+import common
+from sabertooth import SabertoothDriver
+
+# compact protocol commands
+EXIT_SAFE_START = 0x83
+MOTOR_FORWARD = 0x85
+MOTOR_REVERSE = 0x86
+MOTOR_BRAKE = 0x92
+GET_VARIABLE = 0xA1
+STOP_MOTOR = 0xE0
+
+# variable ids for GET_VARIABLE
+ERROR_STATUS = 0
+TARGET_SPEED = 20
+SPEED = 21
+INPUT_VOLTAGE = 23
+TEMPERATURE = 24
+
+# bits of ERROR_STATUS
+SAFE_START_ERROR = 1 << 0
+COMMAND_TIMEOUT_ERROR = 1 << 3
+
+# full speed on the controller
+MAX_SMC_SPEED = 3200
+
+STATUS_VARIABLES = (ERROR_STATUS, SPEED, INPUT_VOLTAGE, TEMPERATURE)
+
+def speed_command(speed):
+    """The bytes that set an SMC to a speed from -3200 to 3200"""
+    command = MOTOR_FORWARD if speed >= 0 else MOTOR_REVERSE
+    speed = min(abs(int(speed)), MAX_SMC_SPEED)
+    return chr(command) + chr(speed & 0x1f) + chr(speed >> 5)
+
+def find_port(serial_number, pattern = '/dev/serial/by-id/*Simple_Motor_Controller*'):
+    """Finds the serial port of the SMC with the given serial number"""
+    wanted = serial_number.replace('-', '').lower()
+    for path in glob.glob(pattern):
+        if wanted in os.path.basename(path).replace('-', '').lower():
+            return os.path.realpath(path)
+
+    raise common.ControllerError("No simple motor controller with serial number %s found" % serial_number)
+
+class SmcConnection(object):
+    """The persistent serial connection to one SMC"""
+    # give up on replies that haven't arrived after this many seconds
+    REPLY_TIMEOUT = 1
+    def __init__(self, name, port, reconnect_interval = 1):
+        self.name = name
+        self.port = port
+        self.reconnect_interval = reconnect_interval
+
+        self.serial = None
+        self.last_attempt = 0
+        self.log_failure = True
+
+        # variables we've asked for and not yet got, in order
+        self.pending = []
+        self.buffer = ''
+
+        # the speed we last sent; None makes the next update send it again
+        self.last_speed = None
+        self.exit_safe_start = False
+
+        # set when a status reply shows the controller in safe-start
+        self.in_safe_start = False
+
+        self.variables = {}
+        self.last_request = None
+        self.last_reply = None
+        self.missed_replies = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.failures = 0
+
+    @property
+    def connected(self):
+        return self.serial is not None
+
+    def connect(self):
+        """Opens the port if it isn't open, at most once per reconnect interval"""
+        if self.serial is not None:
+            return True
+
+        now = time.time()
+        if now - self.last_attempt < self.reconnect_interval:
+            return False
+        self.last_attempt = now
+
+        try:
+            port = self.port() if callable(self.port) else self.port
+            self.serial = serial.Serial(port = port, baudrate = 115200, timeout = 0, writeTimeout = .1)
+        except (serial.SerialException, common.ControllerError, OSError), e:
+            self.failures += 1
+            if self.log_failure:
+                logging.error("cannot open %s motor controller: %s" % (self.name, e))
+                self.log_failure = False
+            return False
+
+        logging.info("opened %s motor controller on %s" % (self.name, self.serial.port))
+        self.log_failure = True
+        self.pending = []
+        self.buffer = ''
+        self.last_speed = None
+
+        # a replugged controller starts up in safe-start
+        self.exit_safe_start = True
+        return True
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception:
+                pass
+        self.serial = None
+
+    def _failed(self, e):
+        self.failures += 1
+        logging.error("lost %s motor controller: %s" % (self.name, e))
+        self.close()
+
+    def write(self, data, variables = ()):
+        """Sends data in one write, followed by requests for variables; returns True if it went out"""
+        if not self.connect():
+            return False
+
+        data += ''.join(chr(GET_VARIABLE) + chr(variable) for variable in variables)
+        try:
+            self.serial.write(data)
+        except (serial.SerialException, OSError), e:
+            self._failed(e)
+            return False
+
+        if variables:
+            self.pending.extend(variables)
+            self.last_request = time.time()
+        self.writes += 1
+        self.bytes_written += len(data)
+        return True
+
+    def read(self):
+        """Picks up whatever replies have arrived, without waiting"""
+        if self.serial is None or not self.pending:
+            return
+
+        try:
+            waiting = self.serial.inWaiting()
+            if waiting:
+                self.buffer += self.serial.read(waiting)
+        except (serial.SerialException, OSError), e:
+            self._failed(e)
+            return
+
+        while len(self.buffer) >= 2 and self.pending:
+            low, high = ord(self.buffer[0]), ord(self.buffer[1])
+            self.buffer = self.buffer[2:]
+
+            value = low + (high << 8)
+            variable = self.pending.pop(0)
+            if variable in (TARGET_SPEED, SPEED) and value >= 0x8000:
+                value -= 0x10000
+            self.variables[variable] = value
+            self.last_reply = time.time()
+            if variable == ERROR_STATUS and value & SAFE_START_ERROR:
+                self.in_safe_start = True
+
+        # a lost reply would otherwise hold up every later one
+        if self.pending and time.time() - self.last_request > self.REPLY_TIMEOUT:
+            self.missed_replies += len(self.pending)
+            self.pending = []
+            self.buffer = ''
+
+    @property
+    def status(self):
+        variables = self.variables
+        return {
+                'connected':self.connected,
+                'errors':variables.get(ERROR_STATUS),
+                'speed':variables.get(SPEED),
+                'voltage':variables.get(INPUT_VOLTAGE, 0) / 1000. if INPUT_VOLTAGE in variables else None,
+                'temperature':variables.get(TEMPERATURE, 0) / 10. if TEMPERATURE in variables else None,
+                'writes':self.writes,
+                'failures':self.failures,
+                'missed replies':self.missed_replies,
+                }
+
+class SmcDriver(SabertoothDriver):
+    """Drives the wheels with two Pololu Simple Motor Controllers
+
+    Speeds are worked out exactly like the sabertooth driver does; only
+    the way they are sent differs. The arduino still provides the sensors
+    and the emergency stop state, which the controllers follow.
+
+    A controller that was reopened, or that latched an error (a command
+    timeout, low input voltage), sits in safe-start and ignores speeds.
+    Unless the arduino is estopped, the driver takes it out again as soon
+    as it reconnects or its status shows safe-start.
+    """
+    config_sections = ('driver', 'smc')
+
+    def __init__(self, robot, left_port, right_port, **parameters):
+        self.controllers = (
+                SmcConnection('left', left_port),
+                SmcConnection('right', right_port))
+        self.last_status_request = 0
+
+        SabertoothDriver.__init__(self, robot, **parameters)
+
+    def check_parameters(self, status_interval = .25, reconnect_interval = 1, **rest):
+        values = SabertoothDriver.check_parameters(self, **rest)
+        values.update({
+                # how often to read back the controllers' status
+                'status_interval':self.validate_parameter('Status interval', status_interval, 0, 60),
+                'reconnect_interval':self.validate_parameter('Reconnect interval', reconnect_interval, 0, 60),
+                })
+        return values
+
+    def configure(self, **parameters):
+        SabertoothDriver.configure(self, **parameters)
+        for controller in self.controllers:
+            controller.reconnect_interval = self.reconnect_interval
+
+    def go(self):
+        SabertoothDriver.go(self)
+
+        # safe-start must be exited before the motors will move
+        for controller in self.controllers:
+            controller.exit_safe_start = True
+
+    def stop(self):
+        SabertoothDriver.stop(self)
+        for controller in self.controllers:
+            controller.write(chr(STOP_MOTOR))
+            controller.exit_safe_start = False
+            controller.last_speed = None
+
+    def _convert_speed(self, speed):
+        """We want to specify speeds from 0 to 100, but the SMC uses 0 to 3200"""
+        if speed > 100 or speed < -100:
+            raise common.DriverError("Speed outside the allowed range")
+
+        return int(speed * MAX_SMC_SPEED / 100)
+
+    def update_speed(self):
+        for controller in self.controllers:
+            controller.read()
+
+        return SabertoothDriver.update_speed(self)
+
+    def _send_speeds(self, speeds):
+        """Sends each controller its speed, plus any status requests, in one write"""
+        estopped = self.robot.arduino.status['estop']
+        if estopped:
+            speeds = (0, 0)
+
+        now = time.time()
+        request_status = now - self.last_status_request >= self.status_interval
+        if request_status:
+            self.last_status_request = now
+
+        changed = False
+        for controller, speed in zip(self.controllers, speeds):
+            value = self._convert_speed(speed)
+
+            if controller.in_safe_start and not estopped:
+                controller.exit_safe_start = True
+            controller.in_safe_start = False
+
+            # leave safe-start alone while estopped; go() exits it. Speeds
+            # sent in safe-start were ignored, so send ours again after
+            exiting = controller.exit_safe_start and not estopped
+            data = chr(EXIT_SAFE_START) if exiting else ''
+            if exiting or value != controller.last_speed:
+                data += speed_command(value)
+
+            # don't pile up requests behind a controller that isn't answering
+            variables = STATUS_VARIABLES if request_status and not controller.pending else ()
+            if not (data or variables):
+                continue
+
+            if controller.write(data, variables) and data:
+                if exiting:
+                    controller.exit_safe_start = False
+                controller.last_speed = value
+                changed = True
+
+        if changed:
+            self.commands_sent += 1
+        return changed
+
+    def close(self):
+        for controller in self.controllers:
+            controller.close()
+
+    @property
+    def status(self):
+        status = SabertoothDriver.status.fget(self)
+        for controller in self.controllers:
+            for key, value in controller.status.items():
+                status['%s smc %s' % (controller.name, key)] = value
+        return status
+
+def get_driver(robot, snapshot, left = None, right = None, **rest):
+    args = SmcDriver.section_parameters(snapshot)
+    args['robot'] = robot
+
+    # look the ports up each time we (re)connect; they move when replugged
+    args['left_port'] = lambda: find_port(left)
+    args['right_port'] = lambda: find_port(right)
+    return SmcDriver(**args)
+
+class FakeSmc(object):
+    """A stand-in SMC on a pseudo-terminal, for trying the driver without hardware
+
+    Understands the same compact protocol subset the driver uses. Pass
+    port to the driver (or open it) like a real controller's port.
+    """
+    def __init__(self, voltage = 12000, temperature = 250, acceleration = 6400):
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+
+        # keep the slave open so the pty survives the driver reconnecting
+        self._slave = slave
+
+        self.voltage = voltage
+        self.temperature = temperature
+        self.acceleration = acceleration    # speed units per second
+
+        self.errors = SAFE_START_ERROR
+        self.target_speed = 0
+        self.speed = 0.
+        self.commands = 0
+        self.bad_commands = 0
+
+        self._buffer = ''
+        self._stop = threading.Event()
+        self._last_step = time.time()
+        self.thread = threading.Thread(target = self._run, name = 'fake smc %s' % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self._stop.set()
+        self.thread.join(1)
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _run(self):
+        while not self._stop.isSet():
+            ready = select.select([self.master], [], [], .01)[0]
+            if ready:
+                try:
+                    self._buffer += os.read(self.master, 256)
+                except OSError:
+                    break
+                self._process()
+            self._step()
+
+    def _step(self):
+        now = time.time()
+        dt, self._last_step = now - self._last_step, now
+
+        target = 0 if self.errors else self.target_speed
+        change = self.acceleration * dt
+        if abs(target - self.speed) <= change:
+            self.speed = float(target)
+        else:
+            self.speed += change if target > self.speed else -change
+
+    def _process(self):
+        lengths = {EXIT_SAFE_START:0, STOP_MOTOR:0, MOTOR_FORWARD:2, MOTOR_REVERSE:2,
+                MOTOR_BRAKE:1, GET_VARIABLE:1}
+        while self._buffer:
+            command = ord(self._buffer[0])
+            if command not in lengths:
+                self.bad_commands += 1
+                self._buffer = self._buffer[1:]
+                continue
+
+            if len(self._buffer) < 1 + lengths[command]:
+                return
+            data = [ord(c) for c in self._buffer[1:1 + lengths[command]]]
+            self._buffer = self._buffer[1 + lengths[command]:]
+            self.commands += 1
+
+            if command == EXIT_SAFE_START:
+                self.errors &= ~SAFE_START_ERROR
+            elif command == STOP_MOTOR:
+                self.target_speed = 0
+                self.errors |= SAFE_START_ERROR
+            elif command in (MOTOR_FORWARD, MOTOR_REVERSE):
+                speed = data[0] + (data[1] << 5)
+                self.target_speed = speed if command == MOTOR_FORWARD else -speed
+            elif command == MOTOR_BRAKE:
+                self.target_speed = 0
+            elif command == GET_VARIABLE:
+                value = {
+                        ERROR_STATUS:self.errors,
+                        TARGET_SPEED:self.target_speed,
+                        SPEED:int(self.speed),
+                        INPUT_VOLTAGE:self.voltage,
+                        TEMPERATURE:self.temperature,
+                        }.get(data[0], 0) & 0xffff
+                os.write(self.master, chr(value & 0xff) + chr(value >> 8))
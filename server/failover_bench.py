@@ -0,0 +1,196 @@
+#!/usr/bin/python
+"""Measures how long a standby server takes to take over from a dead primary
+
+Starts a primary and a standby server on a spare port, drives the robot
+through the primary, kills it with SIGKILL, and times how long it takes
+until the standby sends the motors their speed again. Each round the
+survivor becomes the primary and a fresh standby is started behind it.
+
+The servers get their own lock, state file and heartbeat socket (through
+a parameters file that overrides just those), so a real server can keep
+running alongside. They use the sim driver unless told otherwise.
+
+Takeover has to be well under the arduino's 1 second estop timeout for
+the robot to keep moving through a failover.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+from config import DEFAULT_PATH
+
+# the controller estops if it hears nothing for this long
+ARDUINO_ESTOP_SECS = 1.0
+
+# a parameters file that only moves the servers' shared files
+BENCH_PARAMETERS = """execfile(%(defaults)r)
+standby['lock_path'] = %(lock)r
+standby['state_path'] = %(state)r
+monitor['heartbeat_socket'] = %(heartbeat)r
+"""
+
+def write_parameters(directory):
+    """Writes the benchmark's parameters file and returns its path"""
+    path = os.path.join(directory, 'parameters.py')
+    fhandle = open(path, 'w')
+    try:
+        fhandle.write(BENCH_PARAMETERS % {
+                'defaults':DEFAULT_PATH,
+                'lock':os.path.join(directory, 'server.lock'),
+                'state':os.path.join(directory, 'server.state'),
+                'heartbeat':os.path.join(directory, 'heartbeat.sock'),
+                })
+    finally:
+        fhandle.close()
+    return path
+
+def start_server(port, is_standby, log, parameters, driver):
+    """Starts a server process in the background"""
+    args = [sys.executable, 'server.py', '--port', str(port), '--config', parameters, '--driver', driver]
+    if is_standby:
+        args.append('--standby')
+
+    return subprocess.Popen(args, cwd = os.path.dirname(os.path.abspath(__file__)),
+            stdout = log, stderr = subprocess.STDOUT)
+
+class Connection(object):
+    """A bare connection to a server"""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('localhost', port), 1)
+        self.response = self.sock.makefile('r')
+
+    def send(self, command):
+        """Sends a command; returns (result, output)"""
+        self.sock.sendall('%s\n' % command)
+        length = self.response.readline().strip()
+        if not length.isdigit():
+            raise socket.error("connection closed")
+        return pickle.loads(self.response.read(int(length)))
+
+    def close(self):
+        self.sock.close()
+
+def drive(port, speed):
+    """Takes control of the server on port and drives at speed; returns the connection"""
+    connection = Connection(port)
+    for command in ('control', 'go'):
+        result, output = connection.send(command)
+        if result != 'ok':
+            raise RuntimeError("'%s' failed: %s" % (command, output))
+
+    # the estop only clears with the arduino's next state frame
+    if wait_for(lambda: not connection.send('status')[1]['arduino']['estop'], 1, .01) is None:
+        raise RuntimeError("'go' never cleared the estop")
+
+    result, output = connection.send('speeds %d %d' % (speed, speed))
+    if result != 'ok':
+        raise RuntimeError("'speeds' failed: %s" % output)
+    return connection
+
+def answers(port):
+    """Returns True if a server is listening on port"""
+    try:
+        Connection(port).close()
+        return True
+    except socket.error:
+        return False
+
+def sending_speeds(port, speed):
+    """Returns True once the server on port has sent the motors speed again"""
+    try:
+        connection = Connection(port)
+    except socket.error:
+        return False
+
+    try:
+        result, status = connection.send('status')
+        driver = status['driver']
+        return (driver['speed commands'] > 0 and driver['target left'] == speed
+                and not status['arduino']['estop'])
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+
+def wait_for(test, timeout, interval = .001):
+    """Waits for test() to return True; returns how long it took, or None on timeout"""
+    start = time.time()
+    while time.time() - start < timeout:
+        if test():
+            return time.time() - start
+        time.sleep(interval)
+    return None
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-p', '--port', action="store", type="int", dest="port", default=9998,
+            help="Port for the benchmark servers [Default: 9998]")
+    parser.add_option('-n', '--rounds', action="store", type="int", dest="rounds", default=5,
+            help="Number of failovers to time [Default: 5]")
+    parser.add_option('-w', '--warmup', action="store", type="float", dest="warmup", default=3,
+            help="Seconds to let each new standby initialize [Default: 3]")
+    parser.add_option('-d', '--driver', action="store", type="string", dest="driver", default='sim',
+            help="Driver the servers use [Default: sim]")
+    parser.add_option('-s', '--speed', action="store", type="int", dest="speed", default=30,
+            help="Speed to drive at through the failovers [Default: 30]")
+    parser.add_option('-l', '--log', action="store", type="string", dest="log", default='/tmp/failover-bench.log',
+            help="Where the servers' output goes [Default: /tmp/failover-bench.log]")
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix = 'failover-bench-')
+    parameters = write_parameters(directory)
+
+    log = open(options.log, 'a')
+    primary = start_server(options.port, False, log, parameters, options.driver)
+    backup = None
+    latencies = []
+    try:
+        if wait_for(lambda: answers(options.port), 30, .1) is None:
+            print "Primary server never came up; see %s" % options.log
+            return 1
+
+        backup = start_server(options.port, True, log, parameters, options.driver)
+        time.sleep(options.warmup)
+
+        for i in range(options.rounds):
+            # drive long enough for the primary to save its state
+            controller = drive(options.port, options.speed)
+            time.sleep(.5)
+
+            os.kill(primary.pid, signal.SIGKILL)
+            latency = wait_for(lambda: sending_speeds(options.port, options.speed), 10)
+            primary.wait()
+            controller.close()
+
+            if latency is None:
+                print "round %d: standby never drove on; see %s" % (i + 1, options.log)
+                return 1
+
+            latencies.append(latency)
+            print "round %d: speeds resent after %.3fs" % (i + 1, latency)
+
+            primary, backup = backup, start_server(options.port, True, log, parameters, options.driver)
+            time.sleep(options.warmup)
+    finally:
+        for process in (primary, backup):
+            if process and process.poll() is None:
+                process.kill()
+                process.wait()
+        log.close()
+        shutil.rmtree(directory, ignore_errors = True)
+
+    print "takeover min %.3fs, mean %.3fs, max %.3fs (arduino estop timeout %.1fs)" % (
+            min(latencies), sum(latencies) / len(latencies), max(latencies), ARDUINO_ESTOP_SECS)
+    return 0 if max(latencies) < ARDUINO_ESTOP_SECS else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
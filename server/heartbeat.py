@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""Tells the watchdog (supervisor/watchdog.py) that the server is alive
+
+Messages are single unix datagrams of space-separated text:
+    register <pid>
+    beat <pid> <loop counter> <health bits>
+    unregister <pid>
+"""
+
+import logging
+import os
+import socket
+
+# health bits carried in each beat
+ARDUINO_HEALTHY = 1
+ESTOP = 2
+SAFETY_ESTOP = 4
+RESETTING = 8
+
+class HeartbeatSender(object):
+    """Sends heartbeats to the watchdog's socket
+
+    Sending never blocks; if the watchdog isn't listening the beat is
+    simply counted as failed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+        self.sent = 0
+        self.failed = 0
+        self.log_failure = True
+
+    def _send(self, message):
+        try:
+            self.sock.sendto(message, self.path)
+        except socket.error, e:
+            self.failed += 1
+            if self.log_failure:
+                logging.warn("cannot reach watchdog at %s: %s" % (self.path, e))
+                self.log_failure = False
+            return False
+        else:
+            self.sent += 1
+            if not self.log_failure:
+                logging.info("watchdog at %s is reachable again" % self.path)
+                self.log_failure = True
+            return True
+
+    def register(self):
+        """Tells the watchdog which process to keep an eye on"""
+        return self._send('register %d' % self.pid)
+
+    def unregister(self):
+        """Tells the watchdog we're exiting on purpose"""
+        return self._send('unregister %d' % self.pid)
+
+    def beat(self, counter, health):
+        return self._send('beat %d %d %d' % (self.pid, counter, health))
+
+    @property
+    def status(self):
+        return {
+                'sent':self.sent,
+                'failed':self.failed,
+                }
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+import bisect
+import collections
+import logging
+import threading
+import time
+
+class Histogram(object):
+    """A fixed-size histogram of durations
+
+    Durations are added in seconds and bucketed by milliseconds, so the
+    memory used never grows no matter how long the server runs.
+    """
+    BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        # one extra bucket for everything above the last boundary
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, fraction):
+        """Returns the upper bound (in ms) of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0
+
+        needed = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= needed:
+                break
+
+        if i < len(self.BUCKETS_MS):
+            return min(self.BUCKETS_MS[i], self.max)
+        return self.max
+
+    @property
+    def status(self):
+        return {
+                'count':self.count,
+                'mean ms':round(self.total / self.count, 2) if self.count else 0,
+                'p50 ms':round(self.percentile(.5), 2),
+                'p99 ms':round(self.percentile(.99), 2),
+                'max ms':round(self.max, 2),
+                }
+
+class FlightRecorder(object):
+    """Remembers the last few thousand monitor loop iterations
+
+    Each iteration is a (start time, lateness, [(phase, duration), ...])
+    tuple. When something goes wrong the whole buffer is written out to a
+    file, so we can see what the loop was doing in the lead-up.
+    """
+    def __init__(self, size, path, min_dump_interval = 10):
+        self.iterations = collections.deque(maxlen = size)
+
+        # strftime pattern for dump files
+        self.path = path
+
+        # don't write a new dump for every flap of a flaky condition
+        self.min_dump_interval = min_dump_interval
+        self.last_dump = 0
+        self.dumps = 0
+
+    def record(self, start, lateness, phases):
+        self.iterations.append((start, lateness, phases))
+
+    def dump(self, reason):
+        """Writes the recorded iterations out in the background; returns the filename or None"""
+        now = time.time()
+        if now - self.last_dump < self.min_dump_interval:
+            return None
+
+        self.last_dump = now
+        self.dumps += 1
+
+        fname = time.strftime(self.path, time.localtime(now))
+        iterations = list(self.iterations)
+
+        writer = threading.Thread(
+                target = self._write, args = (fname, reason, iterations), name = 'flight-recorder')
+        writer.setDaemon(True)
+        writer.start()
+
+        return fname
+
+    def _write(self, fname, reason, iterations):
+        try:
+            fhandle = file(fname, 'w')
+            try:
+                fhandle.write("# %s at %.3f; %d iterations\n" % (reason, time.time(), len(iterations)))
+                for start, lateness, phases in iterations:
+                    fhandle.write("%.3f late=%.2fms %s\n" % (start, lateness * 1000, ' '.join(
+                        "%s=%.2fms" % (name, duration * 1000) for name, duration in phases)))
+            finally:
+                fhandle.close()
+        except:
+            logging.exception("failed to write flight recorder dump %s" % fname)
+        else:
+            logging.warn("flight recorder dumped to %s (%s)" % (fname, reason))
+
+    @property
+    def status(self):
+        return {
+                'iterations':len(self.iterations),
+                'dumps':self.dumps,
+                }
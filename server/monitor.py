@@ -1,98 +1,17 @@
 #!/usr/bin/python
 
 import logging
-import os
 import serial
+import sys
 import time
 import threading
 
-from parameters import monitor as mp
-
-def touch(fname, times = None):
-    fhandle = file(fname, 'a')
-    try:
-        os.utime(fname, times)
-    finally:
-        fhandle.close()
-
-class SafetyChecker(object):
-    def __init__(self):
-        self.driver_overtemp_estop = False
-        self.driver_overtemp_warn = False
-        self.battery_estop = False
-        self.battery_warn = False
-        self.sonar_warn = False
-        self.encoder_warn = False
-
-    @property
-    def status(self):
-        status = {
-                'Driver overtemp estop': self.driver_overtemp_estop,
-                'Driver overtemp warn': self.driver_overtemp_warn,
-                'Battery estop': self.battery_estop,
-                'Battery warn': self.battery_warn,
-                'Sonar warn': self.sonar_warn,
-                'Encoder warn': self.encoder_warn
-                }
-        return status
-
-    def should_estop(self):
-        return self.driver_overtemp_estop or self.battery_estop
-
-    def check(self, sensors):
-        self.check_driver_temperature(sensors['Driver temperature'].temperature)
-        self.check_battery_voltage(sensors['Battery voltage'].voltage)
-        self.check_sonar(sensors['Left sonar'].distance, sensors['Right sonar'].distance)
-        self.check_encoders(sensors['Left encoder'].rpm, sensors['Right encoder'].rpm)
-
-    def check_driver_temperature(self, temp):
-        """Warn if driver temperature too high; estop if critical."""
-        if not self.driver_overtemp_estop and temp >= mp['driver_estop_temperature']:
-            logging.warn('driver above critical temperature; estop')
-            self.driver_overtemp_estop = True
-        elif self.driver_overtemp_estop and temp <= mp['driver_safe_temperature']:
-            logging.info('driver at safe temperature, clearing estop')
-            self.driver_overtemp_estop = False
-
-        if not self.driver_overtemp_warn and temp >= mp['driver_warn_temperature']:
-            logging.warn('driver is getting too hot; warning')
-            self.driver_overtemp_warn = True
-        elif self.driver_overtemp_warn and temp <= mp['driver_safe_temperature']:
-            logging.warn('driver at safe temperature, clearing warning')
-            self.driver_overtemp_warn = False
-
-    def check_battery_voltage(self, voltage):
-        """Warn if battery voltage too low; estop if critical."""
-        if not self.battery_estop and voltage <= mp['battery_estop_voltage']:
-            logging.warn('battery below critical voltage; estop')
-            self.battery_estop = True
-        elif self.battery_estop and voltage >= mp['battery_safe_voltage']:
-            logging.info('battery at safe voltage, clearing estop')
-            self.battery_estop = False
-
-        if not self.battery_warn and voltage <= mp['battery_warn_voltage']:
-            logging.warn('battery undervoltage; warning')
-            self.battery_warn = True
-        elif self.battery_warn and voltage >= mp['battery_safe_voltage']:
-            logging.warn('battery at safe voltage, clearing warning')
-            self.battery_warn = False
-
-    def check_sonar(self, left_dist, right_dist):
-        """Warn if something is too close to either sonar."""
-        min_dist = min(left_dist, right_dist)
-        max_dist = max(left_dist, right_dist)
-        if not self.sonar_warn and max_dist <= mp['sonar_warn_distance']:
-            self.sonar_warn = True
-        elif self.sonar_warn and min_dist >= mp['sonar_safe_distance']:
-            self.sonar_warn = False
-
-    def check_encoders(self, left_rpm, right_rpm):
-        """Warn if wheel encoders show very different values."""
-        diff = abs(right_rpm - left_rpm)
-        if not self.encoder_warn and diff >= mp['encoder_warn_delta']:
-            self.encoder_warn = True
-        elif self.encoder_warn and diff <= mp['encoder_safe_delta']:
-            self.encoder_warn = False
+import collision
+import heartbeat
+import instrumentation
+import rules
+import scheduler
+import standby
 
 class ServerMonitor(threading.Thread):
     """Monitors the server and robot and takes action on exceptional conditions"""
@@ -110,89 +29,282 @@ class ServerMonitor(threading.Thread):
         self.log_failed_reset = True
 
         self.last_reset_attempt = 0
-        self.last_touched = 0
 
-        self.safety_checker = SafetyChecker()
+        # parameters come from the current config snapshot (see config.py)
+        self.config = server.config
+        self.snapshot = snapshot = self.config.current
+        self.mp = mp = snapshot.monitor
+
+        self.safety_checker = rules.RuleEngine(snapshot.safety_rules, robot.sensors)
+        self.collision_avoider = collision.CollisionAvoider(**snapshot.collision.as_dict())
+
+        # each check runs at its own rate; lower priorities run first
+        self.scheduler = scheduler.Scheduler(on_error = self.task_failed)
+        self.scheduler.add('sensors', self.read_sensors, mp.loop_min_interval, 0)
+        self.scheduler.add('safety', self.check_safety, mp.loop_min_interval, 1)
+        self.scheduler.add('collision', self.check_collision, mp.loop_min_interval, 1)
+        self.scheduler.add('arduino', self.check_arduino, mp.loop_min_interval, 2)
+        self.scheduler.add('timeouts', self.check_timeouts, mp.loop_min_interval, 3)
+        self.scheduler.add('speed', self.update_speed, mp.speed_update_interval, 4)
+        self.scheduler.add('heartbeat', self.send_heartbeat, mp.heartbeat_interval, 1)
+        self.scheduler.add('state', self.save_state, snapshot.standby.state_interval, 5)
+
+        # how long each phase of the loop takes, and how late the loop wakes up
+        self.timings = dict((task.name, instrumentation.Histogram()) for task in self.scheduler.tasks)
+        for name in ('lateness', 'interval', 'reset', 'errors'):
+            self.timings[name] = instrumentation.Histogram()
+
+        self.flight_recorder = instrumentation.FlightRecorder(
+                mp.flight_recorder_size, mp.flight_recorder_path,
+                mp.flight_recorder_min_dump_interval)
+
+        # the robot starts out estopped; only dump when it stops again later
+        self.was_estopped = True
+
+        # lets the watchdog know the loop is still making progress
+        self.heartbeat = heartbeat.HeartbeatSender(mp.heartbeat_socket)
+        self.loops = 0
+
+        # what a standby server needs to take over from us
+        self.state_file = standby.StateFile(snapshot.standby.state_path)
 
         # used to stop the monitor thread
         self._stop = threading.Event()
 
     def run(self):
-        """Polls for state and sends a heartbeat."""
+        """Runs the monitor tasks as they come due."""
+        self.heartbeat.register()
+        due = last_start = time.time()
+
         # Run until told to stop.
         while not self._stop.isSet():
-            try:
-                for sensor in self.robot.sensors.values():
-                    sensor.read()
-
-                self.safety_checker.check(self.robot.sensors)
-                if self.safety_checker.should_estop():
-                    self.robot.driver.stop()
-
-                if not self.robot.arduino.is_healthy():
-                    if self.log_arduino_unhealthy:
-                        logging.warn('arduino became unhealthy!')
-                        self.log_arduino_unhealthy = False
-
-                    if time.time() - self.last_reset_attempt > mp['time_between_reset_attempts']:
-                        try:
-                            self.robot.reset()
-                        except:
-                            if self.log_failed_reset:
-                                logging.exception("failed to reset arduino")
-                                self.log_failed_reset = False
-                else:
-                    self.log_failed_reset = True
-                    if not self.log_arduino_unhealthy:
-                        self.log_arduino_unhealthy = True
-                        logging.info("arduino becomes healthy again!")
-
-                # brake if the client hasn't said anything for a while
-                if self.client_age() > mp['client_timeout']:
-                    # print out this log message once per timeout
-                    if self.log_estop:
-                        logging.error('monitor estop; client_age %.4f' % (
-                            self.client_age(),))
-                    self.robot.driver.stop()
-                    self.log_estop = False
-                else:
-                    self.log_estop = True
-
-                # slow down if client hasn't issued control commands for a while
-                if self.control_age() > mp['control_timeout_brake'] and not (
-                        self.robot.driver.braking_speed or self.robot.arduino.status['estop']):
-                    if self.log_slowdown:
-                        logging.warn('braking; control_age %.4f' % (
-                                self.control_age(),))
-
-                    self.robot.driver.brake(mp['timeout_brake_speed'])
-                    self.log_slowdown = False
-                # emergency brake if still no control.
-                elif self.control_age() > mp['control_timeout_stop'] and not self.robot.arduino.status['estop']:
-                    if self.log_control_estop:
-                        logging.warn('controlled estop; control_age %.4f' % (
-                            self.control_age(),))
-                    self.log_control_estop = False
-                    self.robot.driver.stop()
-                else:
-                    self.log_slowdown = True
-                    self.log_control_estop = True
-
-                # touch a file every so often to tell watchdog we're still here
-                if time.time() - self.last_touched > mp['file_touch_interval']:
-                    touch(mp['file_touch_path'])
-                    self.last_touched = time.time()
-
-                # send new robot speed
-                self.robot.driver.update_speed()
-
-                time.sleep(mp['loop_min_interval'])
-
-            except serial.SerialException:
-                if self.robot.arduino.is_healthy():
-                    logging.exception("Unexpected serial error while arduino is healthy")
-            except:
-                logging.exception("Unexpected error in monitor loop")
+            snapshot = self.config.current
+            if snapshot is not self.snapshot:
+                self.apply_config(snapshot)
+
+            start = time.time()
+            ran = self.scheduler.run_pending()
+            if ran:
+                self.loops += 1
+                self.record_iteration(start, start - due, start - last_start, ran)
+                last_start = start
+
+            due = self.scheduler.next_deadline()
+            self.scheduler.sleep()
+
+        self.heartbeat.unregister()
+
+    def check_config(self, snapshot):
+        """Raises an exception if a new config snapshot can't be applied"""
+        driver = self.robot.driver
+        max_braking = driver.check_parameters(**driver.section_parameters(snapshot))['max_braking']
+        rules.RuleEngine(snapshot.safety_rules, self.robot.sensors)
+        avoider = collision.CollisionAvoider(**snapshot.collision.as_dict())
+        if avoider.brake_speed > max_braking:
+            raise ValueError("collision brake_speed %s exceeds the driver's max_braking %s" % (
+                avoider.brake_speed, max_braking))
+
+        for name in ('loop_min_interval', 'speed_update_interval', 'heartbeat_interval',
+                'client_timeout', 'control_timeout_brake', 'control_timeout_stop', 'control_grace',
+                'time_between_reset_attempts'):
+            value = getattr(snapshot.monitor, name)
+            if not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError("monitor %s must be a positive number" % name)
+
+    def apply_config(self, snapshot):
+        """Switches to a new (already checked) config snapshot
+
+        Only takes in what can change on the fly; the flight recorder, the
+        heartbeat socket and the odometry keep their startup settings.
+        """
+        previous, self.snapshot = self.snapshot, snapshot
+        changed = snapshot.changed(previous)
+
+        self.robot.driver.configure(**self.robot.driver.section_parameters(snapshot))
+
+        if 'safety_rules' in changed:
+            safety_checker = rules.RuleEngine(snapshot.safety_rules, self.robot.sensors)
+            safety_checker.carry_over(self.safety_checker)
+            self.safety_checker = safety_checker
+
+        if 'collision' in changed:
+            self.collision_avoider = collision.CollisionAvoider(**snapshot.collision.as_dict())
+
+        self.mp = mp = snapshot.monitor
+        periods = {
+                'speed':mp.speed_update_interval,
+                'heartbeat':mp.heartbeat_interval,
+                'state':snapshot.standby.state_interval,
+                }
+        for task in self.scheduler.tasks:
+            task.period = periods.get(task.name, mp.loop_min_interval)
+
+        logging.info("monitor switched from configuration version %d to %d" % (
+            previous.version, snapshot.version))
+
+    def record_iteration(self, start, lateness, interval, ran):
+        """Adds the timing of one pass through the loop to the histograms and flight recorder"""
+        self.timings['lateness'].add(max(lateness, 0))
+        self.timings['interval'].add(interval)
+
+        phases = []
+        for task in ran:
+            self.timings[task.name].add(task.last_duration)
+            phases.append((task.name, task.last_duration))
+        self.flight_recorder.record(start, lateness, phases)
+
+        estopped = bool(self.robot.arduino.status['estop'] or self.safety_checker.should_estop())
+        if estopped and not self.was_estopped:
+            self.flight_recorder.dump('estop')
+        self.was_estopped = estopped
+
+    def task_failed(self, task):
+        """Logs an exception raised by one of the monitor tasks"""
+        start = time.time()
+        if isinstance(sys.exc_info()[1], serial.SerialException):
+            if self.robot.arduino.is_healthy():
+                logging.exception("Unexpected serial error while arduino is healthy")
+        else:
+            logging.exception("Unexpected error in monitor task %s" % task.name)
+        self.timings['errors'].add(time.time() - start)
+
+    def read_sensors(self):
+        """Reads all the sensors and integrates the new frame into the odometry"""
+        for sensor in self.robot.sensors.values():
+            sensor.read()
+        self.robot.odometry.update()
+
+    def check_safety(self):
+        """Stops or brakes the robot if any of the safety rules calls for it"""
+        self.safety_checker.check()
+        if self.safety_checker.should_estop():
+            self.robot.driver.stop()
+        else:
+            brake_speed = self.safety_checker.brake_speed()
+            if brake_speed > self.robot.driver.braking_speed:
+                self.robot.driver.brake(brake_speed)
+
+    def check_collision(self):
+        """Slows down or brakes if we're about to run into something"""
+        sensors = self.robot.sensors
+        driver = self.robot.driver
+        left, right = sensors['Left sonar'], sensors['Right sonar']
+
+        was_braking = self.collision_avoider.braking
+        frame = collision.Frame(max(left.timestamp, right.timestamp),
+                left.distance, right.distance,
+                sensors['Left encoder'].rpm, sensors['Right encoder'].rpm,
+                cmp(sum(driver.last_speeds), 0))
+        scale, brake = self.collision_avoider.update(frame)
+
+        driver.speed_limit = scale
+        brake_speed = min(self.collision_avoider.brake_speed, driver.max_braking)
+        if brake and driver.braking_speed < brake_speed:
+            driver.brake(brake_speed)
+
+        if brake and not was_braking:
+            logging.warn('collision braking; %s' % (self.collision_avoider.status,))
+            self.collision_avoider.save_frames(time.strftime(self.mp.collision_recording_path))
+
+    def check_arduino(self):
+        """Resets the arduino if it becomes unhealthy"""
+        # move any reset in progress along
+        outcome = self.robot.resetter.step()
+        if outcome:
+            self.last_reset_attempt = time.time()
+            self.timings['reset'].add(self.robot.resetter.last_duration)
+            if outcome == 'failed':
+                if self.log_failed_reset:
+                    logging.error("failed to reset arduino: %s" % self.robot.resetter.last_error)
+                    self.log_failed_reset = False
+            else:
+                logging.info("arduino reset done (%s) in %.2fs" % (
+                    outcome, self.robot.resetter.last_duration))
+
+        if self.robot.resetting:
+            return
+
+        if not self.robot.arduino.is_healthy():
+            if self.log_arduino_unhealthy:
+                logging.warn('arduino became unhealthy!')
+                self.log_arduino_unhealthy = False
+                self.flight_recorder.dump('arduino unhealthy')
+
+            if time.time() - self.last_reset_attempt > self.mp.time_between_reset_attempts:
+                self.robot.reset()
+                self.last_reset_attempt = time.time()
+        else:
+            self.log_failed_reset = True
+            if not self.log_arduino_unhealthy:
+                self.log_arduino_unhealthy = True
+                logging.info("arduino becomes healthy again!")
+
+    def check_timeouts(self):
+        """Brakes or stops the robot if the client has gone quiet"""
+        # a dropped controller that didn't come back in time
+        self.server.expire_session()
+
+        # brake if the client hasn't said anything for a while
+        if self.client_age() > self.mp.client_timeout:
+            # print out this log message once per timeout
+            if self.log_estop:
+                logging.error('monitor estop; client_age %.4f' % (
+                    self.client_age(),))
+            self.robot.driver.stop()
+            self.log_estop = False
+        else:
+            self.log_estop = True
+
+        # slow down if client hasn't issued control commands for a while
+        if self.control_age() > self.mp.control_timeout_brake and not (
+                self.robot.driver.braking_speed or self.robot.arduino.status['estop']):
+            if self.log_slowdown:
+                logging.warn('braking; control_age %.4f' % (
+                        self.control_age(),))
+
+            self.robot.driver.brake(self.mp.timeout_brake_speed)
+            self.log_slowdown = False
+        # emergency brake if still no control.
+        elif self.control_age() > self.mp.control_timeout_stop and not self.robot.arduino.status['estop']:
+            if self.log_control_estop:
+                logging.warn('controlled estop; control_age %.4f' % (
+                    self.control_age(),))
+            self.log_control_estop = False
+            self.robot.driver.stop()
+        else:
+            self.log_slowdown = True
+            self.log_control_estop = True
+
+    def send_heartbeat(self):
+        """Tells the watchdog we're still here, and how things are going"""
+        health = 0
+        if self.robot.resetting:
+            health |= heartbeat.RESETTING
+        if self.robot.arduino.is_healthy():
+            health |= heartbeat.ARDUINO_HEALTHY
+        if self.robot.arduino.status['estop']:
+            health |= heartbeat.ESTOP
+        if self.safety_checker.should_estop():
+            health |= heartbeat.SAFETY_ESTOP
+
+        self.heartbeat.beat(self.loops, health)
+
+    def save_state(self):
+        """Saves what a standby server would need to take over"""
+        driver = self.robot.driver
+        self.state_file.save({
+                'target speeds':list(driver.target_speeds),
+                'last speeds':list(driver.last_speeds),
+                'braking speed':driver.braking_speed,
+                'last control':self.robot.last_control,
+                'controller':self.server.controller_address,
+                'estop':bool(self.robot.arduino.status['estop']),
+                })
+
+    def update_speed(self):
+        """Moves any running trajectory along and sends the new robot speed"""
+        self.robot.trajectory.step()
+        self.robot.driver.update_speed()
 
     def stop(self):
         """Signals that the monitor thread should stop."""
@@ -212,7 +324,16 @@ class ServerMonitor(threading.Thread):
         status = {
                 'client_age':self.client_age(),
                 'control_age':self.control_age(),
-                'alerts':self.safety_checker.status
+                'alerts':self.safety_checker.status,
+                'events':self.safety_checker.event_status,
+                'collision':self.collision_avoider.status,
+                'overruns':dict((task.name, task.overruns) for task in self.scheduler.tasks),
+                'timing':dict((name, h.status) for name, h in self.timings.items()),
+                'flight recorder':self.flight_recorder.status,
+                'heartbeat':self.heartbeat.status,
+                'reset':self.robot.resetter.status,
+                'config':self.config.status,
+                'config applied':self.snapshot.version,
                 }
 
         return status
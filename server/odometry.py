@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import math
+
+class Odometry(object):
+    """Dead-reckons the robot's pose from the wheel encoders (and gyro, if present)
+
+    Uses the same differential-drive model as sim/steering.Cart.move: the
+    heading changes by the difference in wheel travel over the track width,
+    and the robot moves forward by the average wheel travel. Unlike the
+    simulator, this integrates the distance each wheel actually covered
+    since the previous frame, so it doesn't care how often it is called.
+
+    The hall effect encoders only count pulses, not direction, so each
+    wheel's direction is taken from the last speed sent to the driver.
+
+    Pose is in inches and radians: x is along the heading the robot had at
+    startup, y is to its left, and heading is counter-clockwise positive.
+    """
+    # the arduino keeps its pulse counters in a 16-bit int
+    COUNTER_MODULUS = 65536
+
+    def __init__(self, robot,
+            wheel_radius = 8, track_width = 30, magnets = 2,
+            gyro_weight = 0, max_pulse_delta = 50, velocity_smoothing = .5, **rest):
+        self.robot = robot
+
+        self.track_width = float(track_width)
+        self.inches_per_pulse = 2 * math.pi * wheel_radius / float(magnets)
+
+        # fraction of each heading change taken from the gyro instead of the
+        # encoders; 0 disables gyro fusion entirely
+        self.gyro_weight = gyro_weight
+
+        # a bigger jump than this between frames means the arduino was reset
+        # (or the counter glitched), so resynchronize instead of integrating
+        self.max_pulse_delta = max_pulse_delta
+
+        self.velocity_smoothing = velocity_smoothing
+
+        self.x = 0.
+        self.y = 0.
+        self.heading = 0.
+        self.velocity = 0.
+        self.turn_rate = 0.
+        self.distance = 0.
+
+        # last encoder readings we integrated
+        self._last = None
+        self._direction = [1, 1]
+
+    def reset_pose(self):
+        """Makes the current position the origin"""
+        self.x = self.y = self.heading = 0.
+        self.distance = 0.
+
+    def resync(self):
+        """Forgets the last encoder counts; the next frame becomes the new baseline"""
+        self._last = None
+        self.velocity = 0.
+        self.turn_rate = 0.
+
+    def _wheel_travel(self, wheel, old, new):
+        """Signed inches travelled by a wheel between two pulse counts"""
+        pulses = (int(new.data) - int(old.data)) % self.COUNTER_MODULUS
+        if pulses > self.max_pulse_delta:
+            return None
+
+        commanded = self.robot.driver.last_speeds[wheel]
+        if commanded:
+            self._direction[wheel] = 1 if commanded > 0 else -1
+
+        return self._direction[wheel] * pulses * self.inches_per_pulse
+
+    def update(self):
+        """Integrates the newest encoder frame into the pose; call once per frame"""
+        left = self.robot.sensors['Left encoder'].last_reading
+        right = self.robot.sensors['Right encoder'].last_reading
+        if left is None or right is None:
+            return
+
+        if self._last is None:
+            self._last = (left, right)
+            return
+
+        last_left, last_right = self._last
+        if left.timestamp == last_left.timestamp and right.timestamp == last_right.timestamp:
+            return
+
+        self._last = (left, right)
+
+        dt = max(left.timestamp, right.timestamp) - max(last_left.timestamp, last_right.timestamp)
+        left_travel = self._wheel_travel(0, last_left, left)
+        right_travel = self._wheel_travel(1, last_right, right)
+        if dt <= 0 or left_travel is None or right_travel is None:
+            self.resync()
+            self._last = (left, right)
+            return
+
+        forward = (left_travel + right_travel) / 2
+        dtheta = (right_travel - left_travel) / self.track_width
+
+        if self.gyro_weight:
+            imu = self.robot.sensors.get('IMU')
+            yaw_rate = imu.yaw_rate if imu else None
+            if yaw_rate is not None and imu.timestamp == max(left.timestamp, right.timestamp):
+                dtheta = (self.gyro_weight * math.radians(yaw_rate) * dt
+                        + (1 - self.gyro_weight) * dtheta)
+
+        # integrate along the mid-point heading of this step
+        mid = self.heading + dtheta / 2
+        self.x += forward * math.cos(mid)
+        self.y += forward * math.sin(mid)
+        self.heading = (self.heading + dtheta + math.pi) % (2 * math.pi) - math.pi
+        self.distance += abs(forward)
+
+        a = self.velocity_smoothing
+        self.velocity = a * self.velocity + (1 - a) * (forward / dt)
+        self.turn_rate = a * self.turn_rate + (1 - a) * (dtheta / dt)
+
+    @property
+    def status(self):
+        return {
+                'x':round(self.x, 1),
+                'y':round(self.y, 1),
+                'heading':round(math.degrees(self.heading), 1),
+                'velocity':round(self.velocity, 1),
+                'turn rate':round(math.degrees(self.turn_rate), 1),
+                'distance':round(self.distance, 1),
+                }
@@ -4,12 +4,67 @@ driver = {
         'min_speed':5,
         'max_speed':95,
         'max_turn_speed':50,
-        'max_acceleration':3,
+        'acceleration':15,
+        'deceleration':30,
+        'jerk':60,
         'max_braking':20,
+        'brake_rate':5,
         'speed_adjust':1,
         'left_speed_adjust':1,
         'right_speed_adjust':.95,
-        'min_update_interval':0.2,
+        'setpoint_interval':0.05,
+        }
+
+# used by the closedloop driver, on top of the driver parameters
+closedloop = {
+        'max_rpm':120,
+        'kp':.2,
+        'ki':.5,
+        'kd':0,
+        'max_correction':30,
+        'magnets':2,
+        'max_pulse_delta':50,
+        'speed_smoothing':.3,
+        }
+
+# used by the smc driver, on top of the driver parameters
+smc = {
+        'status_interval':.25,
+        'reconnect_interval':1,
+        }
+
+# used by the sim driver to build its simulated world (see drivers/sim.py)
+sim = {
+        'time_scale':1,
+
+        'wheel_radius':8,
+        'track_width':30,
+        'length':60,
+        'magnets':2,
+        'max_rpm':120,
+        'motor_time_constant':.3,
+        'right_motor_strength':.95,
+        'load':0,
+
+        'arena_width':480,
+        'arena_length':720,
+
+        'battery_volts':25.6,
+        'empty_volts':23,
+        'capacity_ah':35,
+        'resistance':.05,
+        'idle_current':1,
+        'max_current':60,
+
+        'ambient_temperature':25,
+        'heating':.5,
+        'thermal_time_constant':300,
+        }
+
+# limits on trajectories uploaded with the trajectory command
+trajectory = {
+        'max_segments':200,
+        'max_duration':120,
         }
 
 monitor = {
@@ -18,22 +73,102 @@ monitor = {
         'control_timeout_brake':3,
         'control_timeout_stop':8,
         'timeout_brake_speed':2,
+        # how long a dropped controller may take to resume its session
+        # before the robot is stopped
+        'control_grace':2,
 
-        'file_touch_path':'/tmp/server-monitor-alive',
-        'file_touch_interval':1,
+        'heartbeat_socket':'/tmp/server-heartbeat.sock',
+        'heartbeat_interval':.1,
 
         'loop_min_interval':.05,
+        'speed_update_interval':.05,
 
-        'driver_safe_temperature':30,
-        'driver_warn_temperature':40,
-        'driver_estop_temperature':70,
-        'battery_safe_voltage':22,
-        'battery_warn_voltage':20,
-        'battery_estop_voltage':15,
+        'flight_recorder_size':4000,
+        'flight_recorder_path':'/tmp/server-monitor-%Y%m%d-%H%M%S.log',
+        'flight_recorder_min_dump_interval':10,
 
-        'sonar_warn_distance':40,
-        'sonar_safe_distance':60,
+        'collision_recording_path':'/tmp/server-collision-%Y%m%d-%H%M%S.csv',
+        }
 
-        'encoder_safe_delta':100,
-        'encoder_warn_delta':200,
+odometry = {
+        'wheel_radius':8,
+        'track_width':30,
+        'magnets':2,
+        'gyro_weight':0,
+        'max_pulse_delta':50,
+        'velocity_smoothing':.5,
         }
+
+standby = {
+        'lock_path':'/tmp/penguin-server.lock',
+        'state_path':'/tmp/penguin-server.state',
+        'state_interval':.1,
+        'state_max_age':2,
+        'controller_reservation':10,
+        }
+
+collision = {
+        'wheel_radius':8,
+        'deceleration':40,
+        'reaction_time':.3,
+        'margin':12,
+        'slow_time':3,
+        'min_scale':.2,
+        'brake_speed':20,
+        'smoothing':.5,
+        'max_frame_gap':.5,
+        'history':2000,
+        }
+
+# see rules.py for the format
+safety_rules = [
+        {
+            'name':'Driver overtemp estop',
+            'value':'Driver temperature.temperature',
+            'above':70,
+            'clear':30,
+            'action':'estop',
+            'sounds':('driver_estop_set', 'driver_estop_clear'),
+            },
+        {
+            'name':'Driver overtemp warn',
+            'value':'Driver temperature.temperature',
+            'above':40,
+            'clear':30,
+            'action':'warn',
+            'sounds':('driver_warn', None),
+            },
+        {
+            'name':'Battery estop',
+            'value':'Battery voltage.voltage',
+            'below':15,
+            'clear':22,
+            'action':'estop',
+            'sounds':('battery_estop_set', 'battery_estop_clear'),
+            },
+        {
+            'name':'Battery warn',
+            'value':'Battery voltage.voltage',
+            'below':20,
+            'clear':22,
+            'action':'warn',
+            'sounds':('battery_warn', None),
+            },
+        {
+            # something is close in front of both sonars
+            'name':'Sonar warn',
+            'value':('max', 'Left sonar.distance', 'Right sonar.distance'),
+            'clear value':('min', 'Left sonar.distance', 'Right sonar.distance'),
+            'below':40,
+            'clear':60,
+            'action':'warn',
+            'sounds':('sonar_warn', None),
+            },
+        {
+            'name':'Encoder warn',
+            'value':('absdiff', 'Left encoder.rpm', 'Right encoder.rpm'),
+            'above':200,
+            'clear':100,
+            'action':'warn',
+            },
+        ]
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""Declarative safety rules
+
+Each rule is a dictionary (see safety_rules in parameters.py):
+    name: what the alert is called in the status and logs
+    value: the sensor expression to check (see below)
+    clear value: optional different expression to check when clearing
+    above/below: the alert is set when the value reaches this threshold
+    clear: the alert is cleared once the value gets back past this one
+    action: 'warn', 'brake' or 'estop'
+    brake speed: how hard to brake for 'brake' rules
+    sounds: optional (set sound, clear sound) for clients to play
+
+A sensor expression is either a 'Sensor name.attribute' string, or a tuple
+of a function name from FUNCTIONS followed by more expressions, like
+('max', 'Left sonar.distance', 'Right sonar.distance').
+
+The rules are compiled once into a flat list. Each check takes one
+snapshot of every sensor attribute the rules use, then runs through the
+list, producing an AlertEvent for every alert that is set or cleared.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+FUNCTIONS = {
+        'max':max,
+        'min':min,
+        'abs':abs,
+        'absdiff':lambda a, b: abs(a - b),
+        'sum':lambda *values: sum(values),
+        }
+
+ACTIONS = ('warn', 'brake', 'estop')
+
+class RuleError(ValueError):
+    """Used when a rule cannot be compiled"""
+    pass
+
+class AlertEvent(object):
+    """An alert being set or cleared"""
+    def __init__(self, seq, timestamp, rule, is_set, value):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.name = rule.name
+        self.action = rule.action
+        self.is_set = is_set
+        self.value = value
+        self.sound = rule.sounds[0] if is_set else rule.sounds[1]
+
+    @property
+    def status(self):
+        return {
+                'seq':self.seq,
+                'time':self.timestamp,
+                'name':self.name,
+                'action':self.action,
+                'set':self.is_set,
+                'value':self.value,
+                'sound':self.sound,
+                }
+
+    def __repr__(self):
+        return "AlertEvent(seq=%d, name=%s, action=%s, set=%s, value=%s)" % (
+                self.seq, self.name, self.action, self.is_set, self.value)
+
+class CompiledRule(object):
+    """A rule with its expressions and threshold tests resolved to plain functions"""
+    def __init__(self, name, action, value, clear_value, trips, clears, brake_speed, sounds):
+        self.name = name
+        self.action = action
+        self.value = value
+        self.clear_value = clear_value
+        self.trips = trips
+        self.clears = clears
+        self.brake_speed = brake_speed
+        self.sounds = sounds
+
+        self.active = False
+
+class RuleEngine(object):
+    """Evaluates the compiled safety rules against the robot's sensors"""
+
+    # how many recent events to keep for the status
+    EVENT_HISTORY = 20
+
+    def __init__(self, rules, sensors):
+        # (sensor, attribute) pairs read into each snapshot
+        self.sources = []
+        self.plan = [self._compile(rule, sensors) for rule in rules]
+
+        # appended to by the monitor, read by the connection handlers
+        self.events = collections.deque(maxlen = self.EVENT_HISTORY)
+        self.events_lock = threading.Lock()
+        self.seq = 0
+
+        # number of active rules of each action, so checking them is cheap
+        self.active = dict((action, 0) for action in ACTIONS)
+
+    def carry_over(self, previous):
+        """Takes over the alerts and events of the engine this one replaces
+
+        Rules are matched by name, so a reload doesn't clear a latched
+        alert, and the event numbering carries on for the clients.
+        """
+        active = dict((rule.name, rule.active) for rule in previous.plan)
+        for rule in self.plan:
+            rule.active = active.get(rule.name, False)
+
+        self.active = dict((action, 0) for action in ACTIONS)
+        for rule in self.plan:
+            if rule.active:
+                self.active[rule.action] += 1
+
+        self.seq = previous.seq
+        with previous.events_lock:
+            self.events.extend(previous.events)
+
+    def _source(self, path, sensors):
+        """Returns the snapshot index for a 'Sensor name.attribute' path"""
+        try:
+            name, attribute = path.rsplit('.', 1)
+            source = (sensors[name], attribute)
+        except (ValueError, KeyError):
+            raise RuleError("unknown sensor value '%s'" % path)
+
+        if not hasattr(source[0], attribute):
+            raise RuleError("sensor '%s' has no attribute '%s'" % (name, attribute))
+
+        if source not in self.sources:
+            self.sources.append(source)
+        return self.sources.index(source)
+
+    def _expression(self, expr, sensors):
+        """Compiles a sensor expression into a function of the snapshot"""
+        if isinstance(expr, basestring):
+            index = self._source(expr, sensors)
+            return lambda snapshot: snapshot[index]
+
+        try:
+            function = FUNCTIONS[expr[0]]
+        except (KeyError, TypeError, IndexError):
+            raise RuleError("invalid expression %r" % (expr,))
+
+        args = [self._expression(arg, sensors) for arg in expr[1:]]
+        def evaluate(snapshot):
+            values = [arg(snapshot) for arg in args]
+            if None in values:
+                return None
+            return function(*values)
+        return evaluate
+
+    def _compile(self, rule, sensors):
+        name = rule.get('name')
+        if not name:
+            raise RuleError("every rule needs a name")
+
+        action = rule.get('action', 'warn')
+        if action not in ACTIONS:
+            raise RuleError("rule '%s' has invalid action '%s'" % (name, action))
+
+        if 'clear' not in rule:
+            raise RuleError("rule '%s' has no clear threshold" % name)
+        clear = rule['clear']
+
+        if 'above' in rule:
+            threshold = rule['above']
+            if clear > threshold:
+                raise RuleError("rule '%s' clears above its threshold" % name)
+            trips = lambda value: value >= threshold
+            clears = lambda value: value <= clear
+        elif 'below' in rule:
+            threshold = rule['below']
+            if clear < threshold:
+                raise RuleError("rule '%s' clears below its threshold" % name)
+            trips = lambda value: value <= threshold
+            clears = lambda value: value >= clear
+        else:
+            raise RuleError("rule '%s' needs an 'above' or 'below' threshold" % name)
+
+        value = self._expression(rule.get('value'), sensors)
+        if 'clear value' in rule:
+            clear_value = self._expression(rule['clear value'], sensors)
+        else:
+            clear_value = value
+
+        sounds = tuple(rule.get('sounds', ())) + (None, None)
+
+        return CompiledRule(name, action, value, clear_value, trips, clears,
+                rule.get('brake speed', 0), sounds[:2])
+
+    def check(self, sensors = None):
+        """Checks all the rules against a fresh snapshot; returns the new events
+
+        The sensors are bound when the rules are compiled; the argument is
+        only accepted so this can stand in for the old SafetyChecker.
+        """
+        snapshot = [getattr(sensor, attribute) for sensor, attribute in self.sources]
+        now = time.time()
+
+        new_events = []
+        for rule in self.plan:
+            if rule.active:
+                value = rule.clear_value(snapshot)
+                if value is None or not rule.clears(value):
+                    continue
+                rule.active = False
+                self.active[rule.action] -= 1
+            else:
+                value = rule.value(snapshot)
+                if value is None or not rule.trips(value):
+                    continue
+                rule.active = True
+                self.active[rule.action] += 1
+
+            self.seq += 1
+            event = AlertEvent(self.seq, now, rule, rule.active, value)
+            new_events.append(event)
+            with self.events_lock:
+                self.events.append(event)
+
+            if event.is_set:
+                logging.warn('%s set (%s); %s' % (rule.name, value, rule.action))
+            else:
+                logging.info('%s cleared (%s)' % (rule.name, value))
+
+        return new_events
+
+    def should_estop(self):
+        return self.active['estop'] > 0
+
+    def brake_speed(self):
+        """Returns the braking speed called for by the active rules, or 0"""
+        if not self.active['brake']:
+            return 0
+        return max(rule.brake_speed for rule in self.plan if rule.active and rule.action == 'brake')
+
+    @property
+    def status(self):
+        return dict((rule.name, rule.active) for rule in self.plan)
+
+    @property
+    def event_status(self):
+        with self.events_lock:
+            events = list(self.events)
+        return [event.status for event in events]
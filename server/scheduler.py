@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import logging
+import time
+
+class Task(object):
+    """A periodic job run by the Scheduler"""
+    def __init__(self, name, function, period, priority = 0):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.priority = priority
+
+        # absolute time the task is next due; 0 means run on the first pass
+        self.deadline = 0
+
+        self.runs = 0
+        self.overruns = 0       # times the task fell a whole period behind
+        self.skipped = 0        # slots dropped because of overruns
+        self.overrunning = False  # last run took longer than the period
+        self.last_duration = 0
+        self.max_duration = 0
+
+    @property
+    def status(self):
+        return {
+                'period':self.period,
+                'priority':self.priority,
+                'runs':self.runs,
+                'overruns':self.overruns,
+                'skipped':self.skipped,
+                'last duration':round(self.last_duration, 4),
+                'max duration':round(self.max_duration, 4),
+                }
+
+class Scheduler(object):
+    """Runs periodic tasks against absolute deadlines
+
+    Each task's next deadline is its previous deadline plus its period, so
+    time spent running the tasks doesn't accumulate as drift the way a
+    fixed sleep at the end of a loop does.
+
+    Tasks run in priority order (lower numbers first). A task that falls
+    a whole period or more behind is counted as an overrun and drops the
+    slots it missed rather than running several times back to back to
+    catch up, and a task which took longer than its own period to run gives
+    up its next slot so it can't starve the tasks behind it.
+    """
+    def __init__(self, on_error = None):
+        self.tasks = []
+
+        # called with the task whenever a task raises; defaults to logging
+        self.on_error = on_error or self._log_error
+
+    def _log_error(self, task):
+        logging.exception("Unexpected error in task %s" % task.name)
+
+    def add(self, name, function, period, priority = 0):
+        """Adds a task which calls function every period seconds"""
+        task = Task(name, function, period, priority)
+        self.tasks.append(task)
+        self.tasks.sort(key = lambda t: t.priority)
+        return task
+
+    def next_deadline(self):
+        """Returns the absolute time the next task is due"""
+        return min(task.deadline for task in self.tasks)
+
+    def run_pending(self):
+        """Runs every task that is due; returns the tasks that ran"""
+        ran = []
+        for task in self.tasks:
+            now = time.time()
+            if now < task.deadline:
+                continue
+
+            # it overran its period last time; let everything else catch up
+            if task.overrunning:
+                task.overrunning = False
+                task.skipped += 1
+                task.deadline += task.period
+                continue
+
+            if not task.deadline:
+                task.deadline = now
+            elif now - task.deadline >= task.period:
+                missed = int((now - task.deadline) / task.period)
+                task.overruns += 1
+                task.skipped += missed
+                task.deadline += missed * task.period
+
+            try:
+                task.function()
+            except:
+                self.on_error(task)
+
+            task.last_duration = time.time() - now
+            task.max_duration = max(task.max_duration, task.last_duration)
+            task.overrunning = task.last_duration > task.period
+            task.deadline += task.period
+            task.runs += 1
+            ran.append(task)
+
+        return ran
+
+    def sleep(self):
+        """Sleeps until the next task is due"""
+        delay = self.next_deadline() - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def status(self):
+        return dict((task.name, task.status) for task in self.tasks)
@@ -30,11 +30,15 @@ class VoltageSensor(ArduinoConnectedSensor):
         # resistors used on the divider, in ohms
         self.ratio = float(R1 + R2) / float(R2)
 
-        self.readings = deque([0] * 20, 20)
+        # averaging in zeros before the first readings would look like a
+        # flat battery, and estop a robot that a standby just took over
+        self.readings = deque([], 20)
 
     @property
     def voltage(self):
-        """Voltage is actually an average of several readings"""
+        """Voltage is actually an average of several readings; None before the first"""
+        if not self.readings:
+            return None
         return sum(self.readings)/len(self.readings)
 
     def read(self):
@@ -42,7 +46,6 @@ class VoltageSensor(ArduinoConnectedSensor):
         reading = self._read()
         if reading is not None:
             voltage = self.ratio * float(reading.data) * 5 / 1023
-            self.readings.popleft()
             self.readings.append(voltage)
 
         return self.voltage
@@ -82,6 +85,8 @@ class Sonar(ArduinoConnectedSensor):
     """An LV-MaxSonar -EZ1 connected to the Arduino (via PWM)"""
     def __init__(self, robot, key):
         ArduinoConnectedSensor.__init__(self, robot, key)
+        self.distance = None
+        self.timestamp = None
 
     def read(self):
         reading = self._read()
@@ -89,6 +94,7 @@ class Sonar(ArduinoConnectedSensor):
             self.distance = None
         else:
             self.distance = int(reading.data)
+            self.timestamp = reading.timestamp
 
         return self.distance
 
@@ -105,6 +111,7 @@ class Encoder(ArduinoConnectedSensor):
         self.min_interval = min_interval
 
         self.readings = []
+        self.last_reading = None
 
     @property
     def rpm(self):
@@ -124,6 +131,8 @@ class Encoder(ArduinoConnectedSensor):
     def read(self):
         """Process the RPMs of the encoder"""
         reading = self._read()
+        if reading is not None:
+            self.last_reading = reading
 
         # do we add this new reading to the list?
         # ignore null readings
@@ -154,6 +163,51 @@ class Encoder(ArduinoConnectedSensor):
     def status(self):
         return {'value':self.rpm, 'units':'RPM'}
 
+class AMG(ArduinoConnectedSensor):
+    """The MinIMU-9 (LSM303 accelerometer/magnetometer + L3G4200D gyro)
+
+    Only present when the controller is built with USE_AMG; the arduino
+    sends nine comma-separated raw axis values: accel x,y,z, mag x,y,z
+    and gyro x,y,z.
+    """
+    def __init__(self, robot, key, gyro_scale = 0.00875):
+        ArduinoConnectedSensor.__init__(self, robot, key)
+
+        # degrees/sec per raw gyro count (L3G4200D at the default 250 dps range)
+        self.gyro_scale = gyro_scale
+
+        self.acceleration = None
+        self.magnetic = None
+        self.gyro = None
+        self.timestamp = None
+
+    @property
+    def yaw_rate(self):
+        """Rotation around the vertical axis in degrees/sec (counter-clockwise positive)"""
+        if self.gyro is None:
+            return None
+        return self.gyro[2] * self.gyro_scale
+
+    def read(self):
+        reading = self._read()
+        if reading is not None and reading.timestamp != self.timestamp:
+            try:
+                values = [int(v) for v in reading.data.split(',')]
+            except ValueError:
+                return self.yaw_rate
+
+            if len(values) == 9:
+                self.acceleration = tuple(values[0:3])
+                self.magnetic = tuple(values[3:6])
+                self.gyro = tuple(values[6:9])
+                self.timestamp = reading.timestamp
+
+        return self.yaw_rate
+
+    @property
+    def status(self):
+        return {'value':self.yaw_rate, 'units':'deg/s'}
+
 class SensorReading(object):
     """Represents a reading from a sensor attached to the arduino"""
     def __init__(self,
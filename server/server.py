@@ -2,6 +2,9 @@
 
 import SocketServer
 import cPickle as pickle
+import os
+import signal
+import socket
 import sys
 import time
 import threading
@@ -10,10 +13,14 @@ import traceback
 from optparse import OptionParser, OptionGroup
 
 import arduino
+import config
 import drivers
 import logging
 import monitor
+import odometry
 import sensors
+import standby
+import trajectory
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s server %(levelname)-8s %(message)s',
@@ -33,12 +40,79 @@ class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         SocketServer.TCPServer.__init__(self, sockaddr, handler)
         self.is_shutting_down = threading.Event()
 
+        # address of the connection holding the control lock, if any
+        self.controller_address = None
+
+        # after taking over from another server, keep control free for
+        # whoever had it there: (address, until when)
+        self.reserved_controller = None
+
+        # the controller's session token and connection; when the
+        # connection drops, control is held for the token for a while
+        # instead of stopping: (token, until when)
+        self.session = None
+        self.session_handler = None
+        self.held_session = None
+        self.session_lock = threading.Lock()
+
+    def may_control(self, address):
+        """Returns False if control is being held for some other host"""
+        if self.expire_session() or self.held_session:
+            return False
+        if not self.reserved_controller:
+            return True
+
+        host, until = self.reserved_controller
+        if time.time() > until:
+            self.reserved_controller = None
+            return True
+        return address == host
+
+    def hold_session(self, token, grace):
+        """Keeps control for a dropped controller to resume"""
+        with self.session_lock:
+            self.held_session = (token, time.time() + grace)
+
+    def take_held_session(self, token):
+        """Takes over a session held for the token, along with the control lock
+
+        Both happen together, so nobody else can take control in between;
+        returns False if the session isn't held or the lock isn't free yet.
+        """
+        with self.session_lock:
+            if not self.held_session or self.held_session[0] != token:
+                return False
+            if not self.control_lock.acquire(blocking = 0):
+                return False
+            self.held_session = None
+            return True
+
+    def expire_session(self):
+        """Stops the robot if a held session ran out; returns True if it did"""
+        with self.session_lock:
+            if not self.held_session or time.time() < self.held_session[1]:
+                return False
+            self.held_session = None
+            self.session = None
+
+        self.robot.stop()
+        print "controller did not come back; robot stopped"
+        return True
+
+    def reload_config(self):
+        """Rereads parameters.py; the monitor applies it once it passes its checks"""
+        return self.config.reload(self.monitor.check_config)
+
     def shutdown(self):
         if not self.is_shutting_down.is_set():
             self.is_shutting_down.set()
             SocketServer.TCPServer.shutdown(self)
 
 class ConnectionHandler(SocketServer.StreamRequestHandler):
+    # how long a resume waits for the old connection to hand over; well
+    # under the client's reply timeout, so it doesn't give up and retry
+    RESUME_WAIT = .3
+
     def parse_speed(self, parts):
         "parses the speed that comes over the wire into an int or None"
         try:
@@ -62,22 +136,31 @@ class ConnectionHandler(SocketServer.StreamRequestHandler):
         parts = command.split()
 
         if parts[0] not in (
-                'status', 'stop', 'brake', 'reset', 'go', 'speed', 'left', 'right'):
+                'status', 'stop', 'brake', 'reset', 'go', 'speed', 'speeds', 'left', 'right',
+                'tune', 'trajectory'):
             raise CommandError("invalid command '%s'" % command)
 
 
         if parts[0] == 'status':
             status = robot.status
             status['monitor'] = self.server.monitor.status
+            status['config'] = self.server.config.status
 
             output = status
 
         else:
+            if not self.server.may_control(self.client_address[0]):
+                raise Exception("control is reserved for the previous controller")
+
             acquired = self.server.control_lock.acquire(blocking = 0)
             if not acquired:
                 raise Exception("another connection is controlling the robot")
 
             try:
+                # any control command takes over from a running trajectory
+                if parts[0] != 'tune':
+                    robot.trajectory.abort("preempted by '%s'" % parts[0])
+
                 if parts[0] == 'stop':
                     robot.stop()
                     output = 'robot stopped'
@@ -94,13 +177,36 @@ class ConnectionHandler(SocketServer.StreamRequestHandler):
                     output = 'braking initiated'
 
                 elif parts[0] == 'reset':
-                    robot.reset()
-                    output = "robot reset successful"
+                    if robot.reset():
+                        output = "robot reset started"
+                    else:
+                        output = "robot reset already in progress"
 
                 elif parts[0] == 'go':
                     robot.go()
                     output = "robot ready to run"
 
+                elif parts[0] == 'tune':
+                    try:
+                        gains = [float(gain) for gain in parts[1:]]
+                        if not 1 <= len(gains) <= 3:
+                            raise ValueError("wrong number of gains")
+                    except ValueError:
+                        raise CommandError("tune takes kp [ki [kd]] as numbers")
+
+                    robot.tune(*gains)
+                    output = "gains set to %s" % ' '.join(parts[1:])
+
+                elif parts[0] == 'trajectory':
+                    try:
+                        segments = trajectory.parse(' '.join(parts[1:]), robot.odometry.track_width)
+                    except ValueError, e:
+                        raise CommandError(str(e))
+
+                    robot.run_trajectory(segments, self.server.config.current.trajectory)
+                    output = "trajectory of %d segments (%.1fs) started" % (
+                            len(segments), sum(s.duration for s in segments))
+
                 elif parts[0] in ('speed', 'left', 'right'):
                     #try to get a number out of parts[1]
                     try:
@@ -116,19 +222,71 @@ class ConnectionHandler(SocketServer.StreamRequestHandler):
 
                     printable_motor = "%s motor" if motor in ('left', 'right') else "both motors"
                     output = "speed on %s set to %s" % (printable_motor, new_speed)
+
+                elif parts[0] == 'speeds':
+                    # both wheels in one command, so a setpoint is one round trip
+                    try:
+                        left, right = [int(speed) for speed in parts[1:]]
+                        if not -100 <= left <= 100 or not -100 <= right <= 100:
+                            raise ValueError("out of range")
+                    except ValueError:
+                        raise CommandError("speeds takes left and right numbers from -100 to 100")
+
+                    robot.set_speeds(left, right)
+                    output = "speeds set to %d, %d" % (left, right)
             finally:
                 self.server.control_lock.release()
 
         return output
 
+    def start_session(self, token):
+        """Makes this connection the controller's, under a session token"""
+        self.session = token
+        self.server.session = token
+        self.server.session_handler = self
+        self.server.controller_address = self.client_address[0]
+
+    def resume_session(self, token):
+        """Takes control back for a controller that lost its connection"""
+        if self.controller or token != self.server.session:
+            return False
+
+        # the old connection may not have noticed it's gone; cut it off
+        old = self.server.session_handler
+        if old is not None and old is not self and not self.server.held_session:
+            try:
+                old.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        # the old connection's handler hands the session over as it ends
+        deadline = time.time() + self.RESUME_WAIT
+        while not self.server.take_held_session(token):
+            if time.time() > deadline:
+                return False
+            time.sleep(.01)
+
+        self.controller = True
+        self.start_session(token)
+        self.server.last_request = time.time()
+        print "Client %s:%s resumed the controlling session" % self.client_address
+        return True
+
     def handle(self):
         """handles a single client connection"""
         print "Client %s:%s connected" % self.client_address
         self.controller = False
+        self.session = None
+
+        # the connection ends without saying goodbye unless we hear exit
+        dropped = True
 
         try:
             while not self.server.is_shutting_down.is_set():
-                command = self.rfile.readline().strip()
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.strip()
 
                 # meta commands: these control the meta operations
                 # they do not drive the robot
@@ -137,27 +295,53 @@ class ConnectionHandler(SocketServer.StreamRequestHandler):
                     continue
 
                 if command == 'exit':
+                    dropped = False
                     self.send_output('ok', 'done')
                     break
 
                 if command == 'shutdown':
+                    dropped = False
                     self.send_output('ok', 'shutdown')
                     self.server.shutdown()
                     # the main thread will shut down the robot
                     break
 
+                if command == 'reload':
+                    if not self.controller:
+                        self.send_output('error', 'only the controlling connection may reload')
+                        continue
+                    try:
+                        snapshot = self.server.reload_config()
+                        self.send_output('ok', 'configuration version %d loaded' % snapshot.version)
+                    except config.ConfigError, e:
+                        self.send_output('error', str(e))
+
+                    continue
+
                 if command == 'control':
                     if self.controller:
                         self.send_output('ok', 'was already a controller')
+                    elif not self.server.may_control(self.client_address[0]):
+                        self.send_output('error', 'control is reserved for the previous controller')
                     else:
                         self.controller = self.server.control_lock.acquire(blocking = 0)
                         if self.controller:
-                            self.send_output('ok', 'acquired control lock')
+                            self.start_session(os.urandom(8).encode('hex'))
+                            self.server.reserved_controller = None
+                            self.send_output('ok', 'acquired control lock; session %s' % self.session)
                         else:
                             self.send_output('error', 'cannot acquire control lock')
 
                     continue
 
+                if command.startswith('resume '):
+                    if self.resume_session(command.split()[1]):
+                        self.send_output('ok', 'resumed session %s' % self.session)
+                    else:
+                        self.send_output('error', 'no session to resume')
+
+                    continue
+
                 try:
                     output = self.process_command(command)
 
@@ -178,25 +362,41 @@ class ConnectionHandler(SocketServer.StreamRequestHandler):
         finally:
             output = ["%s:%s disconnected" % self.client_address]
             if self.controller:
-                self.server.control_lock.release()
-                self.server.robot.stop()
-                output.append("; robot stopped. no more controlling client")
+                grace = self.server.config.current.monitor.control_grace
+                self.server.controller_address = None
+                self.server.session_handler = None
+                if dropped and not self.server.is_shutting_down.is_set():
+                    # give the controller a moment to reconnect and resume
+                    self.server.hold_session(self.session, grace)
+                    self.server.control_lock.release()
+                    output.append("; holding control for %.1fs" % grace)
+                else:
+                    self.server.session = None
+                    self.server.control_lock.release()
+                    self.server.robot.stop()
+                    output.append("; robot stopped. no more controlling client")
             else:
                 output.append("; was a viewer")
 
             print "".join(output)
 
 class Robot(object):
-    """Represents the robot this server is controlling"""
-    def __init__(self, driver, arduino_serial = None, **options):
-        self.arduino_serial = arduino_serial
+    """Represents the robot this server is controlling
 
-        # a real arduino is found during reset()
-        self.arduino = None
+    The driver and odometry are built from the config snapshot the server
+    starts with; later snapshots only reach them through the monitor.
+    """
+    def __init__(self, snapshot, driver, arduino_serial = None, **options):
+        self.arduino_serial = arduino_serial
 
         # initialize the driver
         drivermod = drivers.driverlist[driver][1]
-        self.driver = drivermod.get_driver(robot = self, **options)
+        self.driver = drivermod.get_driver(robot = self, snapshot = snapshot, **options)
+
+        # a real arduino is found during reset(), unless the driver brings its own
+        self.arduino = None
+        self.resetter = arduino.Resetter(arduino_serial, self._install_arduino,
+                getattr(self.driver, 'find_arduino', None))
 
         # make a list of sensors
         self.sensors = {
@@ -206,8 +406,15 @@ class Robot(object):
                 'Right sonar':sensors.Sonar(self, 'RS'),
                 'Left encoder':sensors.Encoder(self, 'LE'),
                 'Right encoder':sensors.Encoder(self, 'RE'),
+                'IMU':sensors.AMG(self, 'AMG'),
                 }
 
+        # dead-reckoned pose, updated by the monitor on every frame
+        self.odometry = odometry.Odometry(self, **snapshot.odometry.as_dict())
+
+        # runs uploaded trajectories, stepped by the monitor
+        self.trajectory = trajectory.TrajectoryExecutor(self)
+
         # keep track of when the last command was issued to the robot
         self.last_control = 0
 
@@ -223,9 +430,13 @@ class Robot(object):
     @property
     def status(self):
         """Return the status of the robot"""
+        arduino_status = self.arduino.status
+        arduino_status['resetting'] = self.resetting
         status = {
                 'driver':self.driver.status,
-                'arduino':self.arduino.status,
+                'arduino':arduino_status,
+                'odometry':self.odometry.status,
+                'trajectory':self.trajectory.status,
                 'sensors':[]}
 
         for name, sensor in self.sensors.items():
@@ -235,18 +446,55 @@ class Robot(object):
 
         return status
 
-    def reset(self):
-        """Reset all of the components to a known initialized state"""
-        if self.arduino:
-            self.arduino.stop()
+    def reset(self, block = False, settle_secs = None, takeover = False):
+        """Reset all of the components to a known initialized state
+
+        The reset happens in the background as the monitor steps it along;
+        with block, step it here until it's done instead. When taking over
+        from another server, the arduino is left running as it was.
+        """
+        started = self.resetter.start(self.arduino, settle_secs, takeover)
+        if block:
+            while self.resetter.busy:
+                self.resetter.step()
+                time.sleep(.05)
+
+            if self.resetter.last_outcome == 'failed':
+                raise self.resetter.last_error
+
+        return started
+
+    def _install_arduino(self, new_arduino, placeholder):
+        """Switches to a new arduino (or the stand-in used while resetting)"""
+        self.arduino = new_arduino
+        if not placeholder:
+            self.arduino.start_monitor()
+            self.odometry.resync()
+
+        # on a takeover the robot is still moving; restore() picks it up
+        if not self.resetter.takeover:
+            self.driver.stop()
+        self.last_control = time.time()
 
-        time.sleep(.5)
+    @property
+    def resetting(self):
+        return self.resetter.busy
 
-        self.arduino = arduino.find_arduino(self.arduino_serial)
-        self.arduino.start_monitor()
+    def restore(self, state):
+        """Picks up driving where another server (see standby.py) left off"""
+        self.driver.target_speeds = list(state['target speeds'])
+        self.driver.braking_speed = state['braking speed']
 
-        self.driver.stop()
-        self.last_control = time.time()
+        # carry on along the motion profile from the speed we were at
+        for profile, speed in zip(self.driver.profiles, state.get('last speeds', [0, 0])):
+            profile.reset(speed)
+        self.driver.last_speeds = list(state.get('last speeds', [0, 0]))
+        self.driver.last_sent = None
+        self.last_control = state['last control']
+
+        # the arduino may have stopped in the gap; keep it going if we were
+        if not state.get('estop', True):
+            self.arduino.send_command('G')
 
     def go(self):
         """Puts the robot in go mode"""
@@ -263,11 +511,33 @@ class Robot(object):
         self.driver.brake(speed)
         self.last_control = time.time()
 
+    def tune(self, kp = None, ki = None, kd = None):
+        """Changes the speed controller gains, if the driver has any"""
+        if not hasattr(self.driver, 'set_gains'):
+            raise drivers.common.ParameterError("this driver has no gains to tune")
+        self.driver.set_gains(kp, ki, kd)
+
+    def run_trajectory(self, segments, limits):
+        """Checks a trajectory against the driver's and the given limits and starts it"""
+        if self.arduino.status['estop']:
+            raise drivers.common.StoppedError("Cannot start a trajectory while emergency stopped")
+
+        # ramp from where the wheels are, which may still be short of the targets
+        trajectory.validate(segments, self.driver, self.driver.last_speeds,
+                limits.max_segments, limits.max_duration)
+        self.trajectory.start(segments)
+        self.last_control = time.time()
+
     def set_speed(self, speed, motor):
         """sets the speed on one or both motors"""
         self.driver.set_speed(speed, motor)
         self.last_control = time.time()
 
+    def set_speeds(self, left, right):
+        """sets the speeds of both motors at once"""
+        self.driver.set_speeds(left, right)
+        self.last_control = time.time()
+
 def main():
     """Parses command-line options and starts the robot-controlling server"""
     parser = OptionParser()
@@ -275,6 +545,10 @@ def main():
             help="Print more debug info")
     parser.add_option("--list", action="store_true", dest="list", default=False,
             help="List the available drivers")
+    parser.add_option("--standby", action="store_true", dest="standby", default=False,
+            help="If another server is running, wait (fully initialized) to take over when it dies")
+    parser.add_option("--config", action="store", type="string", dest="config", default=config.DEFAULT_PATH,
+            help="Read the parameters from this file [Default: parameters.py]")
 
     opgroup = OptionGroup(parser, "Operational options")
     opgroup.add_option('-d', '--driver', action="store", type="choice", dest="driver", default="sabertooth", choices=drivers.driverlist.keys(),
@@ -296,10 +570,13 @@ def main():
             help="The serial number of the left controller [3000-6A06-3142-3732-7346-2543]")
     smcgroup.add_option("-r", "--right", type="string", dest="right", default="3000-6F06-3142-3732-4454-2543",
             help="The serial number of the right controller [3000-6F06-3142-3732-4454-2543]")
-    smcgroup.add_option("-c", "--smccmd", type="string", dest="smccmd", default="/root/pololu/smc_linux/SmcCmd",
-            help="The path to the SmcCmd utility [/root/pololu/smc_linux/SmcCmd]")
     parser.add_option_group(smcgroup)
 
+    simgroup = OptionGroup(parser, "Simulation driver options")
+    simgroup.add_option("--time-scale", type="float", dest="sim_time_scale", default=None,
+            help="Run the simulated world this many times faster than real time [Default: 1]")
+    parser.add_option_group(simgroup)
+
     # parse the arguments
     options, args = parser.parse_args()
 
@@ -323,15 +600,44 @@ def main():
 
         return 0
 
+    server_config = config.Config(options.config)
+    sp = server_config.current.standby
+
+    # only one server may drive the robot at a time
+    lock = standby.acquire_lock(sp.lock_path)
+    if lock is None and not options.standby:
+        print "Another server is running (see %s); use --standby to wait for it" % sp.lock_path
+        return 1
+
     # otherwise, try to create the robot and then start the servers
-    robot = Robot(**vars(options))
-    robot.reset()
+    robot = Robot(server_config.current, **vars(options))
+
+    if lock is None:
+        print "Standing by..."
+        lock = standby.acquire_lock(sp.lock_path, block = True)
+        takeover_start = time.time()
+        logging.warn("primary server is gone; taking over")
+
+        # the old server is dead, so its port is already closed
+        robot.reset(block = True, settle_secs = 0, takeover = True)
+    else:
+        takeover_start = None
+        robot.reset(block = True)
     print "Robot initialized successfully..."
 
+    # pick up where a previous server left off, if it was only just now
+    state = standby.StateFile(sp.state_path).load(sp.state_max_age)
+    if state:
+        robot.restore(state)
+
     # create the robot
     server = TCPServer((options.host, options.port), ConnectionHandler)
-    server.last_request = 0
+    server.last_request = time.time() if state else 0
     server.robot = robot
+    server.config = server_config
+
+    if state and state['controller']:
+        server.reserved_controller = (state['controller'], time.time() + sp.controller_reservation)
 
     # used to limit control of the robot to a single connection
     server.control_lock = threading.RLock()
@@ -341,6 +647,17 @@ def main():
     server.monitor = server_monitor
     server_monitor.start()
 
+    # kill -HUP reloads parameters.py, like the 'reload' command
+    def reload_on_hangup(signum, frame):
+        try:
+            server.reload_config()
+        except config.ConfigError:
+            pass    # already logged; the old configuration stays
+    signal.signal(signal.SIGHUP, reload_on_hangup)
+
+    if takeover_start:
+        logging.warn("took over in %.3fs" % (time.time() - takeover_start))
+
     # start the robot and begin accepting requests
     print "Starting server..."
     try:
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""Support for running a warm-standby server
+
+Every server takes an exclusive lock before touching the arduino or
+opening its port. A server started with --standby that finds the lock
+taken finishes initializing and then waits on the lock; the kernel
+releases it the moment the primary dies, however it dies, and the
+standby takes over.
+
+While it runs, the primary keeps a small state file up to date so the
+standby can pick up the driver targets and who was in control.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+
+def acquire_lock(path, block = False):
+    """Takes the server lock; returns the open lock file, or None if another server holds it"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+
+    # note who has it, for humans
+    os.ftruncate(fd, 0)
+    os.write(fd, '%d\n' % os.getpid())
+    return fd
+
+class StateFile(object):
+    """The bits of server state a standby needs to take over"""
+    def __init__(self, path, min_interval = 1):
+        self.path = path
+
+        # rewrite an unchanged state this often, so readers can tell it's fresh
+        self.min_interval = min_interval
+
+        self.last_state = None
+        self.last_write = 0
+
+    def save(self, state):
+        """Atomically replaces the state file, unless nothing has changed"""
+        now = time.time()
+        if state == self.last_state and now - self.last_write < self.min_interval:
+            return False
+
+        data = dict(state)
+        data['time'] = now
+
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        fhandle = open(tmp_path, 'w')
+        try:
+            json.dump(data, fhandle)
+        finally:
+            fhandle.close()
+        os.rename(tmp_path, self.path)
+
+        self.last_state = state
+        self.last_write = now
+        return True
+
+    def load(self, max_age):
+        """Returns the saved state if it was written in the last max_age seconds, otherwise None"""
+        try:
+            fhandle = open(self.path)
+            try:
+                state = json.load(fhandle)
+            finally:
+                fhandle.close()
+        except (IOError, ValueError), e:
+            logging.info("no usable state in %s: %s" % (self.path, e))
+            return None
+
+        age = time.time() - state.get('time', 0)
+        if age > max_age:
+            logging.info("state in %s is %.1fs old; ignoring it" % (self.path, age))
+            return None
+
+        return state
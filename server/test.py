@@ -1,10 +1,57 @@
 #!/usr/bin/python
+"""Drives the smc driver against two fake controllers on pseudo-terminals"""
 
-left = '3000-6A06-3142-3732-7346-2543'
-right = '3000-6F06-3142-3732-4454-2543'
-smcpath = '/root/pololu/smc_linux/SmcCmd'
+import time
 
-from drivers.smccmd import SmcCmdDriver
-d = SmcCmdDriver(left, right, smcpath)
-print "speeds -- left: %s\tright: %s" % (d.left, d.right)
+from arduino import FakeArduino
+from drivers.smc import FakeSmc, SmcDriver, SAFE_START_ERROR
+from parameters import driver as dp, smc as smcp
 
+class Robot(object):
+    def __init__(self):
+        self.arduino = FakeArduino()
+
+left, right = FakeSmc(), FakeSmc()
+robot = Robot()
+
+args = dict(dp)
+args.update(smcp)
+d = SmcDriver(robot, left.port, right.port, **args)
+
+d.go()
+robot.arduino.state.emergency_stop = False
+d.set_speeds(40, 30)
+
+def drive_for(seconds):
+    start = time.time()
+    while time.time() - start < seconds:
+        d.update_speed()
+        time.sleep(.05)
+
+drive_for(4)
+
+status = d.status
+print "speeds -- left: %s\tright: %s" % (status['left smc speed'], status['right smc speed'])
+print "fake speeds -- left: %s\tright: %s" % (left.speed, right.speed)
+print "voltage: %s\ttemperature: %s" % (status['left smc voltage'], status['left smc temperature'])
+print "writes: %s\tcommands: %s\tbad: %s" % (status['left smc writes'], left.commands, left.bad_commands)
+
+# replug the left controller; it comes back in safe-start
+d.controllers[0].close()
+left.errors |= SAFE_START_ERROR
+left.target_speed = 0
+drive_for(1)
+print "replugged -- left target: %s\terrors: %s\tspeed: %s" % (left.target_speed, left.errors, left.speed)
+
+# the right controller latches an error, e.g. a command timeout
+right.errors |= SAFE_START_ERROR
+drive_for(1)
+print "latched error -- right target: %s\terrors: %s\tspeed: %s" % (right.target_speed, right.errors, right.speed)
+
+d.stop()
+time.sleep(.1)
+print "stopped -- left target: %s\terrors: %s" % (left.target_speed, left.errors)
+
+d.close()
+left.close()
+right.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""Runs timed sequences of wheel speeds on the server
+
+A trajectory is uploaded in one go and then stepped by the monitor at
+the driver's update rate, so its timing doesn't depend on the network.
+It is written as space-separated segments, each one of:
+    w:<seconds>:<left>:<right>          wheel speeds
+    c:<seconds>:<speed>:<curvature>     speed along an arc
+
+Curvature is 1/radius in inches, positive to the left; the wheel speeds
+come from the track width. When the last segment ends the robot is
+brought to a stop.
+"""
+
+import logging
+import threading
+import time
+
+from drivers import common
+
+class Segment(object):
+    """Holds both wheels at fixed speeds for a while"""
+    def __init__(self, duration, left, right):
+        self.duration = duration
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return "Segment(%.2f, %.1f, %.1f)" % (self.duration, self.left, self.right)
+
+def parse(text, track_width):
+    """Turns the text form of a trajectory into a list of segments; raises ValueError"""
+    segments = []
+    for token in text.split():
+        parts = token.split(':')
+        try:
+            kind, values = parts[0], [float(v) for v in parts[1:]]
+        except ValueError:
+            raise ValueError("segment '%s' has a value that isn't a number" % token)
+
+        if kind not in ('w', 'c') or len(values) != 3:
+            raise ValueError("segment '%s' should be w:seconds:left:right or c:seconds:speed:curvature" % token)
+
+        duration = values[0]
+        if duration <= 0:
+            raise ValueError("segment '%s' must last longer than 0 seconds" % token)
+
+        if kind == 'w':
+            left, right = values[1:]
+        else:
+            speed, curvature = values[1:]
+            left = speed * (1 - curvature * track_width / 2.)
+            right = speed * (1 + curvature * track_width / 2.)
+
+        segments.append(Segment(duration, left, right))
+
+    if not segments:
+        raise ValueError("a trajectory needs at least one segment")
+
+    return segments
+
+def validate(segments, driver, start_speeds, max_segments, max_duration):
+    """Checks a whole trajectory against the driver's limits; raises ParameterError"""
+    if len(segments) > max_segments:
+        raise common.ParameterError("Trajectory has %d segments; at most %d are allowed" % (
+            len(segments), max_segments))
+
+    total = sum(segment.duration for segment in segments)
+    if total > max_duration:
+        raise common.ParameterError("Trajectory lasts %.1fs; at most %.1fs is allowed" % (
+            total, max_duration))
+
+    # drivers with a motion profile have to be able to reach every setpoint in time
+    profiles = getattr(driver, 'profiles', None)
+    step = getattr(driver, 'setpoint_interval', .05)
+    # both wheels have the same limits, and trajectories repeat themselves
+    ramps = {}
+
+    previous = list(start_speeds)
+    for number, segment in enumerate(segments):
+        speeds = (segment.left, segment.right)
+        for speed in speeds:
+            if abs(speed) > driver.max_speed:
+                raise common.ParameterError("Segment %d speed %.1f exceeds maximum value of %d" % (
+                    number + 1, speed, driver.max_speed))
+
+        if abs(segment.left - segment.right) > driver.max_turn_speed:
+            raise common.ParameterError("Segment %d targets (%.1f,%.1f) exceed maximum turn velocity of %d" % (
+                number + 1, segment.left, segment.right, driver.max_turn_speed))
+
+        if profiles:
+            for old, new in zip(previous, speeds):
+                if (old, new) not in ramps:
+                    ramps[old, new] = profiles[0].ramp_time(old, new, step)
+                ramp = ramps[old, new]
+                if ramp > segment.duration:
+                    raise common.ParameterError("Segment %d needs %.2fs to reach its speed but lasts %.2fs" % (
+                        number + 1, ramp, segment.duration))
+
+        previous = speeds
+
+class TrajectoryExecutor(object):
+    """Feeds a trajectory's setpoints to the driver as time passes
+
+    Anything else taking control (a client command, or the monitor
+    braking or stopping the robot) aborts the trajectory.
+    """
+    def __init__(self, robot):
+        self.robot = robot
+        self.lock = threading.Lock()
+
+        self.segments = None
+        self.started = None
+        self.segment = None
+
+        self.runs = 0
+        self.last_outcome = None
+
+    @property
+    def running(self):
+        return self.segments is not None
+
+    def start(self, segments):
+        """Begins executing a (validated) trajectory right away"""
+        with self.lock:
+            if self.running:
+                self._finish('preempted by a new trajectory')
+            self.segments = segments
+            self.started = time.time()
+            self.segment = None
+            self.runs += 1
+
+        self.step()
+
+    def abort(self, reason):
+        """Stops following the trajectory, leaving the driver as it is"""
+        with self.lock:
+            if self.running:
+                self._finish(reason)
+
+    def _finish(self, outcome):
+        self.segments = None
+        self.segment = None
+        self.last_outcome = outcome
+        if outcome != 'done':
+            logging.info("trajectory %s" % outcome)
+
+    def step(self):
+        """Sets the driver targets for the current segment; call at the driver's update rate"""
+        with self.lock:
+            if not self.running:
+                return
+
+            driver = self.robot.driver
+
+            # someone else is stopping or slowing us down; they win
+            if self.robot.arduino.status['estop']:
+                return self._finish('aborted by emergency stop')
+            if self.segment is not None and driver.braking_speed:
+                return self._finish('aborted by braking')
+
+            elapsed = time.time() - self.started
+            end = 0
+            for number, segment in enumerate(self.segments):
+                end += segment.duration
+                if elapsed < end:
+                    break
+            else:
+                try:
+                    driver.set_speeds(0, 0)
+                except common.StoppedError:
+                    pass
+                return self._finish('done')
+
+            # we're in control, so the control timeouts shouldn't kick in
+            self.robot.last_control = time.time()
+            if number == self.segment:
+                return
+
+            try:
+                driver.set_speeds(segment.left, segment.right)
+            except common.DriverError, e:
+                return self._finish('aborted: %s' % e)
+
+            self.segment = number
+
+    @property
+    def status(self):
+        with self.lock:
+            running = self.running
+            return {
+                    'running':running,
+                    'segment':(self.segment + 1) if running and self.segment is not None else None,
+                    'segments':len(self.segments) if running else None,
+                    'elapsed':round(time.time() - self.started, 2) if running else None,
+                    'runs':self.runs,
+                    'last outcome':self.last_outcome,
+                    }
@@ -1,7 +1,6 @@
 #!/usr/bin/env python 
 
 import math
-import numpy as np
 
 INCH = 1.
 FOOT = 12. * INCH
@@ -24,6 +23,9 @@ class Cart(object):
         self.length = length
 
     def get_polygon(self, dx, dy):
+        # only drawing needs numpy; the server's sim driver uses the rest
+        import numpy as np
+
         # Center of axle is always at width/2, height/2.
         hw, hl = self.width / 2., self.length / 2.
         rot = np.matrix([[math.cos(self.theta), -math.sin(self.theta)],
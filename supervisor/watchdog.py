@@ -1,44 +1,123 @@
 #!/usr/bin/env python
+"""Kills the server if its monitor loop stops making progress
 
+The server registers its pid on startup and then sends a heartbeat (see
+server/heartbeat.py) several times a second over a unix datagram socket.
+If no heartbeat with an advancing loop counter arrives within the
+deadline, the server is killed and supervisor restarts it.
+"""
+
+import errno
 import logging
 import os
-import psutil
+import signal
+import socket
 import time
 
+from optparse import OptionParser
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s watchdog %(levelname)-8s %(message)s',
                     datefmt='%m-%d %H:%M:%S')
 
-def get_server_process():
-    for p in psutil.process_iter():
-        if p.cmdline == ['/usr/bin/python', '/root/penguins/server/server.py']:
-            return p
-
-# log the next time these events happen
-log_server_down = True
-log_fresh = True
-
-# every 5 seconds, check to see that the sever touched a file less than 5
-# seconds ago. it tries to touch the file every second so it's really out to
-# lunch if it hasn't done it yet.
-while True:
-    now = time.time()
-    server = get_server_process()
-    if server:
-        log_server_down = True
-        # the server process is running, so the monitor file should be current
-        stat = os.stat('/tmp/server-monitor-alive')
-        if now - stat[8] > 5:
-            log_fresh = True
-            # the server is out to lunch, kill it dead.
-            # supervisor will restart it.
-            server.kill(9)
-            logging.error('monitor file is stale, killing server')
-        elif log_fresh:
-            logging.info('monitor file fresh')
-            log_fresh = False
-    elif log_server_down:
-        logging.warning('server is not running')
-        log_fresh = True
-        log_server_down = False
-    time.sleep(5)
+class Watchdog(object):
+    """Tracks the heartbeats of a single server process"""
+    def __init__(self, path, deadline):
+        self.deadline = deadline
+
+        # clear out a socket left behind by an earlier watchdog
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+
+        self.pid = None
+        self.counter = None
+        self.health = 0
+        self.last_progress = 0
+
+    def receive(self, timeout):
+        """Waits up to timeout seconds (forever if None) for a message"""
+        self.sock.settimeout(timeout)
+        try:
+            message = self.sock.recv(256)
+        except socket.timeout:
+            return
+
+        try:
+            parts = message.split()
+            kind, pid = parts[0], int(parts[1])
+            if kind == 'beat':
+                counter, health = int(parts[2]), int(parts[3])
+        except (IndexError, ValueError):
+            logging.warning('ignoring bad message %r' % message)
+            return
+
+        now = time.time()
+        if kind == 'register':
+            logging.info('server registered with pid %d' % pid)
+            self.pid, self.counter, self.health = pid, None, 0
+            self.last_progress = now
+
+        elif kind == 'unregister':
+            if pid == self.pid:
+                logging.info('server %d exiting' % pid)
+                self.pid = None
+
+        elif kind == 'beat':
+            if pid != self.pid:
+                logging.info('following heartbeats from pid %d' % pid)
+                self.pid, self.counter = pid, None
+
+            if counter != self.counter:
+                self.counter = counter
+                self.last_progress = now
+            self.health = health
+
+    def check(self):
+        """Kills the server if it has missed its deadline"""
+        if self.pid is None:
+            return
+
+        stalled = time.time() - self.last_progress
+        if stalled <= self.deadline:
+            return
+
+        try:
+            # supervisor will restart it
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+            logging.warning('server %d went away without unregistering' % self.pid)
+        else:
+            logging.error('no progress from server %d for %.3fs, killed it' % (self.pid, stalled))
+
+        self.pid = None
+
+    def run(self):
+        while True:
+            if self.pid is None:
+                timeout = None
+            else:
+                timeout = max(0, self.last_progress + self.deadline - time.time())
+
+            self.receive(timeout)
+            self.check()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-s', '--socket', action="store", type="string", dest="socket",
+            default='/tmp/server-heartbeat.sock',
+            help="Unix socket to listen for heartbeats on [Default: /tmp/server-heartbeat.sock]")
+    parser.add_option('-d', '--deadline', action="store", type="float", dest="deadline", default=.5,
+            help="Seconds without progress before the server is killed [Default: 0.5]")
+    options, args = parser.parse_args()
+
+    watchdog = Watchdog(options.socket, options.deadline)
+    logging.info('waiting for heartbeats on %s' % options.socket)
+    watchdog.run()
+
+if __name__ == '__main__':
+    main()